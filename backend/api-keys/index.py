@@ -1,161 +1,257 @@
-import json
-import os
+import base64
+import hashlib
 import secrets
 from datetime import datetime
-from typing import Dict, Any
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from typing import Dict, Any, List, Optional, Tuple
+from runtime import Router, connection, error_response, json_response, parse_body, psycopg2, query_params, setting
+from timing import instrument
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+KEYS_CHANGED_CHANNEL = 'api_keys_changed'
+KEY_PREFIX_LENGTH = 12
+KEYS_DEFAULT_LIMIT = 50
+KEYS_MAX_LIMIT = 200
+BULK_MAX_KEYS = 1000
+NOTIFY_PAYLOAD_LIMIT = 7900
+
+
+def encode_cursor(created_at: datetime, key_id: str) -> str:
+    '''Opaque keyset cursor pointing just past (created_at, id)'''
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{key_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    created_at, key_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(created_at), key_id
+
+
+def notify_keys_changed(cur: Any, key_ids: List[str]) -> None:
     '''
-    Business: Manage API keys - create, list, revoke
-    Args: event with httpMethod, body, queryStringParameters
-    Returns: HTTP response with API keys data
+    Tell proxy key caches which keys changed: one pg_notify per payload of
+    comma-separated ids, each under the NOTIFY payload limit, in one statement.
     '''
-    method: str = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Api-Key',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    database_url = os.environ.get('DATABASE_URL')
-    if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Database configuration missing'}),
-            'isBase64Encoded': False
-        }
-    
-    conn = psycopg2.connect(database_url)
-    
+    payloads: List[str] = []
+    for key_id in key_ids:
+        if payloads and len(payloads[-1]) + 1 + len(key_id) <= NOTIFY_PAYLOAD_LIMIT:
+            payloads[-1] = f'{payloads[-1]},{key_id}'
+        else:
+            payloads.append(key_id)
+    if payloads:
+        cur.execute("SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload",
+                    (KEYS_CHANGED_CHANNEL, payloads))
+
+
+def key_settings(body_data: Dict[str, Any]) -> Tuple[str, Optional[int], Optional[int]]:
+    '''
+    Name, rateLimitRpm and dailyTokenLimit of a key to create.
+    Raises ValueError with the error message on invalid input.
+    '''
+    name = body_data.get('name', '')
+    name = name.strip() if isinstance(name, str) else ''
+    rate_limit_rpm = body_data.get('rateLimitRpm')
+    daily_token_limit = body_data.get('dailyTokenLimit')
+
+    if not name:
+        raise ValueError('Name is required')
+
+    for limit in (rate_limit_rpm, daily_token_limit):
+        if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0):
+            raise ValueError('Limits must be positive integers')
+
+    return name, rate_limit_rpm, daily_token_limit
+
+
+def new_key_row(name: str, rate_limit_rpm: Optional[int], daily_token_limit: Optional[int],
+                created_at: datetime) -> Tuple[str, Tuple[Any, ...]]:
+    '''A fresh key and its api_keys row; only the digest and prefix of the key are stored'''
+    key_id = f"key_{secrets.token_hex(8)}"
+    key_value = f"sk_live_{secrets.token_urlsafe(20)}"
+    return key_value, (key_id, name, hashlib.sha256(key_value.encode()).digest(), key_value[:KEY_PREFIX_LENGTH],
+                       created_at, True, rate_limit_rpm, daily_token_limit)
+
+
+def created_key(key_value: str, row: Tuple[Any, ...]) -> Dict[str, Any]:
+    key_id, name, _, _, created_at, _, rate_limit_rpm, daily_token_limit = row
+    return {
+        'id': key_id,
+        'name': name,
+        'key': key_value,
+        'created': created_at.strftime('%d %b %Y'),
+        'lastUsed': 'Не использовался',
+        'requests': 0,
+        'rateLimitRpm': rate_limit_rpm,
+        'dailyTokenLimit': daily_token_limit
+    }
+
+
+def list_keys(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    One page of active keys, newest first, paged by (created_at, id) with
+    limit and cursor and narrowed to names containing q. Request counts are
+    summed from the key_daily_usage rollup for the page's keys only.
+    '''
+    params = query_params(event)
+    conditions = ['is_active']
+    args: List[Any] = []
     try:
-        if method == 'GET':
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute("""
-                    SELECT id, name, key_value, created_at, last_used_at, request_count, is_active
+        limit = min(max(int(params.get('limit', KEYS_DEFAULT_LIMIT)), 1), KEYS_MAX_LIMIT)
+        if params.get('cursor'):
+            conditions.append('(created_at, id) < (%s, %s)')
+            args.extend(decode_cursor(params['cursor']))
+    except ValueError:
+        return error_response(400, 'Invalid limit or cursor')
+
+    search_query = (params.get('q') or '').strip()
+    if search_query:
+        conditions.append('name ILIKE %s')
+        args.append('%' + search_query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+
+    with connection(setting('DATABASE_URL')) as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(f"""
+                SELECT k.id, k.name, k.key_prefix, k.created_at,
+                       to_char(k.created_at, 'DD Mon YYYY') AS created,
+                       to_char(k.last_used_at, 'HH24:MI') AS last_used,
+                       COALESCE(u.requests, 0) AS requests,
+                       k.rate_limit_rpm, k.daily_token_limit
+                FROM (
+                    SELECT id, name, key_prefix, created_at, last_used_at, rate_limit_rpm, daily_token_limit
                     FROM api_keys
-                    WHERE is_active = true
-                    ORDER BY created_at DESC
-                """)
-                keys = cur.fetchall()
-                
-                result = []
-                for key in keys:
-                    result.append({
-                        'id': key['id'],
-                        'name': key['name'],
-                        'key': key['key_value'],
-                        'created': key['created_at'].strftime('%d %b %Y') if key['created_at'] else '',
-                        'lastUsed': key['last_used_at'].strftime('%H:%M') if key['last_used_at'] else 'Не использовался',
-                        'requests': key['request_count']
-                    })
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({'keys': result}),
-                    'isBase64Encoded': False
-                }
-        
-        elif method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
-            name = body_data.get('name', '').strip()
-            
-            if not name:
-                return {
-                    'statusCode': 400,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({'error': 'Name is required'}),
-                    'isBase64Encoded': False
-                }
-            
-            key_id = f"key_{secrets.token_hex(8)}"
-            key_value = f"sk_live_{secrets.token_urlsafe(20)}"
-            
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO api_keys (id, name, key_value, created_at, is_active)
-                    VALUES (%s, %s, %s, %s, %s)
-                """, (key_id, name, key_value, datetime.now(), True))
-                conn.commit()
-            
-            return {
-                'statusCode': 201,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'id': key_id,
-                    'name': name,
-                    'key': key_value,
-                    'created': datetime.now().strftime('%d %b %Y'),
-                    'lastUsed': 'Не использовался',
-                    'requests': 0
-                }),
-                'isBase64Encoded': False
-            }
-        
-        elif method == 'DELETE':
-            params = event.get('queryStringParameters', {})
-            key_id = params.get('id', '')
-            
-            if not key_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({'error': 'Key ID is required'}),
-                    'isBase64Encoded': False
-                }
-            
-            with conn.cursor() as cur:
-                cur.execute("""
-                    UPDATE api_keys SET is_active = false WHERE id = %s
-                """, (key_id,))
-                conn.commit()
-            
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({'success': True}),
-                'isBase64Encoded': False
-            }
-        
-        else:
-            return {
-                'statusCode': 405,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
-    
-    finally:
-        conn.close()
\ No newline at end of file
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s
+                ) k
+                LEFT JOIN LATERAL (
+                    SELECT SUM(requests) AS requests FROM key_daily_usage WHERE key_id = k.id
+                ) u ON true
+                ORDER BY k.created_at DESC, k.id DESC
+            """, (*args, limit + 1))
+            keys = cur.fetchall()
+
+    next_cursor = None
+    if len(keys) > limit:
+        keys = keys[:limit]
+        next_cursor = encode_cursor(keys[-1]['created_at'], keys[-1]['id'])
+
+    result = [{
+        'id': key['id'],
+        'name': key['name'],
+        'key': f"{key['key_prefix']}...",
+        'created': key['created'] or '',
+        'lastUsed': key['last_used'] or 'Не использовался',
+        'requests': key['requests'],
+        'rateLimitRpm': key['rate_limit_rpm'],
+        'dailyTokenLimit': key['daily_token_limit']
+    } for key in keys]
+
+    return json_response(200, {'keys': result, 'nextCursor': next_cursor})
+
+
+def create_keys(body_data: Dict[str, Any]) -> Dict[str, Any]:
+    '''Create every key in body keys, a list of {name, rateLimitRpm, dailyTokenLimit}, in one transaction'''
+    items = body_data.get('keys')
+    if not isinstance(items, list) or not items:
+        return error_response(400, 'Keys array is required')
+    if len(items) > BULK_MAX_KEYS:
+        return error_response(400, 'Too many keys', message=f'At most {BULK_MAX_KEYS} keys per request')
+
+    now = datetime.now()
+    created = []
+    for i, item in enumerate(items):
+        try:
+            created.append(new_key_row(*key_settings(item if isinstance(item, dict) else {}), now))
+        except ValueError as e:
+            return error_response(400, str(e), index=i)
+    rows = [row for _, row in created]
+
+    with connection(setting('DATABASE_URL')) as conn:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO api_keys (id, name, key_digest, key_prefix, created_at, is_active,
+                                      rate_limit_rpm, daily_token_limit)
+                VALUES %s
+            """, rows, page_size=len(rows))
+            notify_keys_changed(cur, [row[0] for row in rows])
+            conn.commit()
+
+    return json_response(201, {'keys': [created_key(key_value, row) for key_value, row in created]})
+
+
+def create_key(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    body_data = parse_body(event)
+
+    if query_params(event).get('action') == 'bulk':
+        return create_keys(body_data)
+
+    try:
+        key_value, row = new_key_row(*key_settings(body_data), datetime.now())
+    except ValueError as e:
+        return error_response(400, str(e))
+
+    with connection(setting('DATABASE_URL')) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO api_keys (id, name, key_digest, key_prefix, created_at, is_active,
+                                      rate_limit_rpm, daily_token_limit)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """, row)
+            notify_keys_changed(cur, [row[0]])
+            conn.commit()
+
+    return json_response(201, created_key(key_value, row))
+
+
+def revoke_keys(body_data: Dict[str, Any]) -> Dict[str, Any]:
+    '''Revoke every key in body ids in one transaction'''
+    key_ids = body_data.get('ids')
+    if not isinstance(key_ids, list) or not key_ids or not all(isinstance(key_id, str) for key_id in key_ids):
+        return error_response(400, 'Key IDs are required')
+    if len(key_ids) > BULK_MAX_KEYS:
+        return error_response(400, 'Too many keys', message=f'At most {BULK_MAX_KEYS} keys per request')
+
+    with connection(setting('DATABASE_URL')) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE api_keys SET is_active = false WHERE id = ANY(%s) AND is_active RETURNING id
+            """, (key_ids,))
+            revoked = [row[0] for row in cur.fetchall()]
+            notify_keys_changed(cur, revoked)
+            conn.commit()
+
+    return json_response(200, {'success': True, 'revoked': len(revoked)})
+
+
+def revoke_key(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    params = query_params(event)
+
+    if params.get('action') == 'bulk':
+        return revoke_keys(parse_body(event))
+
+    key_id = params.get('id', '')
+
+    if not key_id:
+        return error_response(400, 'Key ID is required')
+
+    with connection(setting('DATABASE_URL')) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE api_keys SET is_active = false WHERE id = %s
+            """, (key_id,))
+            notify_keys_changed(cur, [key_id])
+            conn.commit()
+
+    return json_response(200, {'success': True})
+
+
+router = Router({'GET': list_keys, 'POST': create_key, 'DELETE': revoke_key},
+                allow_headers='Content-Type, X-Api-Key', database_required=True)
+
+
+@instrument('api-keys')
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Manage API keys - create, list, revoke; action=bulk creates or revokes many keys in one transaction
+    Args: event with httpMethod, body (name and limits, keys for bulk create, ids for bulk revoke),
+          queryStringParameters (id, action; limit, cursor, q for listing)
+    Returns: HTTP response with API keys data
+    '''
+    return router(event, context)
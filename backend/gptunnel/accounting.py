@@ -0,0 +1,386 @@
+import atexit
+import bisect
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Any, Callable, List, Optional, Tuple
+from runtime import dumps, psycopg2
+from timing import report_dropped_rows, report_flush_failure
+
+ACCOUNTING_FLUSH_ROWS = int(os.environ.get('ACCOUNTING_FLUSH_ROWS', '200'))
+ACCOUNTING_FLUSH_INTERVAL = float(os.environ.get('ACCOUNTING_FLUSH_INTERVAL', '2'))
+ACCOUNTING_MAX_ROWS = int(os.environ.get('ACCOUNTING_MAX_ROWS', '20000'))
+ROLLUP_DURATION_BOUNDS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+ROLLUP_FIELDS = 6 + len(ROLLUP_DURATION_BOUNDS_MS) + 1
+
+
+class UsageBuffer:
+    '''
+    In-memory accumulator for proxy usage accounting.
+    Key usage and token_stats are aggregated per key and per (date, model),
+    usage rollups per (hour, key, model) with a duration histogram;
+    history, log and webhook event rows are queued and written with execute_values.
+    Everything pending is written in one transaction when ACCOUNTING_FLUSH_ROWS
+    rows are queued or the oldest entry is ACCOUNTING_FLUSH_INTERVAL seconds old.
+    With flush_inline off that write is left to the flusher thread, so callers
+    running on an event loop never wait for the database.
+    A failed write keeps every row buffered for the next flush. Once
+    ACCOUNTING_MAX_ROWS history, log or event rows are queued the recording
+    caller waits for a flush itself; only when that flush fails too are the
+    oldest rows over the cap dropped, and each drop is logged and counted.
+    '''
+
+    def __init__(self, get_pool: Callable[[str], Any]):
+        self._get_pool = get_pool
+        self._database_url: Optional[str] = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+        self.flush_inline = True
+        self._reset()
+        atexit.register(self.flush)
+
+    def _reset(self) -> None:
+        self._key_usage: Dict[str, List[Any]] = {}
+        self._token_stats: Dict[Tuple[Any, str], List[int]] = {}
+        self._daily_usage: Dict[Tuple[str, Any], List[int]] = {}
+        self._rollups: Dict[Tuple[Any, str, str], List[int]] = {}
+        self._history: List[Tuple[Any, ...]] = []
+        self._logs: List[Tuple[Any, ...]] = []
+        self._events: List[Tuple[Any, ...]] = []
+        self._oldest: Optional[float] = None
+
+    def record_request(self, database_url: str, key_id: str) -> None:
+        '''Count one request against key_id and bump its last_used_at'''
+        now = datetime.now()
+        with self._lock:
+            self._touch(database_url)
+            usage = self._key_usage.get(key_id)
+            if usage is None:
+                self._key_usage[key_id] = [1, now]
+            else:
+                usage[0] += 1
+                usage[1] = now
+            self._daily_usage.setdefault((key_id, now.date()), [0, 0])[0] += 1
+        self.maybe_flush()
+
+    def record_completion(self, database_url: str, key_id: str, endpoint: str, model: str,
+                          prompt_tokens: int, completion_tokens: int, total_tokens: int,
+                          duration_ms: int, user_message: str, ai_response: str,
+                          cache_status: Optional[str] = None) -> None:
+        '''
+        Queue a request_history row and add its tokens to the daily model totals.
+        cache_status is 'hit' or 'miss' for requests that opted into the completion cache;
+        an empty key_id records a keyless completion with no per-key quota usage.
+        '''
+        now = datetime.now()
+        with self._lock:
+            self._touch(database_url)
+            stats_key = (now.date(), model)
+            stats = self._token_stats.setdefault(stats_key, [0, 0, 0, 0, 0, 0])
+            stats[0] += 1
+            stats[1] += total_tokens
+            stats[2] += prompt_tokens
+            stats[3] += completion_tokens
+            if cache_status == 'hit':
+                stats[4] += 1
+            elif cache_status == 'miss':
+                stats[5] += 1
+            if key_id:
+                self._daily_usage.setdefault((key_id, now.date()), [0, 0])[1] += total_tokens
+            self._roll_up(now, key_id, model, False, prompt_tokens, completion_tokens, total_tokens, duration_ms)
+            self._history.append((now, endpoint, 'POST', model, prompt_tokens,
+                                  completion_tokens, total_tokens, duration_ms, 200,
+                                  user_message, ai_response, cache_status == 'hit'))
+        self.maybe_flush()
+
+    def record_failure(self, database_url: str, key_id: str, endpoint: str, model: str,
+                       status_code: int, message: str, duration_ms: int) -> None:
+        '''Queue an error log row and count a failed upstream call in the usage rollups'''
+        now = datetime.now()
+        with self._lock:
+            self._touch(database_url)
+            self._roll_up(now, key_id, model, True, 0, 0, 0, duration_ms)
+            self._logs.append((now, 'error', 'POST', endpoint, status_code, message, duration_ms))
+        self.maybe_flush()
+
+    def record_log(self, database_url: str, level: str, method: str, endpoint: str,
+                   status_code: int, message: str, duration_ms: int) -> None:
+        now = datetime.now()
+        with self._lock:
+            self._touch(database_url)
+            self._logs.append((now, level, method, endpoint, status_code, message, duration_ms))
+        self.maybe_flush()
+
+    def record_event(self, database_url: str, event_type: str, payload: Dict[str, Any]) -> None:
+        '''
+        Queue a webhook event; the flush stores it only when an enabled webhook
+        subscribes to its type and fans it out to every such subscriber.
+        Deliveries to a batching webhook share one due time per batch window and
+        are released early once batch_size of them are waiting. Deliveries to a
+        webhook with an open circuit are held until circuit_open_until.
+        '''
+        now = datetime.now()
+        with self._lock:
+            self._touch(database_url)
+            self._events.append((now, event_type, dumps(payload)))
+        self.maybe_flush()
+
+    def maybe_flush(self) -> None:
+        '''
+        Flush if a threshold is reached and no other flush is running; a full
+        buffer is flushed by the caller whatever flush_inline says
+        '''
+        if self._full():
+            self.flush()
+            self._shed()
+        elif self._flush_due():
+            if self.flush_inline:
+                self._try_flush()
+            else:
+                self._wake.set()
+
+    def flush(self) -> None:
+        '''Write everything pending, waiting for a running flush to finish first'''
+        with self._flush_lock:
+            self._flush_locked()
+
+    def _flush_due(self) -> bool:
+        with self._lock:
+            pending = (len(self._history) + len(self._logs) + len(self._events) + len(self._key_usage)
+                       + len(self._token_stats) + len(self._daily_usage) + len(self._rollups))
+            due = self._oldest is not None and time.monotonic() - self._oldest >= ACCOUNTING_FLUSH_INTERVAL
+        return pending >= ACCOUNTING_FLUSH_ROWS or due
+
+    def _full(self) -> bool:
+        with self._lock:
+            return max(len(self._history), len(self._logs), len(self._events)) >= ACCOUNTING_MAX_ROWS
+
+    def _shed(self) -> None:
+        '''Drop the oldest rows over ACCOUNTING_MAX_ROWS left behind by a failed flush'''
+        dropped = []
+        with self._lock:
+            for table, rows in (('request_history', self._history), ('api_logs', self._logs),
+                                ('webhook_events', self._events)):
+                excess = len(rows) - ACCOUNTING_MAX_ROWS
+                if excess > 0:
+                    del rows[:excess]
+                    dropped.append((table, excess))
+        for table, excess in dropped:
+            report_dropped_rows('usage', table, excess)
+
+    def _try_flush(self) -> None:
+        if self._flush_lock.acquire(blocking=False):
+            try:
+                self._flush_locked()
+            finally:
+                self._flush_lock.release()
+
+    def _flush_locked(self) -> None:
+        with self._lock:
+            if self._oldest is None:
+                return
+            database_url = self._database_url
+            key_usage, token_stats, daily_usage = self._key_usage, self._token_stats, self._daily_usage
+            rollups, history, logs, events = self._rollups, self._history, self._logs, self._events
+            self._reset()
+
+        try:
+            self._write(database_url, key_usage, token_stats, daily_usage, rollups, history, logs, events)
+        except Exception as e:
+            with self._lock:
+                self._merge(key_usage, token_stats, daily_usage, rollups, history, logs, events)
+            report_flush_failure('usage', e)
+
+    def _write(self, database_url: str, key_usage: Dict[str, List[Any]],
+               token_stats: Dict[Tuple[Any, str], List[int]], daily_usage: Dict[Tuple[str, Any], List[int]],
+               rollups: Dict[Tuple[Any, str, str], List[int]], history: List[Tuple[Any, ...]],
+               logs: List[Tuple[Any, ...]], events: List[Tuple[Any, ...]]) -> None:
+        pool = self._get_pool(database_url)
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                if key_usage:
+                    psycopg2.extras.execute_values(cur, """
+                        UPDATE api_keys AS k
+                        SET request_count = k.request_count + v.requests,
+                            last_used_at = GREATEST(k.last_used_at, v.last_used_at)
+                        FROM (VALUES %s) AS v(id, requests, last_used_at)
+                        WHERE k.id = v.id
+                    """, [(key_id, count, used_at) for key_id, (count, used_at) in sorted(key_usage.items())],
+                        template='(%s, %s, %s::timestamp)', page_size=len(key_usage))
+
+                if token_stats:
+                    psycopg2.extras.execute_values(cur, """
+                        INSERT INTO token_stats (date, model, total_requests, total_tokens,
+                                                prompt_tokens, completion_tokens, cache_hits, cache_misses)
+                        VALUES %s
+                        ON CONFLICT (date, model)
+                        DO UPDATE SET
+                            total_requests = token_stats.total_requests + EXCLUDED.total_requests,
+                            total_tokens = token_stats.total_tokens + EXCLUDED.total_tokens,
+                            prompt_tokens = token_stats.prompt_tokens + EXCLUDED.prompt_tokens,
+                            completion_tokens = token_stats.completion_tokens + EXCLUDED.completion_tokens,
+                            cache_hits = token_stats.cache_hits + EXCLUDED.cache_hits,
+                            cache_misses = token_stats.cache_misses + EXCLUDED.cache_misses
+                    """, [(day, model, *totals) for (day, model), totals
+                          in sorted(token_stats.items(), key=lambda item: (item[0][0], item[0][1] or ''))],
+                        page_size=len(token_stats))
+
+                if daily_usage:
+                    psycopg2.extras.execute_values(cur, """
+                        INSERT INTO key_daily_usage (key_id, date, requests, tokens)
+                        VALUES %s
+                        ON CONFLICT (key_id, date)
+                        DO UPDATE SET
+                            requests = key_daily_usage.requests + EXCLUDED.requests,
+                            tokens = key_daily_usage.tokens + EXCLUDED.tokens
+                    """, [(key_id, day, requests, tokens) for (key_id, day), (requests, tokens)
+                          in sorted(daily_usage.items())],
+                        page_size=len(daily_usage))
+
+                if rollups:
+                    daily_rollups: Dict[Tuple[Any, str, str], List[int]] = {}
+                    for (hour, key_id, model), counters in rollups.items():
+                        daily = daily_rollups.setdefault((hour.date(), key_id, model), [0] * ROLLUP_FIELDS)
+                        for i, value in enumerate(counters):
+                            daily[i] += value
+                    for table, column, buckets in (('usage_rollup_hourly', 'bucket', rollups),
+                                                   ('usage_rollup_daily', 'date', daily_rollups)):
+                        psycopg2.extras.execute_values(cur, f"""
+                            INSERT INTO {table} ({column}, key_id, model, requests, errors, prompt_tokens,
+                                                 completion_tokens, total_tokens, duration_ms_sum, duration_buckets)
+                            VALUES %s
+                            ON CONFLICT ({column}, key_id, model)
+                            DO UPDATE SET
+                                requests = {table}.requests + EXCLUDED.requests,
+                                errors = {table}.errors + EXCLUDED.errors,
+                                prompt_tokens = {table}.prompt_tokens + EXCLUDED.prompt_tokens,
+                                completion_tokens = {table}.completion_tokens + EXCLUDED.completion_tokens,
+                                total_tokens = {table}.total_tokens + EXCLUDED.total_tokens,
+                                duration_ms_sum = {table}.duration_ms_sum + EXCLUDED.duration_ms_sum,
+                                duration_buckets = ARRAY(
+                                    SELECT a + b
+                                    FROM unnest({table}.duration_buckets, EXCLUDED.duration_buckets) AS h(a, b)
+                                )
+                        """, [(*rollup_key, *counters[:6], counters[6:]) for rollup_key, counters
+                              in sorted(buckets.items())],
+                            template='(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s::integer[])',
+                            page_size=len(buckets))
+
+                if history:
+                    psycopg2.extras.execute_values(cur, """
+                        INSERT INTO request_history
+                        (timestamp, endpoint, method, model, prompt_tokens, completion_tokens,
+                         total_tokens, duration_ms, status_code, user_message, ai_response, cache_hit)
+                        VALUES %s
+                    """, history, page_size=len(history))
+
+                if logs:
+                    psycopg2.extras.execute_values(cur, """
+                        INSERT INTO api_logs (timestamp, level, method, endpoint, status_code, message, duration_ms)
+                        VALUES %s
+                    """, logs, page_size=len(logs))
+
+                if events:
+                    psycopg2.extras.execute_values(cur, """
+                        WITH new_events AS (
+                            INSERT INTO webhook_events (created_at, event_type, payload)
+                            SELECT v.created_at, v.event_type, v.payload
+                            FROM (VALUES %s) AS v(created_at, event_type, payload)
+                            WHERE EXISTS (
+                                SELECT 1 FROM webhooks w WHERE w.is_enabled AND v.event_type = ANY(w.events)
+                            )
+                            RETURNING id, event_type
+                        )
+                        INSERT INTO webhook_deliveries (webhook_id, event_id, next_attempt_at)
+                        SELECT w.id, e.id,
+                               GREATEST(
+                                   CASE WHEN w.batch_size IS NULL THEN CURRENT_TIMESTAMP
+                                        ELSE COALESCE(
+                                            (SELECT min(d.next_attempt_at) FROM webhook_deliveries d
+                                             WHERE d.webhook_id = w.id AND d.status = 'pending' AND d.attempts = 0
+                                               AND d.next_attempt_at > CURRENT_TIMESTAMP),
+                                            CURRENT_TIMESTAMP + w.batch_window_ms * INTERVAL '1 millisecond')
+                                   END,
+                                   w.circuit_open_until)
+                        FROM new_events e
+                        JOIN webhooks w ON w.is_enabled AND e.event_type = ANY(w.events)
+                    """, events, template='(%s, %s, %s::jsonb)', page_size=len(events))
+
+                    cur.execute("""
+                        WITH full_batches AS (
+                            SELECT d.webhook_id
+                            FROM webhook_deliveries d
+                            JOIN webhooks w ON w.id = d.webhook_id
+                            WHERE w.batch_size IS NOT NULL AND d.status = 'pending' AND d.attempts = 0
+                              AND d.next_attempt_at > CURRENT_TIMESTAMP
+                              AND (w.circuit_open_until IS NULL OR w.circuit_open_until <= CURRENT_TIMESTAMP)
+                            GROUP BY d.webhook_id, w.batch_size
+                            HAVING count(*) >= w.batch_size
+                        )
+                        UPDATE webhook_deliveries d
+                        SET next_attempt_at = CURRENT_TIMESTAMP
+                        FROM full_batches f
+                        WHERE d.webhook_id = f.webhook_id AND d.status = 'pending' AND d.attempts = 0
+                          AND d.next_attempt_at > CURRENT_TIMESTAMP
+                    """)
+
+            conn.commit()
+        finally:
+            pool.putconn(conn)
+
+    def _merge(self, key_usage: Dict[str, List[Any]], token_stats: Dict[Tuple[Any, str], List[int]],
+               daily_usage: Dict[Tuple[str, Any], List[int]], rollups: Dict[Tuple[Any, str, str], List[int]],
+               history: List[Tuple[Any, ...]], logs: List[Tuple[Any, ...]],
+               events: List[Tuple[Any, ...]]) -> None:
+        for key_id, (count, used_at) in key_usage.items():
+            usage = self._key_usage.setdefault(key_id, [0, used_at])
+            usage[0] += count
+            usage[1] = max(usage[1], used_at)
+        for stats_key, totals in token_stats.items():
+            stats = self._token_stats.setdefault(stats_key, [0, 0, 0, 0, 0, 0])
+            for i, value in enumerate(totals):
+                stats[i] += value
+        for usage_key, (requests, tokens) in daily_usage.items():
+            usage = self._daily_usage.setdefault(usage_key, [0, 0])
+            usage[0] += requests
+            usage[1] += tokens
+        for rollup_key, counters in rollups.items():
+            rollup = self._rollups.setdefault(rollup_key, [0] * ROLLUP_FIELDS)
+            for i, value in enumerate(counters):
+                rollup[i] += value
+        self._history[:0] = history
+        self._logs[:0] = logs
+        self._events[:0] = events
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+    def _touch(self, database_url: str) -> None:
+        self._database_url = database_url
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._run_flusher, daemon=True)
+            self._flusher.start()
+
+    def _roll_up(self, now: datetime, key_id: str, model: str, error: bool, prompt_tokens: int,
+                 completion_tokens: int, total_tokens: int, duration_ms: int) -> None:
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        rollup = self._rollups.setdefault((hour, key_id, model or ''), [0] * ROLLUP_FIELDS)
+        rollup[0] += 1
+        rollup[1] += error
+        rollup[2] += prompt_tokens
+        rollup[3] += completion_tokens
+        rollup[4] += total_tokens
+        rollup[5] += duration_ms
+        rollup[6 + bisect.bisect_left(ROLLUP_DURATION_BOUNDS_MS, duration_ms)] += 1
+
+    def _run_flusher(self) -> None:
+        while True:
+            self._wake.wait(ACCOUNTING_FLUSH_INTERVAL)
+            self._wake.clear()
+            if self._flush_due():
+                self._try_flush()
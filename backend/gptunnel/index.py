@@ -1,174 +1,119 @@
-import json
-import os
-import requests
-from typing import Dict, Any
-from datetime import datetime
-import psycopg2
+import time
+from typing import Dict, Any, Callable, List
+from accounting import UsageBuffer
+from balancer import NoUpstreamError, UPSTREAM_READ_TIMEOUT, fetch, post
+from runtime import Router, error_response, get_pool, json_response, loads, parse_body, requests, setting
+from sse import iter_sse
+from timing import instrument, phase
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
-    '''
-    Business: GPTunnel API proxy for AI model completions
-    Args: event with httpMethod, body (model, messages, temperature)
-    Returns: HTTP response with AI completion
-    '''
-    method: str = event.get('httpMethod', 'POST')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Api-Key',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
-    
-    gptunnel_key = os.environ.get('GPTUNNEL_API_KEY')
+GPTUNNEL_ENDPOINT = '/api/gptunnel/complete'
+
+usage_buffer = UsageBuffer(get_pool)
+
+
+def save_usage(model: str, messages: List[Dict[str, Any]], usage: Dict[str, Any], ai_content: str,
+               duration_ms: int) -> None:
+    '''Queue a finished completion for request_history, token_stats and the usage rollups'''
+    database_url = setting('DATABASE_URL')
+    if database_url:
+        usage_buffer.record_completion(database_url, '', GPTUNNEL_ENDPOINT, model or '',
+                                       usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0),
+                                       usage.get('total_tokens', 0), duration_ms,
+                                       messages[-1].get('content', '') if messages else '', ai_content[:1000])
+
+
+def stream_recorder(model: str, messages: List[Dict[str, Any]],
+                    start_time: float) -> Callable[[Dict[str, Any], str], None]:
+    '''Completion callback for iter_sse that records usage once the stream ends'''
+    def record_stream(usage: Dict[str, Any], ai_content: str) -> None:
+        with phase('accounting'):
+            save_usage(model, messages, usage, ai_content, int((time.monotonic() - start_time) * 1000))
+    return record_stream
+
+
+def complete(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    gptunnel_key = setting('GPTUNNEL_API_KEY')
     if not gptunnel_key:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'GPTunnel API key not configured'}),
-            'isBase64Encoded': False
-        }
-    
-    body_data = json.loads(event.get('body', '{}'))
+        return error_response(500, 'GPTunnel API key not configured')
+
+    body_data = parse_body(event)
     model = body_data.get('model', 'gpt-4')
     messages = body_data.get('messages', [])
     temperature = body_data.get('temperature', 0.7)
     max_tokens = body_data.get('max_tokens', 1000)
-    
+
     if not messages:
-        return {
-            'statusCode': 400,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Messages array is required'}),
-            'isBase64Encoded': False
-        }
-    
+        return error_response(400, 'Messages array is required')
+
+    stream = bool(body_data.get('stream', False))
+    payload = {
+        'model': model,
+        'messages': messages,
+        'temperature': temperature,
+        'max_tokens': max_tokens
+    }
+    if stream:
+        payload['stream'] = True
+        payload['stream_options'] = {'include_usage': True}
+
+    start_time = time.monotonic()
     try:
-        response = requests.post(
-            'https://gptunnel.ru/v1/chat/completions',
-            headers={
-                'Authorization': f'Bearer {gptunnel_key}',
-                'Content-Type': 'application/json'
-            },
-            json={
-                'model': model,
-                'messages': messages,
-                'temperature': temperature,
-                'max_tokens': max_tokens
-            },
-            timeout=30
-        )
-        
-        if response.status_code != 200:
+        with phase('upstream'):
+            if stream:
+                response = post(gptunnel_key, payload, stream=True)[1]
+                status_code = response.status_code
+            else:
+                status_code, response_text = fetch(gptunnel_key, payload)
+
+        if status_code != 200:
+            return error_response(status_code, 'GPTunnel API error', details=response.text if stream else response_text)
+
+        if stream:
+            events = iter_sse(response, stream_recorder(model, messages, start_time))
             return {
-                'statusCode': response.status_code,
+                'statusCode': 200,
                 'headers': {
-                    'Content-Type': 'application/json',
+                    'Content-Type': 'text/event-stream',
+                    'Cache-Control': 'no-cache',
                     'Access-Control-Allow-Origin': '*'
                 },
-                'body': json.dumps({
-                    'error': 'GPTunnel API error',
-                    'details': response.text
-                }),
+                'body': events if event.get('supportsStreaming') else ''.join(events),
                 'isBase64Encoded': False
             }
-        
-        result = response.json()
-        
+
+        with phase('parse'):
+            result = loads(response_text)
+
         usage = result.get('usage', {})
-        prompt_tokens = usage.get('prompt_tokens', 0)
-        completion_tokens = usage.get('completion_tokens', 0)
-        total_tokens = usage.get('total_tokens', 0)
         ai_content = result.get('choices', [{}])[0].get('message', {}).get('content', '')
-        
-        database_url = os.environ.get('DATABASE_URL')
-        if database_url:
-            try:
-                conn = psycopg2.connect(database_url)
-                with conn.cursor() as cur:
-                    cur.execute("""
-                        INSERT INTO request_history 
-                        (endpoint, method, model, prompt_tokens, completion_tokens, total_tokens, 
-                         status_code, user_message, ai_response)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """, ('/api/gptunnel/complete', 'POST', model, prompt_tokens, 
-                          completion_tokens, total_tokens, 200, 
-                          messages[-1].get('content', '') if messages else '',
-                          ai_content[:1000]))
-                    
-                    cur.execute("""
-                        INSERT INTO token_stats (date, model, total_requests, total_tokens, 
-                                                prompt_tokens, completion_tokens)
-                        VALUES (CURRENT_DATE, %s, 1, %s, %s, %s)
-                        ON CONFLICT (date, model) 
-                        DO UPDATE SET 
-                            total_requests = token_stats.total_requests + 1,
-                            total_tokens = token_stats.total_tokens + %s,
-                            prompt_tokens = token_stats.prompt_tokens + %s,
-                            completion_tokens = token_stats.completion_tokens + %s
-                    """, (model, total_tokens, prompt_tokens, completion_tokens,
-                          total_tokens, prompt_tokens, completion_tokens))
-                    
-                    conn.commit()
-                conn.close()
-            except Exception:
-                pass
-        
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({
-                'model': result.get('model', model),
-                'content': ai_content,
-                'usage': usage,
-                'finish_reason': result.get('choices', [{}])[0].get('finish_reason', 'stop')
-            }),
-            'isBase64Encoded': False
-        }
-    
+
+        with phase('accounting'):
+            save_usage(model, messages, usage, ai_content, int((time.monotonic() - start_time) * 1000))
+
+        return json_response(200, {
+            'model': result.get('model', model),
+            'content': ai_content,
+            'usage': usage,
+            'finish_reason': result.get('choices', [{}])[0].get('finish_reason', 'stop')
+        })
+
+    except NoUpstreamError as e:
+        return error_response(400, 'Unsupported model', message=str(e))
     except requests.exceptions.Timeout:
-        return {
-            'statusCode': 504,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Request timeout', 'message': 'GPTunnel API timeout after 30s'}),
-            'isBase64Encoded': False
-        }
+        return error_response(504, 'Request timeout', message=f'GPTunnel API timeout after {UPSTREAM_READ_TIMEOUT:g}s')
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Internal error', 'message': str(e)}),
-            'isBase64Encoded': False
-        }
\ No newline at end of file
+        return error_response(500, 'Internal error', message=str(e))
+
+
+router = Router({'POST': complete}, allow_headers='Content-Type, X-Api-Key', default_method='POST')
+
+
+@instrument('gptunnel')
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: GPTunnel API proxy for AI model completions
+    Args: event with httpMethod, body (model, messages, temperature, stream);
+          supportsStreaming is set by hosts that can send an iterator body
+    Returns: HTTP response with AI completion or SSE stream
+    '''
+    return router(event, context)
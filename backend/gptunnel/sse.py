@@ -0,0 +1,90 @@
+from typing import Dict, Any, AsyncIterator, Callable, Iterator
+from runtime import dumps, httpx, loads, requests
+
+STREAM_CONTENT_LIMIT = 1000
+STREAM_CHARS_PER_TOKEN = 4
+
+
+class _StreamUsage:
+    '''Usage from the final chunk and the first STREAM_CONTENT_LIMIT characters of content of an SSE stream'''
+
+    def __init__(self):
+        self.usage: Dict[str, Any] = {}
+        self._parts = []
+        self._length = 0
+        self._streamed = 0
+
+    def feed(self, line: str) -> None:
+        if not line.startswith('data:'):
+            return
+        data = line[5:].strip()
+        if not data or data == '[DONE]':
+            return
+        try:
+            chunk = loads(data)
+        except ValueError:
+            chunk = {}
+        if chunk.get('usage'):
+            self.usage = chunk['usage']
+        for choice in chunk.get('choices') or []:
+            delta = (choice.get('delta') or {}).get('content') or ''
+            self._streamed += len(delta)
+            if delta and self._length < STREAM_CONTENT_LIMIT:
+                delta = delta[:STREAM_CONTENT_LIMIT - self._length]
+                self._parts.append(delta)
+                self._length += len(delta)
+
+    def content(self) -> str:
+        return ''.join(self._parts)
+
+    def usage_so_far(self) -> Dict[str, Any]:
+        '''
+        The upstream's usage when the stream carried it, otherwise completion
+        tokens estimated from the content streamed before it was cut short
+        '''
+        if self.usage:
+            return self.usage
+        completion_tokens = -(-self._streamed // STREAM_CHARS_PER_TOKEN)
+        return {'prompt_tokens': 0, 'completion_tokens': completion_tokens, 'total_tokens': completion_tokens,
+                'estimated': True}
+
+
+def _interrupted(error: Exception) -> str:
+    return f"event: error\ndata: {dumps({'error': 'GPTunnel stream interrupted', 'message': str(error)})}\n\n"
+
+
+def iter_sse(response: Any,
+             on_complete: Callable[[Dict[str, Any], str], None]) -> Iterator[str]:
+    '''
+    Forward an upstream SSE stream line by line without holding it in memory.
+    Usage from the final chunk and the first STREAM_CONTENT_LIMIT characters
+    of content are collected on the way and passed to on_complete when the
+    stream ends, also when the upstream or the client cut it short; a stream
+    that ended before its usage frame is billed by usage_so_far()'s estimate.
+    '''
+    seen = _StreamUsage()
+    try:
+        for raw_line in response.iter_lines():
+            line = raw_line.decode('utf-8')
+            seen.feed(line)
+            yield line + '\n'
+    except requests.exceptions.RequestException as e:
+        yield _interrupted(e)
+    finally:
+        response.close()
+        on_complete(seen.usage_so_far(), seen.content())
+
+
+async def iter_sse_async(response: Any,
+                         on_complete: Callable[[Dict[str, Any], str], None]) -> AsyncIterator[str]:
+    '''iter_sse() for a streamed httpx response'''
+    seen = _StreamUsage()
+    try:
+        async for line in response.aiter_lines():
+            seen.feed(line)
+            yield line + '\n'
+    except httpx.HTTPError as e:
+        yield _interrupted(e)
+    finally:
+        await response.aclose()
+        on_complete(seen.usage_so_far(), seen.content())
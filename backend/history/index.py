@@ -1,152 +1,442 @@
-import json
-import os
-from typing import Dict, Any
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import base64
+import html
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+from runtime import Router, connection, error_response, json_response, psycopg2, query_params, setting
+from timing import instrument
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+HISTORY_DEFAULT_LIMIT = 50
+HISTORY_MAX_LIMIT = 200
+PREVIEW_LENGTH = 200
+ROLLUP_DURATION_BOUNDS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+ROLLUP_DIMENSIONS = ('model', 'key_id')
+SEARCH_MODES = ('fts', 'substring')
+SEARCH_MIN_SUBSTRING = 3
+SNIPPET_CONTEXT = 80
+STATS_MAX_DAYS = 366
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_STOP = '\x03'
+
+
+def encode_cursor(timestamp: datetime, row_id: int) -> str:
+    '''Opaque keyset cursor pointing just past (timestamp, id)'''
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{row_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    timestamp, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(timestamp), int(row_id)
+
+
+def encode_search_cursor(rank: float, row_id: int) -> str:
+    '''Opaque keyset cursor pointing just past (rank, id) in ranked search results'''
+    return base64.urlsafe_b64encode(f"{rank!r}|{row_id}".encode()).decode()
+
+
+def decode_search_cursor(cursor: str) -> Tuple[float, int]:
+    rank, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return float(rank), int(row_id)
+
+
+def history_filters(params: Dict[str, Any], include_cursor: bool = True) -> Tuple[List[str], List[Any]]:
     '''
-    Business: Get request history and token usage statistics
-    Args: event with httpMethod, queryStringParameters (action, limit)
-    Returns: HTTP response with history or stats data
+    Build WHERE conditions for the history query from model, status, endpoint,
+    from/to (ISO timestamps) and cursor. Every time bound is also a plain
+    timestamp comparison so the planner can prune daily partitions.
+    Raises ValueError on malformed input.
     '''
-    method: str = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
+    conditions: List[str] = []
+    args: List[Any] = []
+    if params.get('model'):
+        conditions.append('model = %s')
+        args.append(params['model'])
+    if params.get('status'):
+        conditions.append('status_code = %s')
+        args.append(int(params['status']))
+    if params.get('endpoint'):
+        conditions.append('endpoint = %s')
+        args.append(params['endpoint'])
+    if params.get('from'):
+        conditions.append('timestamp >= %s')
+        args.append(datetime.fromisoformat(params['from']))
+    if params.get('to'):
+        conditions.append('timestamp < %s')
+        args.append(datetime.fromisoformat(params['to']))
+    if include_cursor and params.get('cursor'):
+        cursor_timestamp, cursor_id = decode_cursor(params['cursor'])
+        conditions.append('timestamp <= %s AND (timestamp, id) < (%s, %s)')
+        args.extend((cursor_timestamp, cursor_timestamp, cursor_id))
+    return conditions, args
+
+
+def histogram_percentile(buckets: List[int], quantile: float) -> Optional[int]:
+    '''Estimate a duration percentile in ms by interpolating inside the histogram bucket'''
+    total = sum(buckets)
+    if not total:
+        return None
+    rank = quantile * total
+    seen = 0
+    for i, count in enumerate(buckets):
+        if count and seen + count >= rank:
+            lower = ROLLUP_DURATION_BOUNDS_MS[i - 1] if i > 0 else 0
+            if i == len(ROLLUP_DURATION_BOUNDS_MS):
+                return lower
+            return round(lower + (ROLLUP_DURATION_BOUNDS_MS[i] - lower) * (rank - seen) / count)
+        seen += count
+    return ROLLUP_DURATION_BOUNDS_MS[-1]
+
+
+def latency_summary(buckets: List[int]) -> Dict[str, Optional[int]]:
+    return {
+        'p50': histogram_percentile(buckets, 0.5),
+        'p95': histogram_percentile(buckets, 0.95),
+        'p99': histogram_percentile(buckets, 0.99)
+    }
+
+
+def rollup_summary(cur: Any, dimension: str, since: Any, until: Any) -> Dict[str, Dict[str, Any]]:
+    '''Requests, errors, tokens and merged duration histogram per model or key from usage_rollup_daily'''
+    if dimension not in ROLLUP_DIMENSIONS:
+        raise ValueError(dimension)
+    cur.execute(f"""
+        SELECT {dimension} AS name,
+               SUM(requests)::bigint AS requests,
+               SUM(errors)::bigint AS errors,
+               SUM(total_tokens)::bigint AS total_tokens
+        FROM usage_rollup_daily
+        WHERE date >= %s AND date < %s
+        GROUP BY {dimension}
+    """, (since, until))
+    summary = {
+        row['name']: {
+            'requests': row['requests'],
+            'errors': row['errors'],
+            'totalTokens': row['total_tokens'],
+            'buckets': [0] * (len(ROLLUP_DURATION_BOUNDS_MS) + 1)
         }
-    
-    if method != 'GET':
-        return {
-            'statusCode': 405,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
+        for row in cur.fetchall()
+    }
+    cur.execute(f"""
+        SELECT r.{dimension} AS name, h.idx, SUM(h.count)::bigint AS count
+        FROM usage_rollup_daily r, unnest(r.duration_buckets) WITH ORDINALITY AS h(count, idx)
+        WHERE r.date >= %s AND r.date < %s
+        GROUP BY r.{dimension}, h.idx
+    """, (since, until))
+    for row in cur.fetchall():
+        if row['name'] in summary and row['idx'] <= len(ROLLUP_DURATION_BOUNDS_MS) + 1:
+            summary[row['name']]['buckets'][row['idx'] - 1] = row['count']
+    return summary
+
+
+def highlight(snippet: Optional[str]) -> str:
+    '''HTML-escape a snippet and turn the highlight sentinels into <mark> tags'''
+    return html.escape(snippet or '').replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_STOP, '</mark>')
+
+
+def substring_snippet(text: Optional[str], needle: str) -> str:
+    if not text:
+        return ''
+    position = text.lower().find(needle.lower())
+    if position < 0:
+        return highlight(text[:SNIPPET_CONTEXT * 2])
+    start = max(position - SNIPPET_CONTEXT, 0)
+    end = position + len(needle)
+    return highlight(
+        ('…' if start else '') + text[start:position] + HIGHLIGHT_START + text[position:end] + HIGHLIGHT_STOP
+        + text[end:end + SNIPPET_CONTEXT] + ('…' if end + SNIPPET_CONTEXT < len(text) else '')
+    )
+
+
+def search_history(cur: Any, query: str, mode: str, conditions: List[str], args: List[Any],
+                   cursor: Optional[str], limit: int) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    '''
+    Search prompts and responses. fts ranks every match of the GIN-indexed
+    search_vector, however old, and pages through them by (rank, id); narrow
+    broad queries with from/to, which prune partitions before ranking.
+    substring is an ILIKE served by the trigram indexes and pages by (timestamp, id).
+    Snippets are built for the returned page only.
+    '''
+    if mode == 'substring':
+        pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        where = ' AND '.join(conditions + ['(user_message ILIKE %s OR ai_response ILIKE %s)'])
+        cur.execute(f"""
+            SELECT id, timestamp, endpoint, model, status_code, NULL AS rank,
+                   left(user_message, 2000) AS user_snippet,
+                   left(ai_response, 2000) AS ai_snippet
+            FROM request_history
+            WHERE {where}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT %s
+        """, (*args, pattern, pattern, limit + 1))
+        rows = cur.fetchall()
+        for row in rows:
+            row['user_snippet'] = substring_snippet(row['user_snippet'], query)
+            row['ai_snippet'] = substring_snippet(row['ai_snippet'], query)
+    else:
+        where = ' AND '.join(conditions + ['search_vector @@ query'])
+        page_condition = ''
+        page_args: Tuple[Any, ...] = ()
+        if cursor:
+            page_condition = 'WHERE (m.rank, m.id) < (%s::real, %s)'
+            page_args = decode_search_cursor(cursor)
+        headline_options = (f'MaxFragments=2, MaxWords=20, MinWords=5, FragmentDelimiter=" … ", '
+                            f'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}')
+        cur.execute(f"""
+            WITH matches AS (
+                SELECT id, timestamp, ts_rank(search_vector, query) AS rank
+                FROM request_history, websearch_to_tsquery('simple', %s) AS query
+                WHERE {where}
+            ),
+            page AS (
+                SELECT m.id, m.timestamp, m.rank
+                FROM matches m
+                {page_condition}
+                ORDER BY m.rank DESC, m.id DESC
+                LIMIT %s
+            )
+            SELECT h.id, h.timestamp, h.endpoint, h.model, h.status_code, p.rank,
+                   ts_headline('simple', left(h.user_message, 2000), websearch_to_tsquery('simple', %s), %s)
+                       AS user_snippet,
+                   ts_headline('simple', left(h.ai_response, 2000), websearch_to_tsquery('simple', %s), %s)
+                       AS ai_snippet
+            FROM page p
+            JOIN request_history h ON h.id = p.id AND h.timestamp = p.timestamp
+            ORDER BY p.rank DESC, p.id DESC
+        """, (query, *args, *page_args, limit + 1,
+              query, headline_options, query, headline_options))
+        rows = cur.fetchall()
+        for row in rows:
+            row['user_snippet'] = highlight(row['user_snippet'])
+            row['ai_snippet'] = highlight(row['ai_snippet'])
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        if mode == 'substring':
+            next_cursor = encode_cursor(last['timestamp'], last['id'])
+        else:
+            next_cursor = encode_search_cursor(last['rank'], last['id'])
+
+    results = [{
+        'id': row['id'],
+        'timestamp': row['timestamp'].isoformat(),
+        'endpoint': row['endpoint'],
+        'model': row['model'],
+        'status': row['status_code'],
+        'rank': row['rank'],
+        'userMessage': row['user_snippet'],
+        'aiResponse': row['ai_snippet']
+    } for row in rows]
+    return results, next_cursor
+
+
+def stats_window(params: Dict[str, Any], days: int) -> Tuple[datetime, datetime, bool]:
+    '''
+    Stats range [start, end) from the from/to ISO timestamps, defaulting to the
+    last `days` days up to now. The flag tells whether from or to was given.
+    Raises ValueError on malformed, reversed or over-long ranges.
+    '''
+    start = datetime.fromisoformat(params['from']) if params.get('from') else None
+    end = datetime.fromisoformat(params['to']) if params.get('to') else datetime.now(start and start.tzinfo)
+    start = start or end - timedelta(days=days)
+    try:
+        if not start < end <= start + timedelta(days=STATS_MAX_DAYS):
+            raise ValueError(params.get('from'), params.get('to'))
+    except TypeError:
+        raise ValueError('from and to must both carry a UTC offset or neither')
+    return start, end, bool(params.get('from') or params.get('to'))
+
+
+def stats_payload(cur: Any, start: datetime, end: datetime, explicit: bool) -> Dict[str, Any]:
+    '''
+    Token, cache, error and latency statistics for the stats action over [start, end).
+    Daily tables count every day overlapping the range. Without an explicit
+    range the daily series covers the last 7 days and the hourly one the last 24 hours.
+    '''
+    daily_start = start if explicit else end - timedelta(days=7)
+    hourly_start = start if explicit else end - timedelta(hours=23)
+    cur.execute("""
+        SELECT 
+            model,
+            SUM(total_requests) as total_requests,
+            SUM(total_tokens) as total_tokens,
+            SUM(prompt_tokens) as prompt_tokens,
+            SUM(completion_tokens) as completion_tokens,
+            SUM(cache_hits) as cache_hits,
+            SUM(cache_misses) as cache_misses
+        FROM token_stats
+        WHERE date >= %s AND date < %s
+        GROUP BY model
+        ORDER BY total_tokens DESC
+    """, (start.date(), end))
+    stats = cur.fetchall()
+
+    cur.execute("""
+        SELECT 
+            date,
+            SUM(total_tokens) as tokens
+        FROM token_stats
+        WHERE date >= %s AND date < %s
+        GROUP BY date
+        ORDER BY date ASC
+    """, (daily_start.date(), end))
+    daily = cur.fetchall()
+
+    by_model = rollup_summary(cur, 'model', start.date(), end)
+    by_key = rollup_summary(cur, 'key_id', start.date(), end)
+
+    cur.execute("""
+        SELECT
+            bucket,
+            SUM(requests)::bigint as requests,
+            SUM(errors)::bigint as errors,
+            SUM(total_tokens)::bigint as tokens
+        FROM usage_rollup_hourly
+        WHERE bucket >= date_trunc('hour', %s::timestamp) AND bucket < %s
+        GROUP BY bucket
+        ORDER BY bucket ASC
+    """, (hourly_start, end))
+    hourly = cur.fetchall()
+
+    models = []
+    for s in stats:
+        model_stats = dict(s)
+        rollup = by_model.get(s['model'] or '')
+        if rollup:
+            model_stats['errors'] = rollup['errors']
+            model_stats['errorRate'] = round(rollup['errors'] / rollup['requests'] * 100, 2) if rollup['requests'] else 0
+            model_stats['latency'] = latency_summary(rollup['buckets'])
+        models.append(model_stats)
+
+    overall_buckets = [sum(counts) for counts in zip(*(m['buckets'] for m in by_model.values()))]
+    total_requests = sum(m['requests'] for m in by_model.values())
+    total_errors = sum(m['errors'] for m in by_model.values())
+
+    cache_hits = sum(s['cache_hits'] or 0 for s in stats)
+    cache_misses = sum(s['cache_misses'] or 0 for s in stats)
+    cache_lookups = cache_hits + cache_misses
+
+    return {
+        'range': {'from': start.isoformat(), 'to': end.isoformat()},
+        'models': models,
+        'daily': [{'date': d['date'].isoformat(), 'tokens': d['tokens']} for d in daily],
+        'hourly': [{'hour': h['bucket'].isoformat(), 'requests': h['requests'],
+                    'errors': h['errors'], 'tokens': h['tokens']} for h in hourly],
+        'keys': sorted(({
+            'keyId': key_id or None,
+            'requests': k['requests'],
+            'errors': k['errors'],
+            'totalTokens': k['totalTokens'],
+            'latency': latency_summary(k['buckets'])
+        } for key_id, k in by_key.items()), key=lambda k: k['requests'], reverse=True),
+        'latency': latency_summary(overall_buckets),
+        'errorRate': round(total_errors / total_requests * 100, 2) if total_requests else 0,
+        'cache': {
+            'hits': cache_hits,
+            'misses': cache_misses,
+            'hitRate': round(cache_hits / cache_lookups * 100, 1) if cache_lookups > 0 else 0
         }
-    
-    database_url = os.environ.get('DATABASE_URL')
-    if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
+    }
+
+
+def history_page(cur: Any, conditions: List[str], args: List[Any], limit: int) -> Dict[str, Any]:
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    cur.execute(f"""
+        SELECT 
+            id,
+            timestamp,
+            endpoint,
+            method,
+            model,
+            prompt_tokens,
+            completion_tokens,
+            total_tokens,
+            duration_ms,
+            status_code,
+            left(user_message, %s) AS user_message,
+            left(ai_response, %s) AS ai_response,
+            error_message
+        FROM request_history
+        {where}
+        ORDER BY timestamp DESC, id DESC
+        LIMIT %s
+    """, (PREVIEW_LENGTH, PREVIEW_LENGTH, *args, limit + 1))
+    history = cur.fetchall()
+
+    next_cursor = None
+    if len(history) > limit:
+        history = history[:limit]
+        next_cursor = encode_cursor(history[-1]['timestamp'], history[-1]['id'])
+
+    result = []
+    for h in history:
+        result.append({
+            'id': h['id'],
+            'timestamp': h['timestamp'].isoformat() if h['timestamp'] else '',
+            'endpoint': h['endpoint'],
+            'method': h['method'],
+            'model': h['model'],
+            'tokens': {
+                'prompt': h['prompt_tokens'],
+                'completion': h['completion_tokens'],
+                'total': h['total_tokens']
             },
-            'body': json.dumps({'error': 'Database configuration missing'}),
-            'isBase64Encoded': False
-        }
-    
-    params = event.get('queryStringParameters', {})
+            'duration': h['duration_ms'],
+            'status': h['status_code'],
+            'userMessage': h['user_message'] or '',
+            'aiResponse': h['ai_response'] or '',
+            'error': h['error_message']
+        })
+
+    return {'history': result, 'nextCursor': next_cursor}
+
+
+def get_history(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    params = query_params(event)
     action = params.get('action', 'history')
-    limit = int(params.get('limit', '50'))
-    
-    conn = psycopg2.connect(database_url)
-    
+
     try:
+        limit = min(max(int(params.get('limit', HISTORY_DEFAULT_LIMIT)), 1), HISTORY_MAX_LIMIT)
+        days = min(max(int(params.get('days', '30')), 1), STATS_MAX_DAYS)
         if action == 'stats':
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute("""
-                    SELECT 
-                        model,
-                        SUM(total_requests) as total_requests,
-                        SUM(total_tokens) as total_tokens,
-                        SUM(prompt_tokens) as prompt_tokens,
-                        SUM(completion_tokens) as completion_tokens
-                    FROM token_stats
-                    WHERE date >= CURRENT_DATE - INTERVAL '30 days'
-                    GROUP BY model
-                    ORDER BY total_tokens DESC
-                """)
-                stats = cur.fetchall()
-                
-                cur.execute("""
-                    SELECT 
-                        date,
-                        SUM(total_tokens) as tokens
-                    FROM token_stats
-                    WHERE date >= CURRENT_DATE - INTERVAL '7 days'
-                    GROUP BY date
-                    ORDER BY date ASC
-                """)
-                daily = cur.fetchall()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({
-                        'models': [dict(s) for s in stats],
-                        'daily': [{'date': d['date'].isoformat(), 'tokens': d['tokens']} for d in daily]
-                    }),
-                    'isBase64Encoded': False
-                }
-        
-        else:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute("""
-                    SELECT 
-                        id,
-                        timestamp,
-                        endpoint,
-                        method,
-                        model,
-                        prompt_tokens,
-                        completion_tokens,
-                        total_tokens,
-                        duration_ms,
-                        status_code,
-                        user_message,
-                        ai_response,
-                        error_message
-                    FROM request_history
-                    ORDER BY timestamp DESC
-                    LIMIT %s
-                """, (limit,))
-                history = cur.fetchall()
-                
-                result = []
-                for h in history:
-                    result.append({
-                        'id': h['id'],
-                        'timestamp': h['timestamp'].isoformat() if h['timestamp'] else '',
-                        'endpoint': h['endpoint'],
-                        'method': h['method'],
-                        'model': h['model'],
-                        'tokens': {
-                            'prompt': h['prompt_tokens'],
-                            'completion': h['completion_tokens'],
-                            'total': h['total_tokens']
-                        },
-                        'duration': h['duration_ms'],
-                        'status': h['status_code'],
-                        'userMessage': h['user_message'][:200] if h['user_message'] else '',
-                        'aiResponse': h['ai_response'][:200] if h['ai_response'] else '',
-                        'error': h['error_message']
-                    })
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({'history': result}),
-                    'isBase64Encoded': False
-                }
-    
-    finally:
-        conn.close()
+            window = stats_window(params, days)
+        search_query = (params.get('q') or '').strip()
+        search_mode = params.get('mode', 'fts')
+        if action == 'search':
+            if search_mode not in SEARCH_MODES or not search_query:
+                raise ValueError(search_mode)
+            if search_mode == 'substring' and len(search_query) < SEARCH_MIN_SUBSTRING:
+                raise ValueError(search_query)
+            if search_mode == 'fts' and params.get('cursor'):
+                decode_search_cursor(params['cursor'])
+        conditions, args = history_filters(params, include_cursor=not (action == 'search' and search_mode == 'fts'))
+    except ValueError:
+        return error_response(400, 'Invalid limit, cursor, filter or search query')
+
+    with connection(setting('DATABASE_URL')) as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            if action == 'search':
+                results, next_cursor = search_history(cur, search_query, search_mode, conditions, args,
+                                                      params.get('cursor'), limit)
+                payload = {'results': results, 'nextCursor': next_cursor}
+            elif action == 'stats':
+                payload = stats_payload(cur, *window)
+            else:
+                payload = history_page(cur, conditions, args, limit)
+
+    return json_response(200, payload)
+
+
+router = Router({'GET': get_history}, database_required=True)
+
+
+@instrument('history')
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Get request history and token usage statistics
+    Args: event with httpMethod, queryStringParameters (action, limit, cursor,
+          model, status, endpoint, from, to; days or from/to for stats; q and mode for search)
+    Returns: HTTP response with history or stats data
+    '''
+    return router(event, context)
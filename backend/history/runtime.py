@@ -0,0 +1,300 @@
+import importlib
+import json
+import os
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+from typing import Dict, Any, AsyncIterator, Callable, Iterator, List, Optional, Tuple
+from timing import log_async_query, phase, timed_connection
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+DB_POOL_ENABLED = os.environ.get('DB_POOL_ENABLED', '1') == '1'
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_HEALTHCHECK_AFTER = float(os.environ.get('DB_HEALTHCHECK_AFTER', '30'))
+DB_ASYNC_POOL_SIZE = int(os.environ.get('DB_ASYNC_POOL_SIZE', '10'))
+JSON_CODEC = os.environ.get('JSON_CODEC', 'auto')
+PREFLIGHT_MAX_AGE = '86400'
+
+
+class LazyModule:
+    '''
+    Stand-in for a heavy module that is imported on first attribute access, so
+    preflights and validation errors never pay for it. Submodules the package
+    does not import itself are listed in submodules.
+    '''
+
+    def __init__(self, name: str, *submodules: str):
+        self._name = name
+        self._submodules = submodules
+        self._module: Any = None
+
+    def __getattr__(self, attr: str) -> Any:
+        module = self._module
+        if module is None:
+            for submodule in self._submodules:
+                importlib.import_module(submodule)
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+
+psycopg2 = LazyModule('psycopg2', 'psycopg2.extras', 'psycopg2.pool')
+requests = LazyModule('requests', 'requests.adapters')
+asyncio = LazyModule('asyncio')
+asyncpg = LazyModule('asyncpg')
+httpx = LazyModule('httpx')
+
+if orjson is not None and JSON_CODEC != 'json':
+    def dumps(obj: Any) -> str:
+        '''Serialize to compact UTF-8 JSON'''
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    loads = orjson.loads
+else:
+    def dumps(obj: Any) -> str:
+        '''Serialize to compact UTF-8 JSON'''
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+    loads = json.loads
+
+
+@lru_cache(maxsize=None)
+def setting(name: str, default: Optional[str] = None) -> Optional[str]:
+    '''Environment variable, read once per container'''
+    return os.environ.get(name, default)
+
+
+def query_params(event: Dict[str, Any]) -> Dict[str, str]:
+    return event.get('queryStringParameters') or {}
+
+
+def parse_body(event: Dict[str, Any]) -> Dict[str, Any]:
+    '''Decode the JSON request body; an empty body reads as {}'''
+    with phase('parse'):
+        return loads(event.get('body') or '{}')
+
+
+def json_response(status: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    with phase('serialize'):
+        body = dumps(payload)
+    response_headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+    if headers:
+        response_headers.update(headers)
+    return {'statusCode': status, 'headers': response_headers, 'body': body, 'isBase64Encoded': False}
+
+
+@lru_cache(maxsize=256)
+def _error_body(error: str) -> str:
+    return dumps({'error': error})
+
+
+def error_response(status: int, error: str, headers: Optional[Dict[str, str]] = None,
+                   **details: Any) -> Dict[str, Any]:
+    '''{"error": error, **details}; bodies without details are serialized once per error'''
+    response_headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+    if headers:
+        response_headers.update(headers)
+    body = dumps({'error': error, **details}) if details else _error_body(error)
+    return {'statusCode': status, 'headers': response_headers, 'body': body, 'isBase64Encoded': False}
+
+
+class Router:
+    '''
+    Dispatch an invocation to the view registered for its HTTP method.
+    CORS preflights, unsupported methods and, with database_required, a missing
+    DATABASE_URL are answered from responses built once, without touching the
+    database or heavy imports.
+    '''
+
+    def __init__(self, routes: Dict[str, Callable[[Dict[str, Any], Any], Dict[str, Any]]],
+                 allow_headers: str = 'Content-Type', default_method: str = 'GET',
+                 database_required: bool = False):
+        self.routes = routes
+        self.default_method = default_method
+        self.database_required = database_required
+        self._preflight = {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': ', '.join([*routes, 'OPTIONS']),
+                'Access-Control-Allow-Headers': allow_headers,
+                'Access-Control-Max-Age': PREFLIGHT_MAX_AGE
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+        self._not_allowed = error_response(405, 'Method not allowed')
+        self._database_missing = error_response(500, 'Database configuration missing')
+
+    def __call__(self, event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        static = self.static_response(event)
+        if static is not None:
+            return static
+        return self.routes[event.get('httpMethod') or self.default_method](event, context)
+
+    async def call_async(self, event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        '''__call__ for routes whose views are coroutines'''
+        static = self.static_response(event)
+        if static is not None:
+            return static
+        return await self.routes[event.get('httpMethod') or self.default_method](event, context)
+
+    def static_response(self, event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        '''A copy of the prebuilt response for the event, or None when its view has to answer'''
+        method = event.get('httpMethod') or self.default_method
+        if method not in self.routes:
+            static = self._preflight if method == 'OPTIONS' else self._not_allowed
+        elif self.database_required and not setting('DATABASE_URL'):
+            static = self._database_missing
+        else:
+            return None
+        return {**static, 'headers': dict(static['headers'])}
+
+
+class ConnectionPool:
+    '''
+    Bounded pool of warm psycopg2 connections that outlives a single invocation.
+    Idle connections are pinged before reuse, broken ones are replaced. With
+    keep_idle off every returned connection is closed, so each borrow connects
+    afresh; DB_POOL_ENABLED=0 does that to measure what the pool saves.
+    '''
+
+    def __init__(self, dsn: str, max_size: int, keep_idle: bool = True):
+        self.dsn = dsn
+        self.keep_idle = keep_idle
+        self._idle: List[Tuple[Any, float]] = []
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+
+    def getconn(self) -> Any:
+        with phase('connect'):
+            if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+                raise psycopg2.pool.PoolError('Database connection pool exhausted')
+            try:
+                while True:
+                    with self._lock:
+                        if not self._idle:
+                            break
+                        conn, idle_since = self._idle.pop()
+                    if self._is_healthy(conn, idle_since):
+                        return conn
+                    self._discard(conn)
+                return psycopg2.connect(self.dsn, connection_factory=timed_connection())
+            except Exception:
+                self._slots.release()
+                raise
+
+    def putconn(self, conn: Any) -> None:
+        idle = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        try:
+            if not conn.closed and conn.info.transaction_status != idle:
+                conn.rollback()
+        except psycopg2.Error:
+            pass
+        try:
+            if conn.closed or conn.info.transaction_status != idle or not self.keep_idle:
+                self._discard(conn)
+            else:
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def closeall(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def _is_healthy(self, conn: Any, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < DB_HEALTHCHECK_AFTER:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _discard(conn: Any) -> None:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(database_url: str) -> ConnectionPool:
+    '''Return the container-wide pool, creating it on first use'''
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.dsn != database_url:
+            if _pool is not None:
+                _pool.closeall()
+            _pool = ConnectionPool(database_url, DB_POOL_SIZE, DB_POOL_ENABLED)
+        return _pool
+
+
+@contextmanager
+def connection(database_url: str) -> Iterator[Any]:
+    '''Borrow a pooled connection for the duration of the block'''
+    pool = get_pool(database_url)
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
+_async_pools: 'weakref.WeakKeyDictionary[Any, Tuple[str, Any]]' = weakref.WeakKeyDictionary()
+
+
+async def _create_async_pool(database_url: str) -> Any:
+    async def init(conn: Any) -> None:
+        conn.add_query_logger(log_async_query)
+
+    return await asyncpg.create_pool(database_url, min_size=1, max_size=DB_ASYNC_POOL_SIZE, init=init)
+
+
+async def get_async_pool(database_url: str) -> Any:
+    '''
+    Return the asyncpg pool of the running event loop, creating it on first use.
+    A pool belongs to the loop it was made on, so every loop gets its own.
+    '''
+    loop = asyncio.get_running_loop()
+    entry = _async_pools.get(loop)
+    if entry is None or entry[0] != database_url:
+        if entry is not None and entry[1].done() and not entry[1].exception():
+            entry[1].result().terminate()
+        entry = _async_pools[loop] = (database_url, asyncio.ensure_future(_create_async_pool(database_url)))
+    try:
+        return await asyncio.shield(entry[1])
+    except Exception:
+        if _async_pools.get(loop) is entry:
+            del _async_pools[loop]
+        raise
+
+
+@asynccontextmanager
+async def async_connection(database_url: str) -> AsyncIterator[Any]:
+    '''Borrow a connection from the loop's asyncpg pool for the duration of the block'''
+    with phase('connect'):
+        pool = await get_async_pool(database_url)
+        conn = await pool.acquire(timeout=DB_POOL_TIMEOUT)
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
@@ -0,0 +1,386 @@
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Dict, Any, AsyncIterator, Callable, Iterator, List, Optional, Tuple
+
+REQUEST_LOG_ENABLED = os.environ.get('REQUEST_LOG_ENABLED', '1') == '1'
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '0') == '1'
+METRICS_DURATION_BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRIC_TYPES = (
+    ('api_requests_total', 'counter'),
+    ('api_request_duration_seconds', 'histogram'),
+    ('api_phase_duration_seconds', 'summary'),
+    ('api_db_queries_total', 'counter'),
+    ('api_db_query_duration_seconds_total', 'counter'),
+    ('api_buffer_flush_failures_total', 'counter'),
+    ('api_buffer_dropped_rows_total', 'counter')
+)
+
+_current: ContextVar[Optional['RequestTimer']] = ContextVar('request_timer', default=None)
+
+
+class RequestTimer:
+    '''Per-phase wall time and database statements of one invocation'''
+
+    def __init__(self, metrics: 'Metrics'):
+        self.metrics = metrics
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.queries = 0
+        self.query_ms = 0.0
+
+    def add(self, name: str, duration_ms: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + duration_ms
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self) -> str:
+        entries = [f'{name};dur={duration_ms:.1f}' for name, duration_ms in self.phases.items()]
+        if self.queries:
+            entries.append(f'db;dur={self.query_ms:.1f};desc="{self.queries} queries"')
+        entries.append(f'total;dur={self.elapsed_ms():.1f}')
+        return ', '.join(entries)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    '''Add the time spent in the block to the current invocation's phase name'''
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, (time.perf_counter() - started) * 1000)
+
+
+class Metrics:
+    '''Counters of one function, rendered in the Prometheus text format by render_metrics()'''
+
+    def __init__(self, function: str):
+        self.function = function
+        self._lock = threading.Lock()
+        self._requests: Dict[Tuple[str, int], int] = {}
+        self._duration_buckets = [0] * (len(METRICS_DURATION_BOUNDS) + 1)
+        self._duration_sum = 0.0
+        self._phases: Dict[str, List[float]] = {}
+        self._queries = 0
+        self._query_seconds = 0.0
+
+    def observe_request(self, method: str, status: int, timer: RequestTimer, duration_ms: float) -> None:
+        seconds = duration_ms / 1000
+        with self._lock:
+            key = (method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            bucket = next((i for i, bound in enumerate(METRICS_DURATION_BOUNDS) if seconds <= bound),
+                          len(METRICS_DURATION_BOUNDS))
+            self._duration_buckets[bucket] += 1
+            self._duration_sum += seconds
+            for name, phase_ms in timer.phases.items():
+                totals = self._phases.setdefault(name, [0.0, 0])
+                totals[0] += phase_ms / 1000
+                totals[1] += 1
+
+    def observe_query(self, seconds: float) -> None:
+        with self._lock:
+            self._queries += 1
+            self._query_seconds += seconds
+
+    def samples(self) -> Dict[str, List[str]]:
+        '''Sample lines of every family in METRIC_TYPES'''
+        label = f'function="{self.function}"'
+        with self._lock:
+            requests = [f'api_requests_total{{{label},method="{method}",status="{status}"}} {count}'
+                        for (method, status), count in sorted(self._requests.items())]
+            durations = []
+            cumulative = 0
+            for bound, count in zip(METRICS_DURATION_BOUNDS + ('+Inf',), self._duration_buckets):
+                cumulative += count
+                durations.append(f'api_request_duration_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+            durations.append(f'api_request_duration_seconds_sum{{{label}}} {self._duration_sum:.6f}')
+            durations.append(f'api_request_duration_seconds_count{{{label}}} {cumulative}')
+            phases = []
+            for name, (seconds, count) in sorted(self._phases.items()):
+                phases.append(f'api_phase_duration_seconds_sum{{{label},phase="{name}"}} {seconds:.6f}')
+                phases.append(f'api_phase_duration_seconds_count{{{label},phase="{name}"}} {count}')
+            return {
+                'api_requests_total': requests,
+                'api_request_duration_seconds': durations,
+                'api_phase_duration_seconds': phases,
+                'api_db_queries_total': [f'api_db_queries_total{{{label}}} {self._queries}'],
+                'api_db_query_duration_seconds_total': [
+                    f'api_db_query_duration_seconds_total{{{label}}} {self._query_seconds:.6f}']
+            }
+
+
+_metrics: Dict[str, Metrics] = {}
+_metrics_lock = threading.Lock()
+_flush_failures: Dict[str, int] = {}
+_dropped_rows: Dict[Tuple[str, str], int] = {}
+
+
+def metrics_for(function: str) -> Metrics:
+    '''
+    The process-wide metrics of a function. Statements sent outside an
+    invocation, by background flushers and listeners, count towards the first
+    function instrumented in the process.
+    '''
+    with _metrics_lock:
+        metrics = _metrics.get(function)
+        if metrics is None:
+            metrics = _metrics[function] = Metrics(function)
+        return metrics
+
+
+def report_flush_failure(buffer: str, error: BaseException) -> None:
+    '''
+    Log and count a failed background write: a write-behind buffer flush, whose
+    rows stay buffered, or a periodic sync or maintenance job, retried on its next run
+    '''
+    with _metrics_lock:
+        _flush_failures[buffer] = _flush_failures.get(buffer, 0) + 1
+    print(json.dumps({'type': 'flush_failed', 'buffer': buffer, 'error': str(error)}), flush=True)
+
+
+def report_dropped_rows(buffer: str, table: str, rows: int) -> None:
+    '''Log and count rows a full write-behind buffer had to give up after a failed write'''
+    with _metrics_lock:
+        _dropped_rows[(buffer, table)] = _dropped_rows.get((buffer, table), 0) + rows
+    print(json.dumps({'type': 'rows_dropped', 'buffer': buffer, 'table': table, 'rows': rows}), flush=True)
+
+
+def render_metrics() -> str:
+    '''Metrics of every function instrumented in the process in the Prometheus text format'''
+    with _metrics_lock:
+        families = [metrics.samples() for metrics in _metrics.values()]
+        families.append({
+            'api_buffer_flush_failures_total': [
+                f'api_buffer_flush_failures_total{{buffer="{buffer}"}} {count}'
+                for buffer, count in sorted(_flush_failures.items())],
+            'api_buffer_dropped_rows_total': [
+                f'api_buffer_dropped_rows_total{{buffer="{buffer}",table="{table}"}} {count}'
+                for (buffer, table), count in sorted(_dropped_rows.items())]
+        })
+    lines = []
+    for name, kind in METRIC_TYPES:
+        lines.append(f'# TYPE {name} {kind}')
+        for samples in families:
+            lines.extend(samples.get(name, ()))
+    return '\n'.join(lines) + '\n'
+
+
+_cursor_classes: Dict[type, type] = {}
+_cursor_classes_lock = threading.Lock()
+_connection_class: Optional[type] = None
+
+
+def _record_query(started: float) -> None:
+    _count_query(time.perf_counter() - started)
+
+
+def log_async_query(record: Any) -> None:
+    '''asyncpg query logger that counts and times statements like TimedConnection does'''
+    _count_query(record.elapsed)
+
+
+def _count_query(seconds: float) -> None:
+    timer = _current.get()
+    if timer is not None:
+        timer.queries += 1
+        timer.query_ms += seconds * 1000
+        timer.metrics.observe_query(seconds)
+    elif _metrics:
+        next(iter(_metrics.values())).observe_query(seconds)
+
+
+def _timed_cursor(factory: type) -> type:
+    with _cursor_classes_lock:
+        cursor_class = _cursor_classes.get(factory)
+        if cursor_class is None:
+            def execute(cursor: Any, query: Any, vars: Any = None) -> Any:
+                started = time.perf_counter()
+                try:
+                    return factory.execute(cursor, query, vars)
+                finally:
+                    _record_query(started)
+
+            def executemany(cursor: Any, query: Any, vars_list: Any) -> Any:
+                started = time.perf_counter()
+                try:
+                    return factory.executemany(cursor, query, vars_list)
+                finally:
+                    _record_query(started)
+
+            cursor_class = _cursor_classes[factory] = type(f'Timed{factory.__name__}', (factory,),
+                                                           {'execute': execute, 'executemany': executemany})
+        return cursor_class
+
+
+def timed_connection() -> type:
+    '''
+    Connection factory whose cursors count and time every statement they send.
+    Built on first use so psycopg2 is only imported once a handler needs the database.
+    '''
+    global _connection_class
+    if _connection_class is None:
+        import psycopg2.extensions
+
+        class TimedConnection(psycopg2.extensions.connection):
+            def cursor(self, *args: Any, **kwargs: Any) -> Any:
+                factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+                kwargs['cursor_factory'] = _timed_cursor(factory)
+                return super().cursor(*args, **kwargs)
+
+        _connection_class = TimedConnection
+    return _connection_class
+
+
+def _finish(timer: RequestTimer, event: Dict[str, Any], method: str, status: int) -> None:
+    duration_ms = timer.elapsed_ms()
+    timer.metrics.observe_request(method, status, timer, duration_ms)
+    if REQUEST_LOG_ENABLED:
+        print(json.dumps({
+            'type': 'request',
+            'function': timer.metrics.function,
+            'requestId': (event.get('requestContext') or {}).get('requestId'),
+            'method': method,
+            'status': status,
+            'durationMs': round(duration_ms, 1),
+            'phases': {name: round(phase_ms, 1) for name, phase_ms in timer.phases.items()},
+            'queries': timer.queries,
+            'queryMs': round(timer.query_ms, 1)
+        }), flush=True)
+
+
+def _timed_body(body: Iterator[str], timer: RequestTimer, event: Dict[str, Any],
+                method: str, status: int) -> Iterator[str]:
+    '''Attribute work done while a streamed body is produced to its invocation, then report it'''
+    chunks = iter(body)
+    try:
+        while True:
+            token = _current.set(timer)
+            started = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            finally:
+                timer.add('stream', (time.perf_counter() - started) * 1000)
+                _current.reset(token)
+            yield chunk
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+        _finish(timer, event, method, status)
+
+
+async def _timed_async_body(body: AsyncIterator[str], timer: RequestTimer, event: Dict[str, Any],
+                            method: str, status: int) -> AsyncIterator[str]:
+    '''_timed_body for bodies produced by an async handler'''
+    chunks = body.__aiter__()
+    try:
+        while True:
+            token = _current.set(timer)
+            started = time.perf_counter()
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                timer.add('stream', (time.perf_counter() - started) * 1000)
+                _current.reset(token)
+            yield chunk
+    finally:
+        aclose = getattr(chunks, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+        _finish(timer, event, method, status)
+
+
+def _metrics_response(event: Dict[str, Any], method: str) -> Optional[Dict[str, Any]]:
+    if (METRICS_ENABLED and method == 'GET'
+            and (event.get('queryStringParameters') or {}).get('action') == 'metrics'):
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'text/plain; version=0.0.4',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': render_metrics(),
+            'isBase64Encoded': False
+        }
+    return None
+
+
+def _report(response: Dict[str, Any], timer: RequestTimer, event: Dict[str, Any], method: str) -> Dict[str, Any]:
+    status = response.get('statusCode', 200)
+    headers = response.setdefault('headers', {})
+    headers['Server-Timing'] = timer.server_timing()
+    headers['Timing-Allow-Origin'] = '*'
+    headers.setdefault('Access-Control-Expose-Headers', 'Server-Timing')
+    body = response.get('body')
+    if body is None or isinstance(body, str):
+        _finish(timer, event, method, status)
+    elif hasattr(body, '__aiter__'):
+        response['body'] = _timed_async_body(body, timer, event, method, status)
+    else:
+        response['body'] = _timed_body(body, timer, event, method, status)
+    return response
+
+
+def instrument(function: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    '''
+    Wrap a handler so every invocation reports its phases and statements as a
+    Server-Timing header, a JSON log line and the function's metrics. With
+    METRICS_ENABLED=1, GET ?action=metrics returns the metrics of every function
+    in the process in Prometheus text format.
+    Coroutine handlers get a coroutine wrapper; their bodies may be async iterators.
+    '''
+    metrics = metrics_for(function)
+
+    def decorate(handler: Callable[..., Any]) -> Callable[..., Any]:
+        if inspect.iscoroutinefunction(handler):
+            @wraps(handler)
+            async def instrumented_async(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+                method = event.get('httpMethod', 'GET')
+                response = _metrics_response(event, method)
+                if response is not None:
+                    return response
+
+                timer = RequestTimer(metrics)
+                token = _current.set(timer)
+                try:
+                    response = await handler(event, context)
+                finally:
+                    _current.reset(token)
+                return _report(response, timer, event, method)
+
+            return instrumented_async
+
+        @wraps(handler)
+        def instrumented(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            method = event.get('httpMethod', 'GET')
+            response = _metrics_response(event, method)
+            if response is not None:
+                return response
+
+            timer = RequestTimer(metrics)
+            token = _current.set(timer)
+            try:
+                response = handler(event, context)
+            finally:
+                _current.reset(token)
+            return _report(response, timer, event, method)
+
+        return instrumented
+
+    return decorate
@@ -0,0 +1,203 @@
+import base64
+import csv
+import io
+import os
+from datetime import datetime
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+from runtime import Router, connection, dumps, error_response, get_pool, json_response, psycopg2, query_params, setting
+from timing import instrument
+
+LOGS_DEFAULT_LIMIT = 50
+LOGS_MAX_LIMIT = 500
+EXPORT_FETCH_SIZE = int(os.environ.get('LOGS_EXPORT_FETCH_SIZE', '2000'))
+EXPORT_BUFFERED_MAX_ROWS = int(os.environ.get('LOGS_EXPORT_BUFFERED_MAX_ROWS', '100000'))
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8'
+}
+LOG_COLUMNS = ('id', 'timestamp', 'level', 'method', 'endpoint', 'status_code', 'message', 'duration_ms')
+
+
+def encode_cursor(timestamp: datetime, row_id: int) -> str:
+    '''Opaque keyset cursor pointing just past (timestamp, id)'''
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{row_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    timestamp, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(timestamp), int(row_id)
+
+
+def log_filters(params: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    '''
+    Build the WHERE clause for api_logs from level, endpoint, status, from/to
+    (ISO timestamps) and cursor. Time bounds stay plain timestamp comparisons so
+    daily partitions are pruned. Raises ValueError on malformed input.
+    '''
+    conditions: List[str] = []
+    args: List[Any] = []
+    if params.get('level'):
+        conditions.append('level = %s')
+        args.append(params['level'])
+    if params.get('endpoint'):
+        conditions.append('endpoint = %s')
+        args.append(params['endpoint'])
+    if params.get('status'):
+        conditions.append('status_code = %s')
+        args.append(int(params['status']))
+    if params.get('from'):
+        conditions.append('timestamp >= %s')
+        args.append(datetime.fromisoformat(params['from']))
+    if params.get('to'):
+        conditions.append('timestamp < %s')
+        args.append(datetime.fromisoformat(params['to']))
+    if params.get('cursor'):
+        cursor_timestamp, cursor_id = decode_cursor(params['cursor'])
+        conditions.append('timestamp <= %s AND (timestamp, id) < (%s, %s)')
+        args.extend((cursor_timestamp, cursor_timestamp, cursor_id))
+    return (f"WHERE {' AND '.join(conditions)}" if conditions else ''), args
+
+
+def format_log(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'id': row['id'],
+        'timestamp': row['timestamp'].isoformat(),
+        'level': row['level'],
+        'method': row['method'],
+        'endpoint': row['endpoint'],
+        'status': row['status_code'],
+        'message': row['message'] or '',
+        'duration': row['duration_ms']
+    }
+
+
+def _batches(cur: Any, max_rows: Optional[int], outcome: Dict[str, Any]) -> Iterator[List[Dict[str, Any]]]:
+    '''Fetch EXPORT_FETCH_SIZE rows at a time, stopping at max_rows and noting in outcome if more matched'''
+    sent = 0
+    last = None
+    while True:
+        rows = cur.fetchmany(EXPORT_FETCH_SIZE)
+        if not rows:
+            return
+        if max_rows is not None and sent + len(rows) > max_rows:
+            rows = rows[:max_rows - sent]
+            last = rows[-1] if rows else last
+            outcome['truncated'] = True
+            outcome['nextCursor'] = encode_cursor(last['timestamp'], last['id']) if last else None
+            if rows:
+                yield rows
+            return
+        sent += len(rows)
+        last = rows[-1]
+        yield rows
+
+
+def iter_export(pool: Any, export_format: str, where: str, args: List[Any],
+                max_rows: Optional[int], outcome: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+    '''
+    Stream matching logs through a named server-side cursor, EXPORT_FETCH_SIZE
+    rows per round trip, so only one batch is held in memory at a time.
+    The pooled connection is held until the export is consumed or closed.
+    With max_rows one more row is read to tell whether the export was cut
+    short; if so outcome gets truncated and the nextCursor that continues
+    after the last row exported.
+    '''
+    outcome = {} if outcome is None else outcome
+    outcome['truncated'] = False
+    conn = pool.getconn()
+    try:
+        with conn.cursor(name='logs_export', cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.itersize = EXPORT_FETCH_SIZE
+            limit = 'LIMIT %s' if max_rows is not None else ''
+            cur.execute(f"""
+                SELECT {', '.join(LOG_COLUMNS)}
+                FROM api_logs
+                {where}
+                ORDER BY timestamp DESC, id DESC
+                {limit}
+            """, (*args, max_rows + 1) if max_rows is not None else tuple(args))
+
+            if export_format == 'csv':
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerow(LOG_COLUMNS)
+                yield buffer.getvalue()
+                for rows in _batches(cur, max_rows, outcome):
+                    buffer.seek(0)
+                    buffer.truncate()
+                    writer.writerows(
+                        [row[column].isoformat() if column == 'timestamp' else row[column] for column in LOG_COLUMNS]
+                        for row in rows
+                    )
+                    yield buffer.getvalue()
+            else:
+                for rows in _batches(cur, max_rows, outcome):
+                    yield ''.join(dumps(format_log(row)) + '\n' for row in rows)
+    finally:
+        pool.putconn(conn)
+
+
+def list_logs(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    params = query_params(event)
+    export_format = params.get('format')
+
+    try:
+        limit = min(max(int(params.get('limit', LOGS_DEFAULT_LIMIT)), 1), LOGS_MAX_LIMIT)
+        where, args = log_filters(params)
+        if export_format is not None and export_format not in EXPORT_FORMATS:
+            raise ValueError(export_format)
+    except ValueError:
+        return error_response(400, 'Invalid limit, cursor, filter or format')
+
+    if export_format:
+        streaming = bool(event.get('supportsStreaming'))
+        outcome: Dict[str, Any] = {}
+        chunks = iter_export(get_pool(setting('DATABASE_URL')), export_format, where, args,
+                             None if streaming else EXPORT_BUFFERED_MAX_ROWS, outcome)
+        headers = {
+            'Content-Type': EXPORT_FORMATS[export_format],
+            'Content-Disposition': f'attachment; filename="api_logs.{export_format}"',
+            'Access-Control-Allow-Origin': '*'
+        }
+        if streaming:
+            body: Any = chunks
+        else:
+            body = ''.join(chunks)
+            headers['X-Truncated'] = 'true' if outcome['truncated'] else 'false'
+            headers['Access-Control-Expose-Headers'] = 'Server-Timing, X-Truncated, X-Next-Cursor'
+            if outcome.get('nextCursor'):
+                headers['X-Next-Cursor'] = outcome['nextCursor']
+        return {'statusCode': 200, 'headers': headers, 'body': body, 'isBase64Encoded': False}
+
+    with connection(setting('DATABASE_URL')) as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(f"""
+                SELECT {', '.join(LOG_COLUMNS)}
+                FROM api_logs
+                {where}
+                ORDER BY timestamp DESC, id DESC
+                LIMIT %s
+            """, (*args, limit + 1))
+            rows = cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['timestamp'], rows[-1]['id'])
+
+    return json_response(200, {'logs': [format_log(row) for row in rows], 'nextCursor': next_cursor})
+
+
+router = Router({'GET': list_logs}, database_required=True)
+
+
+@instrument('logs')
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Read proxy logs with filters, keyset pagination and NDJSON/CSV export
+    Args: event with httpMethod, queryStringParameters (level, endpoint, status, from, to,
+          cursor, limit, format); supportsStreaming is set by hosts that can send an iterator body
+    Returns: HTTP response with a page of logs or an export stream; a buffered export cut at
+             LOGS_EXPORT_BUFFERED_MAX_ROWS carries X-Truncated: true and an X-Next-Cursor to resume from
+    '''
+    return router(event, context)
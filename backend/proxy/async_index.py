@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+from datetime import datetime
+from typing import Dict, Any, Optional
+from accounting import UsageBuffer
+from balancer import NoUpstreamError, UPSTREAM_READ_TIMEOUT
+from completion_cache import completion_cache_key
+from index import (admit, api_key_of, authorize, cache_hit_response, completion_cache, completion_payload,
+                   completion_response, partition_maintainer, read_body, record_success, stream_recorder,
+                   stream_response, upstream_error_response)
+from key_cache import key_cache, MISS
+from runtime import Router, async_connection, error_response, get_pool, httpx, setting
+from singleflight import AsyncSingleFlight
+from sse import iter_sse_async
+from timing import instrument, phase
+from upstream import fetch_completion_async, post_completion_async
+
+usage_buffer = UsageBuffer(get_pool)
+usage_buffer.flush_inline = False
+upstream_flights = AsyncSingleFlight()
+
+
+async def lookup_key(database_url: str, key_digest: bytes) -> Optional[Dict[str, Any]]:
+    '''
+    Resolve an API key through the shared key cache and the loop's asyncpg pool.
+    The cache's LISTEN connection is (re)opened on a worker thread so the loop
+    never blocks on it.
+    '''
+    if key_cache.listening:
+        key_cache.sync(database_url)
+    else:
+        await asyncio.to_thread(key_cache.sync, database_url)
+    key_record = key_cache.get(key_digest)
+
+    if key_record is MISS:
+        async with async_connection(database_url) as conn:
+            row = await conn.fetchrow("""
+                SELECT id, name, is_active, rate_limit_rpm, daily_token_limit
+                FROM api_keys
+                WHERE key_digest = $1
+            """, key_digest)
+        key_record = dict(row) if row else None
+        key_cache.put(key_digest, key_record)
+    return key_record
+
+
+async def complete(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    api_key = api_key_of(event)
+
+    if not api_key:
+        return error_response(401, 'API key required', message='Include X-Api-Key header')
+
+    database_url = setting('DATABASE_URL')
+    if not database_url:
+        return error_response(500, 'Database configuration missing')
+
+    try:
+        key_digest = hashlib.sha256(api_key.encode()).digest()
+
+        partition_maintainer.start(database_url)
+        with phase('key_lookup'):
+            key_record = await lookup_key(database_url, key_digest)
+
+        rejected = authorize(key_record)
+        if rejected:
+            return rejected
+
+        body_data, rejected = read_body(event)
+        if rejected:
+            return rejected
+
+        rejected = admit(database_url, key_record, usage_buffer)
+        if rejected:
+            return rejected
+
+        gptunnel_key = setting('GPTUNNEL_API_KEY')
+        if not gptunnel_key:
+            return error_response(500, 'GPTunnel not configured')
+
+        payload = completion_payload(body_data)
+        stream = payload.get('stream', False)
+
+        use_cache = bool(body_data.get('cache', False)) and not stream
+        if use_cache:
+            cache_key = completion_cache_key(payload)
+            with phase('cache'):
+                cached_body = await asyncio.to_thread(completion_cache.get, database_url, cache_key)
+            if cached_body is not None:
+                return cache_hit_response(database_url, key_record, payload, cached_body, usage_buffer)
+
+        start_time = datetime.now()
+
+        shared = False
+        with phase('upstream'):
+            if stream:
+                response = await post_completion_async(gptunnel_key, payload, stream=True)
+                status_code = response.status_code
+            elif use_cache:
+                (status_code, response_text), shared = await upstream_flights.do(
+                    cache_key, lambda: fetch_completion_async(gptunnel_key, payload))
+            else:
+                status_code, response_text = await fetch_completion_async(gptunnel_key, payload)
+
+        duration_ms = int((datetime.now() - start_time).total_seconds() * 1000)
+
+        if status_code != 200:
+            if stream:
+                try:
+                    await response.aread()
+                    response_text = response.text
+                finally:
+                    await response.aclose()
+            return upstream_error_response(database_url, key_record, payload, status_code, response_text,
+                                           duration_ms, usage_buffer)
+
+        if stream:
+            events = iter_sse_async(response, stream_recorder(database_url, key_record, payload, start_time,
+                                                              usage_buffer))
+            if event.get('supportsStreaming'):
+                return stream_response(events)
+            return stream_response(''.join([line async for line in events]))
+
+        if use_cache:
+            cache_status = 'hit' if shared else 'miss'
+        else:
+            cache_status = None
+
+        response_body = record_success(database_url, key_record, payload, response_text, duration_ms, shared,
+                                       cache_status, usage_buffer)
+        if use_cache and not shared:
+            with phase('cache'):
+                await asyncio.to_thread(completion_cache.put, database_url, cache_key, response_body)
+
+        return completion_response(response_body, cache_status)
+
+    except NoUpstreamError as e:
+        return error_response(400, 'Unsupported model', message=str(e))
+    except httpx.TimeoutException:
+        return error_response(504, 'Timeout', message=f'Request timeout after {UPSTREAM_READ_TIMEOUT:g}s')
+    except Exception as e:
+        return error_response(500, 'Internal error', message=str(e))
+
+
+router = Router({'POST': complete}, allow_headers='Content-Type, X-Api-Key', default_method='POST')
+
+
+@instrument('proxy')
+async def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Asyncio variant of the public completions endpoint; same contract as index.handler,
+              but one process keeps many completions in flight while they wait on GPTunnel
+    Args: event with httpMethod, headers (X-Api-Key), body (model, messages, stream, cache);
+          supportsStreaming is set by hosts that can send an async iterator body
+    Returns: HTTP response with AI completion, SSE stream or error
+    '''
+    return await router.call_async(event, context)
@@ -0,0 +1,499 @@
+import os
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Deque, Dict, Any, Callable, Iterable, List, Optional, Tuple
+from runtime import asyncio, dumps, httpx, loads, requests, setting
+
+GPTUNNEL_URL = os.environ.get('GPTUNNEL_URL', 'https://gptunnel.ru/v1/chat/completions')
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', '10'))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', '5'))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', '30'))
+UPSTREAM_ASYNC_MAX_CONNECTIONS = int(os.environ.get('UPSTREAM_ASYNC_MAX_CONNECTIONS', '1000'))
+UPSTREAM_KEEPALIVE = os.environ.get('UPSTREAM_KEEPALIVE', '1') == '1'
+UPSTREAM_STRATEGY = os.environ.get('UPSTREAM_STRATEGY', 'least_outstanding')
+UPSTREAM_MAX_ATTEMPTS = int(os.environ.get('UPSTREAM_MAX_ATTEMPTS', '2'))
+UPSTREAM_EJECT_AFTER = int(os.environ.get('UPSTREAM_EJECT_AFTER', '3'))
+UPSTREAM_EJECT_SECONDS = float(os.environ.get('UPSTREAM_EJECT_SECONDS', '30'))
+UPSTREAM_EWMA_ALPHA = float(os.environ.get('UPSTREAM_EWMA_ALPHA', '0.3'))
+UPSTREAM_HEDGE_ENABLED = os.environ.get('UPSTREAM_HEDGE_ENABLED', '0') == '1'
+UPSTREAM_HEDGE_PERCENTILE = float(os.environ.get('UPSTREAM_HEDGE_PERCENTILE', '0.95'))
+UPSTREAM_HEDGE_MIN_SAMPLES = int(os.environ.get('UPSTREAM_HEDGE_MIN_SAMPLES', '20'))
+UPSTREAM_HEDGE_MIN_DELAY_MS = float(os.environ.get('UPSTREAM_HEDGE_MIN_DELAY_MS', '50'))
+UPSTREAM_HEDGE_BUDGET = min(float(os.environ.get('UPSTREAM_HEDGE_BUDGET', '0.1')), 1.0)
+UPSTREAM_HEDGE_WORKERS = int(os.environ.get('UPSTREAM_HEDGE_WORKERS', str(UPSTREAM_POOL_SIZE * 2)))
+HEDGE_WINDOW = 256
+HEDGE_BUDGET_BURST = 10.0
+RETRYABLE_STATUSES = frozenset((429, 502, 503, 504))
+STRATEGIES = ('least_outstanding', 'ewma')
+
+
+class NoUpstreamError(Exception):
+    '''No configured upstream serves the requested model'''
+
+
+class Upstream:
+    '''
+    One OpenAI-compatible chat completions endpoint and its passive health.
+    models is None for an upstream that takes every model, otherwise it maps
+    the requested model name to the name this upstream knows it by.
+    '''
+
+    def __init__(self, name: str, url: str, models: Optional[Dict[str, str]] = None,
+                 api_key_env: Optional[str] = None):
+        self.name = name
+        self.url = url
+        self.models = models
+        self.api_key_env = api_key_env
+        self.outstanding = 0
+        self.latency_ms: Optional[float] = None
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def serves(self, model: str) -> bool:
+        return self.models is None or model in self.models
+
+    def model_name(self, model: str) -> str:
+        return model if self.models is None else self.models[model]
+
+    def api_key(self, default: str) -> str:
+        return (setting(self.api_key_env) if self.api_key_env else None) or default
+
+    def state(self, now: float) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'outstanding': self.outstanding,
+            'latencyMs': round(self.latency_ms, 1) if self.latency_ms is not None else None,
+            'ejected': self.ejected_until > now,
+            'requests': self.requests,
+            'errors': self.errors
+        }
+
+
+class Balancer:
+    '''
+    Picks an upstream per attempt among those serving the model and not ejected.
+    least_outstanding prefers the fewest in-flight requests; ewma prefers the
+    lowest smoothed latency weighted by in-flight requests, so unmeasured
+    upstreams are probed first. UPSTREAM_EJECT_AFTER consecutive failures eject
+    an upstream for UPSTREAM_EJECT_SECONDS; after that a single failure ejects
+    it again until a success resets the count. When every candidate is ejected
+    they are all used rather than failing the request.
+    '''
+
+    def __init__(self, upstreams: List[Upstream], strategy: str = 'least_outstanding'):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown upstream strategy {strategy!r}; expected one of {', '.join(STRATEGIES)}")
+        self.upstreams = upstreams
+        self.strategy = strategy
+        self._lock = threading.Lock()
+
+    def acquire(self, model: str, exclude: Iterable[Upstream] = ()) -> Optional[Upstream]:
+        '''Pick an upstream for one attempt and count it as outstanding until release()'''
+        now = time.monotonic()
+        with self._lock:
+            candidates = [u for u in self.upstreams if u.serves(model) and u not in exclude]
+            healthy = [u for u in candidates if u.ejected_until <= now]
+            if not healthy:
+                healthy = candidates
+            if not healthy:
+                return None
+            if self.strategy == 'ewma':
+                upstream = min(healthy, key=lambda u: ((u.latency_ms or 0.0) * (u.outstanding + 1), random.random()))
+            else:
+                upstream = min(healthy, key=lambda u: (u.outstanding, random.random()))
+            upstream.outstanding += 1
+            upstream.requests += 1
+            return upstream
+
+    def release(self, upstream: Upstream, latency_ms: float, failed: bool) -> None:
+        with self._lock:
+            upstream.outstanding -= 1
+            if failed:
+                upstream.errors += 1
+                upstream.failures += 1
+                if upstream.failures >= UPSTREAM_EJECT_AFTER:
+                    upstream.ejected_until = time.monotonic() + UPSTREAM_EJECT_SECONDS
+                return
+            upstream.failures = 0
+            if upstream.latency_ms is None:
+                upstream.latency_ms = latency_ms
+            else:
+                upstream.latency_ms += UPSTREAM_EWMA_ALPHA * (latency_ms - upstream.latency_ms)
+
+    def serves(self, model: str) -> bool:
+        return any(u.serves(model) for u in self.upstreams)
+
+    def state(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            return [u.state(now) for u in self.upstreams]
+
+
+class HedgePolicy:
+    '''
+    When to hedge a completion, and whether the budget allows it. The delay is
+    the UPSTREAM_HEDGE_PERCENTILE of the model's last HEDGE_WINDOW completion
+    latencies once UPSTREAM_HEDGE_MIN_SAMPLES are known, never below
+    UPSTREAM_HEDGE_MIN_DELAY_MS. Every request earns UPSTREAM_HEDGE_BUDGET of a
+    hedge, up to HEDGE_BUDGET_BURST, and every hedge spends one, so hedges stay
+    within that share of requests however slow the upstreams get.
+    '''
+
+    def __init__(self, percentile: float, min_samples: int, budget: float):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.budget = budget
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._balance = 0.0
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model: str, latency_ms: float) -> None:
+        with self._lock:
+            samples = self._latencies.get(model)
+            if samples is None:
+                samples = self._latencies[model] = deque(maxlen=HEDGE_WINDOW)
+            samples.append(latency_ms)
+
+    def delay(self, model: str) -> Optional[float]:
+        '''Seconds to wait before hedging a new request for model, None while it is unmeasured'''
+        with self._lock:
+            self.requests += 1
+            self._balance = min(self._balance + self.budget, HEDGE_BUDGET_BURST)
+            samples = self._latencies.get(model)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        latency_ms = ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+        return max(latency_ms, UPSTREAM_HEDGE_MIN_DELAY_MS) / 1000
+
+    def spend(self) -> bool:
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            self.hedges += 1
+            return True
+
+    def won(self) -> None:
+        with self._lock:
+            self.hedge_wins += 1
+
+    def state(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'requests': self.requests, 'hedges': self.hedges, 'hedgeWins': self.hedge_wins}
+
+
+class HedgeExecutor:
+    '''
+    Worker threads for hedged completions that never queue: a call only runs
+    once acquire() has reserved an idle worker for it, and its worker is freed
+    again when it finishes.
+    '''
+
+    def __init__(self, workers: int):
+        self._slots = threading.BoundedSemaphore(workers)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hedge')
+
+    def acquire(self) -> bool:
+        return self._slots.acquire(blocking=False)
+
+    def release(self) -> None:
+        self._slots.release()
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> Future:
+        '''Run fn on the worker reserved by acquire()'''
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+hedge_policy = HedgePolicy(UPSTREAM_HEDGE_PERCENTILE, UPSTREAM_HEDGE_MIN_SAMPLES, UPSTREAM_HEDGE_BUDGET)
+
+
+def load_upstreams(config: Optional[str]) -> List[Upstream]:
+    '''
+    Parse the UPSTREAMS setting, a JSON list such as
+    [{"name": "gptunnel", "url": "https://gptunnel.ru/v1/chat/completions"},
+     {"name": "backup", "url": "...", "apiKeyEnv": "BACKUP_API_KEY", "models": ["gpt-4o-mini"]}].
+    models is a list of model names or an object mapping requested names to the
+    upstream's own; upstreams without apiKeyEnv use GPTUNNEL_API_KEY. Without
+    UPSTREAMS the single GPTUNNEL_URL endpoint is used.
+    '''
+    if not config:
+        return [Upstream('gptunnel', GPTUNNEL_URL)]
+    upstreams = []
+    for i, entry in enumerate(loads(config)):
+        models = entry.get('models')
+        if isinstance(models, list):
+            models = {model: model for model in models}
+        upstreams.append(Upstream(entry.get('name') or f'upstream-{i}', entry['url'], models, entry.get('apiKeyEnv')))
+    if not upstreams:
+        raise ValueError('UPSTREAMS must list at least one upstream')
+    return upstreams
+
+
+_session: Any = None
+_balancer: Optional[Balancer] = None
+_executor: Optional[HedgeExecutor] = None
+_async_clients: 'weakref.WeakKeyDictionary[Any, Any]' = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def get_session() -> Any:
+    '''Return the container-wide keep-alive session used for upstream calls'''
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=UPSTREAM_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def get_balancer() -> Balancer:
+    '''Return the container-wide balancer built from UPSTREAMS on first use'''
+    global _balancer
+    with _lock:
+        if _balancer is None:
+            _balancer = Balancer(load_upstreams(setting('UPSTREAMS')), UPSTREAM_STRATEGY)
+        return _balancer
+
+
+def get_executor() -> HedgeExecutor:
+    '''Return the container-wide UPSTREAM_HEDGE_WORKERS threads that run hedged completions'''
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = HedgeExecutor(UPSTREAM_HEDGE_WORKERS)
+        return _executor
+
+
+def get_async_client() -> Any:
+    '''Return the keep-alive httpx client of the running event loop, creating it on first use'''
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=UPSTREAM_ASYNC_MAX_CONNECTIONS,
+                                max_keepalive_connections=UPSTREAM_POOL_SIZE),
+            timeout=httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT))
+    return client
+
+
+def _route(balancer: Balancer, model: str, tried: List[Upstream], avoid: Iterable[Upstream],
+           own: int) -> Tuple[Upstream, bool]:
+    '''Pick the upstream for the next attempt and tell whether it is the last one allowed'''
+    if not tried and not balancer.serves(model):
+        raise NoUpstreamError(f'No upstream serves model {model}')
+    upstream = balancer.acquire(model, [*tried, *avoid]) or balancer.acquire(model, tried)
+    tried.append(upstream)
+    last_attempt = own + 1 >= UPSTREAM_MAX_ATTEMPTS or not any(
+        u.serves(model) and u not in tried for u in balancer.upstreams)
+    return upstream, last_attempt
+
+
+def _request(upstream: Upstream, api_key: str, payload: Dict[str, Any], model: str) -> Tuple[Dict[str, str], bytes]:
+    '''Headers and body of one attempt; UPSTREAM_KEEPALIVE=0 asks for a fresh connection per call'''
+    body = payload if upstream.models is None else {**payload, 'model': upstream.model_name(model)}
+    headers = {
+        'Authorization': f'Bearer {upstream.api_key(api_key)}',
+        'Content-Type': 'application/json'
+    }
+    if not UPSTREAM_KEEPALIVE:
+        headers['Connection'] = 'close'
+    return headers, dumps(body).encode()
+
+
+def post(api_key: str, payload: Dict[str, Any], stream: bool = False, attempts: Optional[List[Upstream]] = None,
+         avoid: Iterable[Upstream] = ()) -> Tuple[Upstream, Any]:
+    '''
+    Send a chat completion to the best upstream for its model and return the
+    upstream with its response. Connection failures and 429/502/503/504 answers
+    mean the upstream did not run the completion, so they are retried on another
+    upstream, up to UPSTREAM_MAX_ATTEMPTS in total; read timeouts and other
+    errors are not, since the completion may already be under way. A stream is
+    outstanding until its headers arrive. Every upstream tried is appended to
+    attempts; upstreams in avoid are only used when no other one serves the model.
+    '''
+    balancer = get_balancer()
+    model = payload.get('model', '')
+    tried: List[Upstream] = [] if attempts is None else attempts
+    own = 0
+    while True:
+        upstream, last_attempt = _route(balancer, model, tried, avoid, own)
+        own += 1
+        headers, data = _request(upstream, api_key, payload, model)
+        started = time.monotonic()
+        try:
+            response = get_session().post(upstream.url, headers=headers, data=data, stream=stream,
+                                          timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+        except requests.exceptions.ConnectionError:
+            balancer.release(upstream, 0.0, True)
+            if last_attempt:
+                raise
+            continue
+        except BaseException:
+            balancer.release(upstream, 0.0, True)
+            raise
+        status = response.status_code
+        balancer.release(upstream, (time.monotonic() - started) * 1000, status in RETRYABLE_STATUSES or status >= 500)
+        if status in RETRYABLE_STATUSES and not last_attempt:
+            response.close()
+            continue
+        return upstream, response
+
+
+def fetch(api_key: str, payload: Dict[str, Any]) -> Tuple[int, str]:
+    '''
+    Send a non-streaming completion and return its status code and body text.
+    With UPSTREAM_HEDGE_ENABLED, a request still unanswered after its model's
+    hedge delay is sent again, to another upstream when one serves the model,
+    if the hedge budget allows. The first successful answer wins; without one
+    the first answer of any status is returned, whichever call produced it,
+    and fetch raises only when both calls raised. The other call is abandoned
+    and its answer is dropped unread, so only the winner reaches accounting.
+    requests cannot abort a call that is waiting for headers, so an abandoned
+    call finishes on its worker thread.
+    A hedged request needs an idle hedge worker for each of its calls and never
+    waits for one: without a worker for the primary it runs on the calling
+    thread unhedged, without one for the hedge the primary runs alone. Queueing
+    would count against the hedge delay and fire more hedges the busier the
+    workers are.
+    '''
+    model = payload.get('model', '')
+    primary_attempts: List[Upstream] = []
+
+    def call(attempts: List[Upstream], avoid: Iterable[Upstream]) -> Tuple[int, str]:
+        started = time.monotonic()
+        response = post(api_key, payload, attempts=attempts, avoid=avoid)[1]
+        if UPSTREAM_HEDGE_ENABLED and response.status_code == 200:
+            hedge_policy.observe(model, (time.monotonic() - started) * 1000)
+        return response.status_code, response.text
+
+    delay = hedge_policy.delay(model) if UPSTREAM_HEDGE_ENABLED else None
+    if delay is None:
+        return call(primary_attempts, ())
+
+    executor = get_executor()
+    if not executor.acquire():
+        return call(primary_attempts, ())
+    primary = executor.submit(call, primary_attempts, ())
+    try:
+        return primary.result(timeout=delay)
+    except FutureTimeoutError:
+        pass
+    if not executor.acquire():
+        return primary.result()
+    if not hedge_policy.spend():
+        executor.release()
+        return primary.result()
+
+    hedge = executor.submit(call, [], primary_attempts)
+    answered = None
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                continue
+            if future.result()[0] == 200:
+                if future is hedge:
+                    hedge_policy.won()
+                return future.result()
+            answered = answered or future
+    return (answered or primary).result()
+
+
+async def post_async(api_key: str, payload: Dict[str, Any], stream: bool = False,
+                     attempts: Optional[List[Upstream]] = None, avoid: Iterable[Upstream] = ()) -> Tuple[Upstream, Any]:
+    '''post() on the event loop's httpx client; a streamed response must be closed with aclose()'''
+    balancer = get_balancer()
+    model = payload.get('model', '')
+    tried: List[Upstream] = [] if attempts is None else attempts
+    own = 0
+    client = get_async_client()
+    while True:
+        upstream, last_attempt = _route(balancer, model, tried, avoid, own)
+        own += 1
+        headers, data = _request(upstream, api_key, payload, model)
+        started = time.monotonic()
+        try:
+            response = await client.send(client.build_request('POST', upstream.url, headers=headers, content=data),
+                                         stream=stream)
+        except (httpx.ConnectError, httpx.ConnectTimeout):
+            balancer.release(upstream, 0.0, True)
+            if last_attempt:
+                raise
+            continue
+        except BaseException:
+            balancer.release(upstream, 0.0, True)
+            raise
+        status = response.status_code
+        balancer.release(upstream, (time.monotonic() - started) * 1000, status in RETRYABLE_STATUSES or status >= 500)
+        if status in RETRYABLE_STATUSES and not last_attempt:
+            await response.aclose()
+            continue
+        return upstream, response
+
+
+async def fetch_async(api_key: str, payload: Dict[str, Any]) -> Tuple[int, str]:
+    '''
+    fetch() on the event loop. Both calls of a hedged request run as tasks and
+    the loser is cancelled, which closes its connection to the upstream.
+    '''
+    model = payload.get('model', '')
+    primary_attempts: List[Upstream] = []
+
+    async def call(attempts: List[Upstream], avoid: Iterable[Upstream]) -> Tuple[int, str]:
+        started = time.monotonic()
+        response = (await post_async(api_key, payload, attempts=attempts, avoid=avoid))[1]
+        if UPSTREAM_HEDGE_ENABLED and response.status_code == 200:
+            hedge_policy.observe(model, (time.monotonic() - started) * 1000)
+        return response.status_code, response.text
+
+    delay = hedge_policy.delay(model) if UPSTREAM_HEDGE_ENABLED else None
+    if delay is None:
+        return await call(primary_attempts, ())
+
+    primary = asyncio.ensure_future(call(primary_attempts, ()))
+    tasks = {primary}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done or not hedge_policy.spend():
+            return await primary
+
+        hedge = asyncio.ensure_future(call([], primary_attempts))
+        tasks.add(hedge)
+        answered = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    continue
+                if future.result()[0] == 200:
+                    if future is hedge:
+                        hedge_policy.won()
+                    return future.result()
+                answered = answered or future
+        return (answered or primary).result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
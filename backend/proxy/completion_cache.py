@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Optional, Tuple
+from runtime import psycopg2
+
+COMPLETION_CACHE_SIZE = int(os.environ.get('COMPLETION_CACHE_SIZE', '1000'))
+COMPLETION_CACHE_TTL = float(os.environ.get('COMPLETION_CACHE_TTL', '3600'))
+COMPLETION_CACHE_MAX_ROWS = int(os.environ.get('COMPLETION_CACHE_MAX_ROWS', '100000'))
+COMPLETION_CACHE_EVICT_INTERVAL = float(os.environ.get('COMPLETION_CACHE_EVICT_INTERVAL', '60'))
+
+
+def completion_cache_key(payload: Dict[str, Any]) -> bytes:
+    '''SHA-256 of the request payload serialized with sorted keys and no whitespace'''
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).digest()
+
+
+class CompletionCache:
+    '''
+    Two-tier cache of serialized completion responses.
+    An in-process LRU sits in front of the completion_cache table; rows expire
+    after COMPLETION_CACHE_TTL seconds and the table is trimmed to
+    COMPLETION_CACHE_MAX_ROWS newest rows at most every COMPLETION_CACHE_EVICT_INTERVAL.
+    '''
+
+    def __init__(self, get_pool: Callable[[str], Any], max_size: int, ttl: float):
+        self._get_pool = get_pool
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: 'OrderedDict[bytes, Tuple[str, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._evict_at = 0.0
+
+    def get(self, database_url: str, key: bytes) -> Optional[str]:
+        '''Return the cached response body or None'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    return entry[0]
+                del self._entries[key]
+
+        try:
+            row = self._fetch(database_url, key)
+        except psycopg2.Error:
+            return None
+        if row is None:
+            return None
+        self._remember(key, row[0], min(self.ttl, float(row[1])))
+        return row[0]
+
+    def put(self, database_url: str, key: bytes, body: str) -> None:
+        '''Store a response in both tiers; database failures only cost the L2 copy'''
+        self._remember(key, body, self.ttl)
+        try:
+            self._store(database_url, key, body)
+        except psycopg2.Error:
+            pass
+
+    def _fetch(self, database_url: str, key: bytes) -> Optional[Tuple[str, Any]]:
+        pool = self._get_pool(database_url)
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT response, EXTRACT(EPOCH FROM expires_at - CURRENT_TIMESTAMP)
+                    FROM completion_cache
+                    WHERE cache_key = %s AND expires_at > CURRENT_TIMESTAMP
+                """, (key,))
+                return cur.fetchone()
+        finally:
+            pool.putconn(conn)
+
+    def _store(self, database_url: str, key: bytes, body: str) -> None:
+        pool = self._get_pool(database_url)
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO completion_cache (cache_key, response, created_at, expires_at)
+                    VALUES (%s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP + %s * INTERVAL '1 second')
+                    ON CONFLICT (cache_key)
+                    DO UPDATE SET response = EXCLUDED.response,
+                                  created_at = EXCLUDED.created_at,
+                                  expires_at = EXCLUDED.expires_at
+                """, (key, body, self.ttl))
+                if time.monotonic() >= self._evict_at:
+                    self._evict_at = time.monotonic() + COMPLETION_CACHE_EVICT_INTERVAL
+                    cur.execute("DELETE FROM completion_cache WHERE expires_at <= CURRENT_TIMESTAMP")
+                    cur.execute("""
+                        DELETE FROM completion_cache
+                        WHERE created_at < (
+                            SELECT created_at FROM completion_cache
+                            ORDER BY created_at DESC
+                            OFFSET %s LIMIT 1
+                        )
+                    """, (COMPLETION_CACHE_MAX_ROWS,))
+            conn.commit()
+        finally:
+            pool.putconn(conn)
+
+    def _remember(self, key: bytes, body: str, ttl: float) -> None:
+        with self._lock:
+            self._entries[key] = (body, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
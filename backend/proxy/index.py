@@ -1,250 +1,323 @@
-import json
-import os
 import hashlib
-from typing import Dict, Any
 from datetime import datetime
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import requests
+from typing import Dict, Any, Callable, Optional, Tuple
+from key_cache import key_cache, MISS
+from accounting import UsageBuffer
+from balancer import NoUpstreamError, UPSTREAM_READ_TIMEOUT
+from completion_cache import CompletionCache, completion_cache_key, COMPLETION_CACHE_SIZE, COMPLETION_CACHE_TTL
+from partitions import PartitionMaintainer
+from rate_limit import RateLimiter
+from runtime import Router, connection, dumps, error_response, get_pool, loads, parse_body, psycopg2, requests, setting
+from singleflight import SingleFlight
+from sse import iter_sse
+from upstream import fetch_completion, post_completion
+from timing import instrument, phase
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+
+usage_buffer = UsageBuffer(get_pool)
+completion_cache = CompletionCache(get_pool, COMPLETION_CACHE_SIZE, COMPLETION_CACHE_TTL)
+upstream_flights = SingleFlight()
+rate_limiter = RateLimiter(get_pool)
+partition_maintainer = PartitionMaintainer(get_pool)
+
+
+def queue_chat_message(database_url: str, key_id: str, model: str, usage: Dict[str, Any],
+                       user_message: str, ai_content: str, cached: bool,
+                       buffer: UsageBuffer = usage_buffer) -> None:
+    '''Put a chat.message webhook event into the outbox via the usage buffer'''
+    buffer.record_event(database_url, 'chat.message', {
+        'keyId': key_id,
+        'model': model,
+        'usage': usage,
+        'cached': cached,
+        'userMessage': user_message,
+        'aiResponse': ai_content,
+        'timestamp': datetime.now().isoformat()
+    })
+
+
+def api_key_of(event: Dict[str, Any]) -> Optional[str]:
+    headers = event.get('headers') or {}
+    return headers.get('X-Api-Key') or headers.get('x-api-key')
+
+
+def authorize(key_record: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    '''Reject unknown keys with 401 and disabled ones with 403 before anything else is looked at'''
+    if not key_record:
+        return error_response(401, 'Invalid API key')
+
+    if not key_record['is_active']:
+        return error_response(403, 'API key is disabled')
+    return None
+
+
+def admit(database_url: str, key_record: Dict[str, Any],
+          buffer: UsageBuffer = usage_buffer) -> Optional[Dict[str, Any]]:
+    '''Reject a rate-limited key with its 429 response; spend its token and count the request otherwise'''
+    with phase('rate_limit'):
+        limited = rate_limiter.check(database_url, key_record['id'],
+                                     key_record['rate_limit_rpm'], key_record['daily_token_limit'])
+    if limited:
+        retry_after, reason = limited
+        buffer.record_log(database_url, 'warning', 'POST', '/api/v1/completions', 429, reason, 0)
+        return error_response(429, reason, headers={'Retry-After': str(retry_after)}, retryAfter=retry_after)
+
+    buffer.record_request(database_url, key_record['id'])
+    return None
+
+
+def read_body(event: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
     '''
-    Business: Public API endpoint that validates API keys and proxies requests to GPTunnel
-    Args: event with httpMethod, headers (X-Api-Key), body (model, messages)
-    Returns: HTTP response with AI completion or error
+    Decode and validate a completion body before admit() spends a rate-limit token.
+    Returns the body, or a 400 response as the second item when it is unusable.
     '''
-    method: str = event.get('httpMethod', 'POST')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Api-Key',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
-    
-    headers = event.get('headers', {})
-    api_key = headers.get('X-Api-Key') or headers.get('x-api-key')
-    
+    try:
+        body_data = parse_body(event)
+    except ValueError:
+        return {}, error_response(400, 'Request body must be valid JSON')
+    if not isinstance(body_data, dict) or not body_data.get('messages'):
+        return {}, error_response(400, 'Messages array is required')
+    return body_data, None
+
+
+def completion_payload(body_data: Dict[str, Any]) -> Dict[str, Any]:
+    payload = {
+        'model': body_data.get('model', 'gpt-4o-mini'),
+        'messages': body_data.get('messages', []),
+        'temperature': body_data.get('temperature', 0.7),
+        'max_tokens': body_data.get('max_tokens', 1000)
+    }
+    if body_data.get('stream', False):
+        payload['stream'] = True
+        payload['stream_options'] = {'include_usage': True}
+    return payload
+
+
+def user_message_of(payload: Dict[str, Any]) -> str:
+    messages = payload['messages']
+    return messages[-1].get('content', '')[:500] if messages else ''
+
+
+def cache_hit_response(database_url: str, key_record: Dict[str, Any], payload: Dict[str, Any],
+                       cached_body: str, buffer: UsageBuffer = usage_buffer) -> Dict[str, Any]:
+    cached_result = loads(cached_body)
+    ai_content = cached_result.get('choices', [{}])[0].get('message', {}).get('content', '')
+    buffer.record_completion(database_url, key_record['id'], '/api/v1/completions', payload['model'],
+                             0, 0, 0, 0, user_message_of(payload), ai_content[:1000], cache_status='hit')
+    buffer.record_log(database_url, 'info', 'POST', '/api/v1/completions', 200, 'Cache hit', 0)
+    queue_chat_message(database_url, key_record['id'], payload['model'], cached_result.get('usage', {}),
+                       user_message_of(payload), ai_content[:1000], True, buffer)
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'X-Cache': 'HIT'
+        },
+        'body': cached_body,
+        'isBase64Encoded': False
+    }
+
+
+def upstream_error_response(database_url: str, key_record: Dict[str, Any], payload: Dict[str, Any],
+                            status_code: int, error_text: str, duration_ms: int,
+                            buffer: UsageBuffer = usage_buffer) -> Dict[str, Any]:
+    buffer.record_failure(database_url, key_record['id'], '/api/v1/completions', payload['model'],
+                          status_code, error_text[:500], duration_ms)
+    return error_response(status_code, 'GPTunnel error', details=error_text)
+
+
+def stream_recorder(database_url: str, key_record: Dict[str, Any], payload: Dict[str, Any],
+                    start_time: datetime,
+                    buffer: UsageBuffer = usage_buffer) -> Callable[[Dict[str, Any], str], None]:
+    '''Accounting callback run once an SSE stream ends, whether it finished or was cut short'''
+    model = payload['model']
+    user_message = user_message_of(payload)
+
+    def record_stream(usage: Dict[str, Any], ai_content: str) -> None:
+        stream_duration_ms = int((datetime.now() - start_time).total_seconds() * 1000)
+        total_tokens = usage.get('total_tokens', 0)
+        with phase('accounting'):
+            rate_limiter.add_tokens(key_record['id'], total_tokens)
+            buffer.record_completion(database_url, key_record['id'], '/api/v1/completions', model,
+                                     usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0),
+                                     total_tokens, stream_duration_ms, user_message, ai_content)
+            buffer.record_log(database_url, 'info', 'POST', '/api/v1/completions', 200,
+                              f'Success: {total_tokens} tokens', stream_duration_ms)
+            queue_chat_message(database_url, key_record['id'], model, usage, user_message, ai_content,
+                               False, buffer)
+
+    return record_stream
+
+
+def stream_response(body: Any) -> Dict[str, Any]:
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+
+def record_success(database_url: str, key_record: Dict[str, Any], payload: Dict[str, Any], response_text: str,
+                   duration_ms: int, shared: bool, cache_status: Optional[str],
+                   buffer: UsageBuffer = usage_buffer) -> str:
+    '''Account a finished completion and return its response body; shared answers cost no tokens'''
+    with phase('parse'):
+        result = loads(response_text)
+    usage = result.get('usage', {})
+    ai_content = result.get('choices', [{}])[0].get('message', {}).get('content', '')
+
+    if shared:
+        prompt_tokens = completion_tokens = total_tokens = 0
+    else:
+        prompt_tokens = usage.get('prompt_tokens', 0)
+        completion_tokens = usage.get('completion_tokens', 0)
+        total_tokens = usage.get('total_tokens', 0)
+
+    with phase('accounting'):
+        rate_limiter.add_tokens(key_record['id'], total_tokens)
+        buffer.record_completion(database_url, key_record['id'], '/api/v1/completions', payload['model'],
+                                 prompt_tokens, completion_tokens, total_tokens, duration_ms,
+                                 user_message_of(payload), ai_content[:1000], cache_status=cache_status)
+        buffer.record_log(database_url, 'info', 'POST', '/api/v1/completions', 200,
+                          f'Success: {total_tokens} tokens', duration_ms)
+        queue_chat_message(database_url, key_record['id'], payload['model'], usage,
+                           user_message_of(payload), ai_content[:1000], shared, buffer)
+
+    with phase('serialize'):
+        return dumps(result)
+
+
+def completion_response(response_body: str, cache_status: Optional[str]) -> Dict[str, Any]:
+    response_headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*'
+    }
+    if cache_status:
+        response_headers['X-Cache'] = cache_status.upper()
+    return {
+        'statusCode': 200,
+        'headers': response_headers,
+        'body': response_body,
+        'isBase64Encoded': False
+    }
+
+
+def complete(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    api_key = api_key_of(event)
+
     if not api_key:
-        return {
-            'statusCode': 401,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'API key required', 'message': 'Include X-Api-Key header'}),
-            'isBase64Encoded': False
-        }
-    
-    database_url = os.environ.get('DATABASE_URL')
+        return error_response(401, 'API key required', message='Include X-Api-Key header')
+
+    database_url = setting('DATABASE_URL')
     if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Database configuration missing'}),
-            'isBase64Encoded': False
-        }
-    
-    conn = psycopg2.connect(database_url)
-    
+        return error_response(500, 'Database configuration missing')
+
     try:
-        key_hash = hashlib.sha256(api_key.encode()).hexdigest()
-        
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT id, name, is_active 
-                FROM api_keys 
-                WHERE key_value = %s
-            """, (api_key,))
-            key_record = cur.fetchone()
-            
-            if not key_record:
-                return {
-                    'statusCode': 401,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({'error': 'Invalid API key'}),
-                    'isBase64Encoded': False
-                }
-            
-            if not key_record['is_active']:
-                return {
-                    'statusCode': 403,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({'error': 'API key is disabled'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute("""
-                UPDATE api_keys 
-                SET last_used_at = %s, request_count = request_count + 1
-                WHERE id = %s
-            """, (datetime.now(), key_record['id']))
-            conn.commit()
-        
-        body_data = json.loads(event.get('body', '{}'))
-        model = body_data.get('model', 'gpt-4o-mini')
-        messages = body_data.get('messages', [])
-        temperature = body_data.get('temperature', 0.7)
-        max_tokens = body_data.get('max_tokens', 1000)
-        
-        if not messages:
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({'error': 'Messages array is required'}),
-                'isBase64Encoded': False
-            }
-        
-        gptunnel_key = os.environ.get('GPTUNNEL_API_KEY')
+        key_digest = hashlib.sha256(api_key.encode()).digest()
+
+        partition_maintainer.start(database_url)
+        with phase('key_lookup'):
+            key_cache.sync(database_url)
+            key_record = key_cache.get(key_digest)
+
+            if key_record is MISS:
+                with connection(database_url) as conn:
+                    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                        cur.execute("""
+                            SELECT id, name, is_active, rate_limit_rpm, daily_token_limit
+                            FROM api_keys
+                            WHERE key_digest = %s
+                        """, (key_digest,))
+                        row = cur.fetchone()
+                key_record = dict(row) if row else None
+                key_cache.put(key_digest, key_record)
+
+        rejected = authorize(key_record)
+        if rejected:
+            return rejected
+
+        body_data, rejected = read_body(event)
+        if rejected:
+            return rejected
+
+        rejected = admit(database_url, key_record)
+        if rejected:
+            return rejected
+
+        gptunnel_key = setting('GPTUNNEL_API_KEY')
         if not gptunnel_key:
-            return {
-                'statusCode': 500,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({'error': 'GPTunnel not configured'}),
-                'isBase64Encoded': False
-            }
-        
+            return error_response(500, 'GPTunnel not configured')
+
+        payload = completion_payload(body_data)
+        stream = payload.get('stream', False)
+
+        use_cache = bool(body_data.get('cache', False)) and not stream
+        if use_cache:
+            cache_key = completion_cache_key(payload)
+            with phase('cache'):
+                cached_body = completion_cache.get(database_url, cache_key)
+            if cached_body is not None:
+                return cache_hit_response(database_url, key_record, payload, cached_body)
+
         start_time = datetime.now()
-        
-        response = requests.post(
-            'https://gptunnel.ru/v1/chat/completions',
-            headers={
-                'Authorization': f'Bearer {gptunnel_key}',
-                'Content-Type': 'application/json'
-            },
-            json={
-                'model': model,
-                'messages': messages,
-                'temperature': temperature,
-                'max_tokens': max_tokens
-            },
-            timeout=30
-        )
-        
+
+        shared = False
+        with phase('upstream'):
+            if stream:
+                response = post_completion(gptunnel_key, payload, stream=True)
+                status_code = response.status_code
+            elif use_cache:
+                (status_code, response_text), shared = upstream_flights.do(
+                    cache_key, lambda: fetch_completion(gptunnel_key, payload))
+            else:
+                status_code, response_text = fetch_completion(gptunnel_key, payload)
+
         duration_ms = int((datetime.now() - start_time).total_seconds() * 1000)
-        
-        if response.status_code != 200:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO api_logs (level, method, endpoint, status_code, message, duration_ms)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, ('error', 'POST', '/api/v1/completions', response.status_code, 
-                      response.text[:500], duration_ms))
-                conn.commit()
-            
-            return {
-                'statusCode': response.status_code,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'error': 'GPTunnel error',
-                    'details': response.text
-                }),
-                'isBase64Encoded': False
-            }
-        
-        result = response.json()
-        usage = result.get('usage', {})
-        prompt_tokens = usage.get('prompt_tokens', 0)
-        completion_tokens = usage.get('completion_tokens', 0)
-        total_tokens = usage.get('total_tokens', 0)
-        ai_content = result.get('choices', [{}])[0].get('message', {}).get('content', '')
-        
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO request_history 
-                (endpoint, method, model, prompt_tokens, completion_tokens, total_tokens, 
-                 duration_ms, status_code, user_message, ai_response)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, ('/api/v1/completions', 'POST', model, prompt_tokens, 
-                  completion_tokens, total_tokens, duration_ms, 200,
-                  messages[-1].get('content', '')[:500] if messages else '',
-                  ai_content[:1000]))
-            
-            cur.execute("""
-                INSERT INTO token_stats (date, model, total_requests, total_tokens, 
-                                        prompt_tokens, completion_tokens)
-                VALUES (CURRENT_DATE, %s, 1, %s, %s, %s)
-                ON CONFLICT (date, model) 
-                DO UPDATE SET 
-                    total_requests = token_stats.total_requests + 1,
-                    total_tokens = token_stats.total_tokens + %s,
-                    prompt_tokens = token_stats.prompt_tokens + %s,
-                    completion_tokens = token_stats.completion_tokens + %s
-            """, (model, total_tokens, prompt_tokens, completion_tokens,
-                  total_tokens, prompt_tokens, completion_tokens))
-            
-            cur.execute("""
-                INSERT INTO api_logs (level, method, endpoint, status_code, message, duration_ms)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, ('info', 'POST', '/api/v1/completions', 200, 
-                  f'Success: {total_tokens} tokens', duration_ms))
-            
-            conn.commit()
-        
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps(result),
-            'isBase64Encoded': False
-        }
-    
+
+        if status_code != 200:
+            error_text = response.text if stream else response_text
+            return upstream_error_response(database_url, key_record, payload, status_code, error_text, duration_ms)
+
+        if stream:
+            events = iter_sse(response, stream_recorder(database_url, key_record, payload, start_time))
+            return stream_response(events if event.get('supportsStreaming') else ''.join(events))
+
+        if use_cache:
+            cache_status = 'hit' if shared else 'miss'
+        else:
+            cache_status = None
+
+        response_body = record_success(database_url, key_record, payload, response_text, duration_ms, shared,
+                                       cache_status)
+        if use_cache and not shared:
+            with phase('cache'):
+                completion_cache.put(database_url, cache_key, response_body)
+
+        return completion_response(response_body, cache_status)
+
+    except NoUpstreamError as e:
+        return error_response(400, 'Unsupported model', message=str(e))
     except requests.exceptions.Timeout:
-        return {
-            'statusCode': 504,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Timeout', 'message': 'Request timeout after 30s'}),
-            'isBase64Encoded': False
-        }
+        return error_response(504, 'Timeout', message=f'Request timeout after {UPSTREAM_READ_TIMEOUT:g}s')
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Internal error', 'message': str(e)}),
-            'isBase64Encoded': False
-        }
-    finally:
-        conn.close()
+        return error_response(500, 'Internal error', message=str(e))
+
+
+router = Router({'POST': complete}, allow_headers='Content-Type, X-Api-Key', default_method='POST')
+
+
+@instrument('proxy')
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Public API endpoint that validates API keys and proxies requests to GPTunnel
+    Args: event with httpMethod, headers (X-Api-Key), body (model, messages, stream, cache);
+          supportsStreaming is set by hosts that can send an iterator body
+    Returns: HTTP response with AI completion, SSE stream or error
+    '''
+    return router(event, context)
@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+from runtime import psycopg2
+
+KEY_CACHE_SIZE = int(os.environ.get('KEY_CACHE_SIZE', '10000'))
+KEY_CACHE_TTL = float(os.environ.get('KEY_CACHE_TTL', '60'))
+KEY_CACHE_NEGATIVE_TTL = float(os.environ.get('KEY_CACHE_NEGATIVE_TTL', '10'))
+KEYS_CHANGED_CHANNEL = 'api_keys_changed'
+LISTENER_RETRY_AFTER = 5.0
+
+MISS = object()
+
+
+class KeyCache:
+    '''
+    Bounded LRU cache of API key lookups keyed by the SHA-256 of the key.
+    Unknown keys are cached as None with a shorter TTL. Entries are dropped
+    when the api-keys function sends a pg_notify on KEYS_CHANGED_CHANNEL
+    whose payload lists the changed key ids, comma-separated.
+    '''
+
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: 'OrderedDict[bytes, Tuple[Optional[Dict[str, Any]], float]]' = OrderedDict()
+        self._hash_by_id: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+        self._listener: Any = None
+        self._listener_retry_at = 0.0
+        self._sync_lock = threading.Lock()
+
+    def get(self, key_hash: bytes) -> Any:
+        '''Return the cached record, None for a known-invalid key or MISS'''
+        with self._lock:
+            entry = self._entries.get(key_hash)
+            if entry is None:
+                return MISS
+            record, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key_hash)
+                return MISS
+            self._entries.move_to_end(key_hash)
+            return record
+
+    def put(self, key_hash: bytes, record: Optional[Dict[str, Any]]) -> None:
+        ttl = self.ttl if record is not None else self.negative_ttl
+        with self._lock:
+            self._remove(key_hash)
+            self._entries[key_hash] = (record, time.monotonic() + ttl)
+            if record is not None:
+                self._hash_by_id[record['id']] = key_hash
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, *key_ids: str) -> None:
+        '''Drop the entries for key_ids together with every negative entry'''
+        with self._lock:
+            for key_id in key_ids:
+                key_hash = self._hash_by_id.get(key_id)
+                if key_hash is not None:
+                    self._remove(key_hash)
+            for cached_hash in [h for h, (record, _) in self._entries.items() if record is None]:
+                self._remove(cached_hash)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._hash_by_id.clear()
+
+    @property
+    def listening(self) -> bool:
+        '''True while the LISTEN connection is up, when sync() does no blocking work'''
+        return self._listener is not None and not self._listener.closed
+
+    def sync(self, database_url: str) -> None:
+        '''
+        Apply key changes announced since the last call. Notifications are
+        already buffered on the LISTEN socket, so poll() costs no round trip.
+        If the listener is down nothing can be trusted and the cache is cleared.
+        '''
+        with self._sync_lock:
+            if self._listener is None or self._listener.closed:
+                self.clear()
+                if time.monotonic() < self._listener_retry_at:
+                    return
+                try:
+                    self._listener = psycopg2.connect(database_url)
+                    self._listener.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                    with self._listener.cursor() as cur:
+                        cur.execute(f'LISTEN {KEYS_CHANGED_CHANNEL}')
+                except psycopg2.Error:
+                    self._close_listener()
+                return
+
+            try:
+                self._listener.poll()
+            except psycopg2.Error:
+                self._close_listener()
+                self.clear()
+                return
+
+            while self._listener.notifies:
+                notify = self._listener.notifies.pop(0)
+                self.invalidate(*notify.payload.split(','))
+
+    def _close_listener(self) -> None:
+        if self._listener is not None:
+            try:
+                self._listener.close()
+            except psycopg2.Error:
+                pass
+        self._listener = None
+        self._listener_retry_at = time.monotonic() + LISTENER_RETRY_AFTER
+
+    def _remove(self, key_hash: bytes) -> None:
+        entry = self._entries.pop(key_hash, None)
+        if entry is not None and entry[0] is not None:
+            self._hash_by_id.pop(entry[0]['id'], None)
+
+
+key_cache = KeyCache(KEY_CACHE_SIZE, KEY_CACHE_TTL, KEY_CACHE_NEGATIVE_TTL)
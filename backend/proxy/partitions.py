@@ -0,0 +1,66 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Optional
+from timing import report_flush_failure
+
+PARTITION_MAINTENANCE_INTERVAL = float(os.environ.get('PARTITION_MAINTENANCE_INTERVAL', '3600'))
+PARTITION_PRECREATE_DAYS = int(os.environ.get('PARTITION_PRECREATE_DAYS', '7'))
+HISTORY_RETENTION_DAYS = int(os.environ.get('HISTORY_RETENTION_DAYS', '90'))
+LOGS_RETENTION_DAYS = int(os.environ.get('LOGS_RETENTION_DAYS', '30'))
+PARTITION_MAINTENANCE_LOCK = 74210001
+
+
+class PartitionMaintainer:
+    '''
+    Keeps the daily partitions of request_history and api_logs ahead of the
+    clock and drops the ones past retention. A daemon thread runs the
+    maintenance every PARTITION_MAINTENANCE_INTERVAL seconds; an advisory lock
+    makes sure only one proxy instance does the work at a time. A failed run is
+    logged and counted through timing and retried on the next interval.
+    '''
+
+    def __init__(self, get_pool: Callable[[str], Any]):
+        self._get_pool = get_pool
+        self._database_url: Optional[str] = None
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+
+    def start(self, database_url: str) -> None:
+        '''Remember the database and start the maintenance thread if it is not running'''
+        with self._lock:
+            self._database_url = database_url
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+
+    def run_once(self) -> None:
+        '''Create upcoming partitions and drop expired ones'''
+        database_url = self._database_url
+        if database_url is None:
+            return
+
+        pool = self._get_pool(database_url)
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (PARTITION_MAINTENANCE_LOCK,))
+                if not cur.fetchone()[0]:
+                    return
+                for table, retention_days in (('request_history', HISTORY_RETENTION_DAYS),
+                                              ('api_logs', LOGS_RETENTION_DAYS)):
+                    cur.execute("""
+                        SELECT ensure_daily_partitions(%s, CURRENT_DATE, CURRENT_DATE + %s)
+                    """, (table, PARTITION_PRECREATE_DAYS))
+                    cur.execute("SELECT drop_expired_partitions(%s, %s)", (table, retention_days))
+            conn.commit()
+        finally:
+            pool.putconn(conn)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                report_flush_failure('partitions', e)
+            time.sleep(PARTITION_MAINTENANCE_INTERVAL)
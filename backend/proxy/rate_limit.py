@@ -0,0 +1,127 @@
+import math
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, Any, Callable, Optional, Tuple
+from runtime import psycopg2
+from timing import report_flush_failure
+
+RATE_LIMIT_RECONCILE_INTERVAL = float(os.environ.get('RATE_LIMIT_RECONCILE_INTERVAL', '30'))
+RATE_LIMIT_IDLE_TTL = float(os.environ.get('RATE_LIMIT_IDLE_TTL', '600'))
+
+
+class _KeyState:
+    __slots__ = ('tokens', 'refilled_at', 'used_today', 'pending', 'seen_at')
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.refilled_at = now
+        self.used_today = 0
+        self.pending = 0
+        self.seen_at = now
+
+
+class RateLimiter:
+    '''
+    Per-key requests/min token bucket and tokens/day quota kept in memory.
+    check() is O(1) and never touches the database. A daemon thread reconciles
+    daily token usage with key_daily_usage every RATE_LIMIT_RECONCILE_INTERVAL
+    seconds so quotas also account for other proxy instances; a failed
+    reconcile is logged and counted through timing and retried next interval.
+    '''
+
+    def __init__(self, get_pool: Callable[[str], Any]):
+        self._get_pool = get_pool
+        self._database_url: Optional[str] = None
+        self._states: Dict[str, _KeyState] = {}
+        self._day = date.today()
+        self._lock = threading.Lock()
+        self._reconciler: Optional[threading.Thread] = None
+
+    def check(self, database_url: str, key_id: str, rate_limit_rpm: Optional[int],
+              daily_token_limit: Optional[int]) -> Optional[Tuple[int, str]]:
+        '''Consume one request; return (retry_after_seconds, reason) if the key is over a limit'''
+        now = time.monotonic()
+        with self._lock:
+            self._database_url = database_url
+            self._roll_day()
+            state = self._states.get(key_id)
+            if state is None:
+                state = self._states[key_id] = _KeyState(float(rate_limit_rpm or 0), now)
+            state.seen_at = now
+
+            if daily_token_limit is not None and state.used_today + state.pending >= daily_token_limit:
+                return self._seconds_until_tomorrow(), 'Daily token quota exceeded'
+
+            if rate_limit_rpm:
+                rate = rate_limit_rpm / 60.0
+                state.tokens = min(float(rate_limit_rpm), state.tokens + (now - state.refilled_at) * rate)
+                state.refilled_at = now
+                if state.tokens < 1:
+                    return max(1, math.ceil((1 - state.tokens) / rate)), 'Rate limit exceeded'
+                state.tokens -= 1
+
+            if self._reconciler is None or not self._reconciler.is_alive():
+                self._reconciler = threading.Thread(target=self._run_reconciler, daemon=True)
+                self._reconciler.start()
+        return None
+
+    def add_tokens(self, key_id: str, tokens: int) -> None:
+        '''Charge tokens used by a finished completion against the daily quota'''
+        with self._lock:
+            state = self._states.get(key_id)
+            if state is not None:
+                state.pending += tokens
+
+    def reconcile(self) -> None:
+        '''Replace local daily usage with the database view and drop idle keys'''
+        with self._lock:
+            database_url = self._database_url
+            now = time.monotonic()
+            for key_id in [k for k, s in self._states.items() if now - s.seen_at > RATE_LIMIT_IDLE_TTL]:
+                del self._states[key_id]
+            key_ids = list(self._states)
+        if database_url is None or not key_ids:
+            return
+
+        pool = self._get_pool(database_url)
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT key_id, tokens FROM key_daily_usage
+                    WHERE date = %s AND key_id = ANY(%s)
+                """, (self._day, key_ids))
+                used = dict(cur.fetchall())
+        finally:
+            pool.putconn(conn)
+
+        with self._lock:
+            for key_id in key_ids:
+                state = self._states.get(key_id)
+                if state is not None:
+                    state.used_today = max(used.get(key_id, 0), state.used_today + state.pending)
+                    state.pending = 0
+
+    def _roll_day(self) -> None:
+        today = date.today()
+        if today != self._day:
+            self._day = today
+            for state in self._states.values():
+                state.used_today = 0
+                state.pending = 0
+
+    @staticmethod
+    def _seconds_until_tomorrow() -> int:
+        now = datetime.now()
+        tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        return max(1, math.ceil((tomorrow - now).total_seconds()))
+
+    def _run_reconciler(self) -> None:
+        while True:
+            time.sleep(RATE_LIMIT_RECONCILE_INTERVAL)
+            try:
+                self.reconcile()
+            except psycopg2.Error as e:
+                report_flush_failure('rate_limit', e)
@@ -0,0 +1,68 @@
+import threading
+from typing import Dict, Any, Awaitable, Callable, Optional, Tuple
+from runtime import asyncio
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    '''
+    Collapses concurrent calls that share a key into one execution.
+    The first caller runs the function, callers arriving while it is in flight
+    wait for it and receive the same result or exception.
+    '''
+
+    def __init__(self):
+        self._calls: Dict[Any, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Any, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        '''Return (result, shared) where shared is True for callers that did not run fn'''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class AsyncSingleFlight:
+    '''
+    SingleFlight for coroutines on one event loop. The first caller's
+    coroutine runs as a task that later callers await; a cancelled caller
+    does not cancel the task the others are waiting for.
+    '''
+
+    def __init__(self):
+        self._calls: Dict[Any, Any] = {}
+
+    async def do(self, key: Any, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        '''Return (result, shared) where shared is True for callers that did not start fn'''
+        task = self._calls.get(key)
+        if task is not None:
+            return await asyncio.shield(task), True
+        task = self._calls[key] = asyncio.ensure_future(fn())
+        task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task), False
@@ -0,0 +1,20 @@
+from typing import Dict, Any, Tuple
+from balancer import fetch, fetch_async, post, post_async
+
+
+def post_completion(gptunnel_key: str, payload: Dict[str, Any], stream: bool = False) -> Any:
+    '''Send a chat completion through the upstream balancer over a pooled connection'''
+    return post(gptunnel_key, payload, stream)[1]
+
+
+def fetch_completion(gptunnel_key: str, payload: Dict[str, Any]) -> Tuple[int, str]:
+    '''Send a non-streaming completion, hedged when enabled, and return its status code and body text'''
+    return fetch(gptunnel_key, payload)
+
+
+async def post_completion_async(gptunnel_key: str, payload: Dict[str, Any], stream: bool = False) -> Any:
+    return (await post_async(gptunnel_key, payload, stream))[1]
+
+
+async def fetch_completion_async(gptunnel_key: str, payload: Dict[str, Any]) -> Tuple[int, str]:
+    return await fetch_async(gptunnel_key, payload)
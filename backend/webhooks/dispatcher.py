@@ -0,0 +1,342 @@
+import hashlib
+import hmac
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import urlsplit
+from runtime import psycopg2, requests
+
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', '200'))
+WEBHOOK_CONCURRENCY = int(os.environ.get('WEBHOOK_CONCURRENCY', '32'))
+WEBHOOK_PER_HOST_LIMIT = int(os.environ.get('WEBHOOK_PER_HOST_LIMIT', '4'))
+WEBHOOK_CONNECT_TIMEOUT = float(os.environ.get('WEBHOOK_CONNECT_TIMEOUT', '3'))
+WEBHOOK_READ_TIMEOUT = float(os.environ.get('WEBHOOK_READ_TIMEOUT', '10'))
+WEBHOOK_CLAIM_TIMEOUT = int(os.environ.get('WEBHOOK_CLAIM_TIMEOUT', '300'))
+WEBHOOK_DISPATCH_BUDGET = float(os.environ.get('WEBHOOK_DISPATCH_BUDGET', '25'))
+WEBHOOK_POLL_INTERVAL = float(os.environ.get('WEBHOOK_POLL_INTERVAL', '1'))
+WEBHOOK_EVENT_RETENTION_DAYS = int(os.environ.get('WEBHOOK_EVENT_RETENTION_DAYS', '7'))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', '8'))
+WEBHOOK_RETRY_BASE_DELAY = float(os.environ.get('WEBHOOK_RETRY_BASE_DELAY', '10'))
+WEBHOOK_RETRY_MAX_DELAY = float(os.environ.get('WEBHOOK_RETRY_MAX_DELAY', '3600'))
+WEBHOOK_BREAKER_THRESHOLD = int(os.environ.get('WEBHOOK_BREAKER_THRESHOLD', '20'))
+WEBHOOK_BREAKER_COOLDOWN = float(os.environ.get('WEBHOOK_BREAKER_COOLDOWN', '60'))
+WEBHOOK_BREAKER_MAX_COOLDOWN = float(os.environ.get('WEBHOOK_BREAKER_MAX_COOLDOWN', '3600'))
+WEBHOOK_PROBE_INTERVAL = float(os.environ.get('WEBHOOK_PROBE_INTERVAL', '30'))
+
+_executor: Optional[ThreadPoolExecutor] = None
+_session: Any = None
+_host_slots: Dict[str, threading.BoundedSemaphore] = {}
+_lock = threading.Lock()
+_cleanup_at = 0.0
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor, _session
+    with _lock:
+        if _executor is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=64, pool_maxsize=WEBHOOK_PER_HOST_LIMIT)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+            _executor = ThreadPoolExecutor(max_workers=WEBHOOK_CONCURRENCY, thread_name_prefix='webhook')
+        return _executor
+
+
+def _host_slot(url: str) -> threading.BoundedSemaphore:
+    host = urlsplit(url).netloc.lower()
+    with _lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = _host_slots[host] = threading.BoundedSemaphore(WEBHOOK_PER_HOST_LIMIT)
+        return slot
+
+
+def retry_delay(attempts: int) -> float:
+    '''Exponential backoff with equal jitter after the given number of failed attempts'''
+    delay = min(WEBHOOK_RETRY_MAX_DELAY, WEBHOOK_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def claim_deliveries(conn: Any, limit: int) -> List[Dict[str, Any]]:
+    '''
+    Lease up to limit due deliveries and return them with their webhook URL,
+    event and circuit breaker state. The lease moves next_attempt_at forward by
+    WEBHOOK_CLAIM_TIMEOUT, so rows left behind by a crashed dispatcher come due
+    again. SKIP LOCKED lets several dispatchers run side by side. Deliveries to
+    a webhook disabled after they were queued stay pending until it is enabled again.
+    '''
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute("""
+            WITH claimed AS (
+                UPDATE webhook_deliveries d
+                SET status = 'sending', locked_at = CURRENT_TIMESTAMP,
+                    next_attempt_at = CURRENT_TIMESTAMP + %s * INTERVAL '1 second'
+                WHERE d.id IN (
+                    SELECT id FROM webhook_deliveries
+                    WHERE status IN ('pending', 'sending') AND next_attempt_at <= CURRENT_TIMESTAMP
+                      AND EXISTS (SELECT 1 FROM webhooks w WHERE w.id = webhook_deliveries.webhook_id AND w.is_enabled)
+                    ORDER BY next_attempt_at, webhook_id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING d.id, d.webhook_id, d.event_id, d.attempts
+            )
+            SELECT c.id, c.webhook_id, c.attempts, w.url, w.secret, w.batch_size,
+                   e.event_type, e.payload, e.created_at,
+                   w.circuit_open_until IS NOT NULL AS circuit_tripped,
+                   COALESCE(EXTRACT(EPOCH FROM w.circuit_open_until - CURRENT_TIMESTAMP), 0) AS circuit_wait
+            FROM claimed c
+            JOIN webhooks w ON w.id = c.webhook_id
+            JOIN webhook_events e ON e.id = c.event_id
+        """, (WEBHOOK_CLAIM_TIMEOUT, limit))
+        deliveries = cur.fetchall()
+    conn.commit()
+    return deliveries
+
+
+def plan_deliveries(deliveries: List[Dict[str, Any]]) -> Tuple[List[List[Dict[str, Any]]], List[Tuple[Dict[str, Any], float]]]:
+    '''
+    Group claimed deliveries into requests and pick (delivery, delay) pairs to
+    postpone. A batching webhook gets its deliveries in chunks of batch_size,
+    every other delivery is a request of its own. Deliveries to a webhook with an
+    open circuit wait until it closes; after the cool-down a single request per
+    webhook goes out as a probe.
+    '''
+    requests_by_webhook: Dict[str, List[List[Dict[str, Any]]]] = {}
+    deferred = []
+    for delivery in deliveries:
+        if delivery['circuit_tripped'] and delivery['circuit_wait'] > 0:
+            deferred.append((delivery, float(delivery['circuit_wait'])))
+            continue
+        webhook_requests = requests_by_webhook.setdefault(delivery['webhook_id'], [])
+        batch_size = delivery['batch_size'] or 1
+        if webhook_requests and len(webhook_requests[-1]) < batch_size:
+            webhook_requests[-1].append(delivery)
+        else:
+            webhook_requests.append([delivery])
+
+    planned = []
+    for webhook_requests in requests_by_webhook.values():
+        if webhook_requests[0][0]['circuit_tripped']:
+            for batch in webhook_requests[1:]:
+                deferred.extend((delivery, WEBHOOK_PROBE_INTERVAL) for delivery in batch)
+            webhook_requests = webhook_requests[:1]
+        planned.extend(webhook_requests)
+    return planned, deferred
+
+
+def _event_body(delivery: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'id': delivery['id'],
+        'event': delivery['event_type'],
+        'timestamp': delivery['created_at'].isoformat(),
+        'data': delivery['payload']
+    }
+
+
+def deliver(batch: List[Dict[str, Any]]) -> Tuple[bool, Optional[int], Optional[str]]:
+    '''
+    POST one event, or a JSON array of events to a batching webhook; returns
+    (ok, status_code, error). With a webhook secret the body is signed with
+    HMAC-SHA256 over "<timestamp>.<body>" in X-Webhook-Signature.
+    '''
+    first = batch[0]
+    if first['batch_size']:
+        payload: Any = [_event_body(delivery) for delivery in batch]
+    else:
+        payload = _event_body(first)
+    body = json.dumps(payload, separators=(',', ':')).encode()
+    headers = {
+        'Content-Type': 'application/json',
+        'X-Webhook-Event': first['event_type'],
+        'X-Webhook-Delivery': str(first['id']),
+        'X-Webhook-Batch-Size': str(len(batch))
+    }
+    if first['secret']:
+        timestamp = str(int(time.time()))
+        signature = hmac.new(first['secret'].encode(), timestamp.encode() + b'.' + body, hashlib.sha256)
+        headers['X-Webhook-Signature'] = f't={timestamp},v1={signature.hexdigest()}'
+
+    with _host_slot(first['url']):
+        try:
+            response = _session.post(
+                first['url'],
+                data=body,
+                timeout=(WEBHOOK_CONNECT_TIMEOUT, WEBHOOK_READ_TIMEOUT),
+                headers=headers
+            )
+            response.close()
+        except requests.exceptions.RequestException as e:
+            return False, None, str(e)[:500]
+    ok = response.status_code < 400
+    return ok, response.status_code, None if ok else f'HTTP {response.status_code}'
+
+
+def record_results(conn: Any, outcomes: List[Tuple[List[Dict[str, Any]], Tuple[bool, Optional[int], Optional[str]]]],
+                   deferred: List[Tuple[Dict[str, Any], float]]) -> None:
+    '''
+    Store delivery outcomes, schedule retries and postponed deliveries, roll the
+    outcomes up into the webhooks counters and trip or close circuit breakers,
+    all in one transaction. The breaker only sets circuit_open_until and never
+    touches the user's is_enabled flag. success_count and failure_count count events, the
+    circuit breaker counts requests; a failed batch is retried as a whole.
+    '''
+    counters: Dict[str, List[int]] = {}
+    rows = []
+    for batch, (ok, status_code, error) in outcomes:
+        counter = counters.setdefault(batch[0]['webhook_id'], [0, 0, 0])
+        if ok:
+            counter[0] += len(batch)
+            rows.extend((delivery['id'], 'delivered', status_code, error, None, 1) for delivery in batch)
+            continue
+        counter[1] += len(batch)
+        counter[2] += 1
+        delay = retry_delay(max(delivery['attempts'] for delivery in batch) + 1)
+        for delivery in batch:
+            if delivery['attempts'] + 1 >= WEBHOOK_MAX_ATTEMPTS:
+                rows.append((delivery['id'], 'failed', status_code, error, None, 1))
+            else:
+                rows.append((delivery['id'], 'pending', status_code, error, delay, 1))
+    for delivery, delay in deferred:
+        rows.append((delivery['id'], 'pending', None, None, delay, 0))
+    if not rows:
+        return
+
+    with conn.cursor() as cur:
+        psycopg2.extras.execute_values(cur, """
+            UPDATE webhook_deliveries AS d
+            SET status = v.status,
+                attempts = d.attempts + v.attempted,
+                last_status_code = CASE WHEN v.attempted = 1 THEN v.status_code ELSE d.last_status_code END,
+                last_error = CASE WHEN v.attempted = 1 THEN v.error ELSE d.last_error END,
+                delivered_at = CASE WHEN v.status = 'delivered' THEN CURRENT_TIMESTAMP ELSE d.delivered_at END,
+                next_attempt_at = CASE WHEN v.delay IS NULL THEN d.next_attempt_at
+                                       ELSE CURRENT_TIMESTAMP + v.delay * INTERVAL '1 second' END,
+                locked_at = NULL
+            FROM (VALUES %s) AS v(id, status, status_code, error, delay, attempted)
+            WHERE d.id = v.id
+        """, rows, template='(%s, %s, %s::integer, %s, %s::float8, %s)', page_size=len(rows))
+
+        if counters:
+            psycopg2.extras.execute_values(cur, """
+                UPDATE webhooks AS w
+                SET success_count = w.success_count + v.successes,
+                    failure_count = w.failure_count + v.failures,
+                    last_delivery_at = CASE WHEN v.successes > 0 THEN CURRENT_TIMESTAMP ELSE w.last_delivery_at END,
+                    consecutive_failures = CASE WHEN v.successes > 0 THEN 0
+                                                ELSE w.consecutive_failures + v.failed_requests END,
+                    circuit_trips = CASE WHEN v.successes > 0 THEN 0 ELSE w.circuit_trips END,
+                    circuit_open_until = CASE WHEN v.successes > 0 THEN NULL ELSE w.circuit_open_until END
+                FROM (VALUES %s) AS v(id, successes, failures, failed_requests)
+                WHERE w.id = v.id
+            """, [(webhook_id, *counter) for webhook_id, counter in sorted(counters.items())],
+                page_size=len(counters))
+
+            failing = sorted(webhook_id for webhook_id, (successes, failures, failed_requests) in counters.items()
+                             if failed_requests and not successes)
+            if failing:
+                cur.execute("""
+                    UPDATE webhooks
+                    SET circuit_trips = circuit_trips + 1,
+                        circuit_open_until = CURRENT_TIMESTAMP
+                            + LEAST(%s, %s * power(2, circuit_trips)) * INTERVAL '1 second'
+                    WHERE id = ANY(%s)
+                      AND consecutive_failures >= %s
+                      AND (circuit_open_until IS NULL OR circuit_open_until <= CURRENT_TIMESTAMP)
+                """, (WEBHOOK_BREAKER_MAX_COOLDOWN, WEBHOOK_BREAKER_COOLDOWN, failing, WEBHOOK_BREAKER_THRESHOLD))
+    conn.commit()
+
+
+def reset_circuit(conn: Any, webhook_id: str) -> bool:
+    '''Close the circuit of a webhook and make the deliveries it was holding due now'''
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE webhooks
+            SET consecutive_failures = 0, circuit_trips = 0, circuit_open_until = NULL
+            WHERE id = %s
+        """, (webhook_id,))
+        found = cur.rowcount > 0
+        cur.execute("""
+            UPDATE webhook_deliveries
+            SET next_attempt_at = CURRENT_TIMESTAMP
+            WHERE webhook_id = %s AND status = 'pending' AND next_attempt_at > CURRENT_TIMESTAMP
+        """, (webhook_id,))
+    conn.commit()
+    return found
+
+
+def cleanup_events(conn: Any) -> None:
+    '''Drop old events once none of their deliveries are outstanding'''
+    with conn.cursor() as cur:
+        cur.execute("""
+            DELETE FROM webhook_events e
+            WHERE e.created_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day'
+              AND NOT EXISTS (
+                  SELECT 1 FROM webhook_deliveries d
+                  WHERE d.event_id = e.id AND d.status IN ('pending', 'sending')
+              )
+        """, (WEBHOOK_EVENT_RETENTION_DAYS,))
+    conn.commit()
+
+
+def dispatch_pending(pool: Any) -> Dict[str, int]:
+    '''
+    Deliver due webhook events until the queue is empty or WEBHOOK_DISPATCH_BUDGET
+    seconds have passed. Deliveries run concurrently on a shared thread pool with
+    at most WEBHOOK_PER_HOST_LIMIT requests in flight per target host. Failed
+    deliveries are retried with exponential backoff up to WEBHOOK_MAX_ATTEMPTS times.
+    '''
+    global _cleanup_at
+    executor = _get_executor()
+    stats = {'delivered': 0, 'failed': 0, 'deferred': 0}
+    deadline = time.monotonic() + WEBHOOK_DISPATCH_BUDGET
+
+    while time.monotonic() < deadline:
+        conn = pool.getconn()
+        try:
+            deliveries = claim_deliveries(conn, WEBHOOK_BATCH_SIZE)
+        finally:
+            pool.putconn(conn)
+        if not deliveries:
+            break
+
+        batches, deferred = plan_deliveries(deliveries)
+        outcomes = list(zip(batches, executor.map(deliver, batches)))
+
+        conn = pool.getconn()
+        try:
+            record_results(conn, outcomes, deferred)
+        finally:
+            pool.putconn(conn)
+
+        for batch, (ok, status_code, error) in outcomes:
+            stats['delivered' if ok else 'failed'] += len(batch)
+        stats['deferred'] += len(deferred)
+
+    if time.monotonic() >= _cleanup_at:
+        _cleanup_at = time.monotonic() + 3600
+        conn = pool.getconn()
+        try:
+            cleanup_events(conn)
+        finally:
+            pool.putconn(conn)
+
+    return stats
+
+
+def run_forever(pool: Any) -> None:
+    '''Dispatcher loop for a long-running worker process'''
+    while True:
+        stats = dispatch_pending(pool)
+        if not stats['delivered'] and not stats['failed']:
+            time.sleep(WEBHOOK_POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    from runtime import get_pool
+    run_forever(get_pool(os.environ['DATABASE_URL']))
@@ -1,241 +1,180 @@
-import json
-import os
 import secrets
-import requests
 from datetime import datetime
 from typing import Dict, Any
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from dispatcher import dispatch_pending, reset_circuit
+from runtime import (Router, connection, error_response, get_pool, json_response, parse_body, psycopg2,
+                     query_params, requests, setting)
+from timing import instrument
 
+DEFAULT_BATCH_WINDOW_MS = 1000
+
+
+def test_webhook(webhook_id: str) -> Dict[str, Any]:
+    '''Send a test.ping to the webhook; no pooled connection is held while waiting for its answer'''
+    database_url = setting('DATABASE_URL')
+    with connection(database_url) as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute("SELECT url FROM webhooks WHERE id = %s", (webhook_id,))
+            webhook = cur.fetchone()
+
+    if not webhook:
+        return error_response(404, 'Webhook not found')
+
+    test_payload = {
+        'event': 'test.ping',
+        'timestamp': datetime.now().isoformat(),
+        'data': {'message': 'Test webhook from API Hub'}
+    }
+
+    try:
+        response = requests.post(
+            webhook['url'],
+            json=test_payload,
+            timeout=10,
+            headers={'Content-Type': 'application/json'}
+        )
+    except Exception as e:
+        return json_response(200, {
+            'success': False,
+            'message': str(e)
+        })
+    success = response.status_code < 400
+
+    with connection(database_url) as conn:
+        with conn.cursor() as cur:
+            if success:
+                cur.execute("""
+                    UPDATE webhooks
+                    SET last_delivery_at = %s, success_count = success_count + 1
+                    WHERE id = %s
+                """, (datetime.now(), webhook_id))
+            else:
+                cur.execute("""
+                    UPDATE webhooks
+                    SET failure_count = failure_count + 1
+                    WHERE id = %s
+                """, (webhook_id,))
+        conn.commit()
+
+    return json_response(200, {
+        'success': success,
+        'status': response.status_code,
+        'message': 'Test completed'
+    })
+
+
+def list_webhooks(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    params = query_params(event)
+    action = params.get('action', 'list')
+
+    if action == 'dispatch':
+        return json_response(200, dispatch_pending(get_pool(setting('DATABASE_URL'))))
+
+    if action == 'test':
+        return test_webhook(params.get('id', ''))
+
+    if action == 'reset':
+        with connection(setting('DATABASE_URL')) as conn:
+            if not reset_circuit(conn, params.get('id', '')):
+                return error_response(404, 'Webhook not found')
+        return json_response(200, {'success': True})
+
+    with connection(setting('DATABASE_URL')) as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute("""
+                SELECT id, url, events, is_enabled, last_delivery_at,
+                       success_count, failure_count, circuit_open_until, batch_size, batch_window_ms
+                FROM webhooks
+                ORDER BY created_at DESC
+            """)
+            webhooks = cur.fetchall()
+
+    result = []
+    for wh in webhooks:
+        total = wh['success_count'] + wh['failure_count']
+        success_rate = (wh['success_count'] / total * 100) if total > 0 else 100
+
+        result.append({
+            'id': wh['id'],
+            'url': wh['url'],
+            'events': wh['events'],
+            'enabled': wh['is_enabled'],
+            'lastDelivery': wh['last_delivery_at'].strftime('%H:%M') if wh['last_delivery_at'] else 'Не использовался',
+            'successRate': round(success_rate, 1),
+            'circuitOpenUntil': wh['circuit_open_until'].isoformat() if wh['circuit_open_until'] else None,
+            'batchSize': wh['batch_size'],
+            'batchWindowMs': wh['batch_window_ms']
+        })
+
+    return json_response(200, {'webhooks': result})
+
+
+def create_webhook(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    body_data = parse_body(event)
+    url = body_data.get('url', '').strip()
+    events = body_data.get('events', ['chat.message'])
+    batch_size = body_data.get('batchSize')
+    batch_window_ms = body_data.get('batchWindowMs')
+
+    if not url:
+        return error_response(400, 'URL is required')
+
+    for value in (batch_size, batch_window_ms):
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value <= 0):
+            return error_response(400, 'Batch settings must be positive integers')
+
+    if batch_size is not None and batch_window_ms is None:
+        batch_window_ms = DEFAULT_BATCH_WINDOW_MS
+    elif batch_size is None:
+        batch_window_ms = None
+
+    webhook_id = f"wh_{secrets.token_hex(8)}"
+    secret = f"whsec_{secrets.token_urlsafe(24)}"
+
+    with connection(setting('DATABASE_URL')) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO webhooks (id, url, events, is_enabled, created_at, secret, batch_size, batch_window_ms)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """, (webhook_id, url, events, True, datetime.now(), secret, batch_size, batch_window_ms))
+            conn.commit()
+
+    return json_response(201, {
+        'id': webhook_id,
+        'url': url,
+        'events': events,
+        'enabled': True,
+        'lastDelivery': 'Не использовался',
+        'successRate': 100.0,
+        'secret': secret,
+        'batchSize': batch_size,
+        'batchWindowMs': batch_window_ms
+    })
+
+
+def delete_webhook(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    webhook_id = query_params(event).get('id', '')
+
+    if not webhook_id:
+        return error_response(400, 'Webhook ID is required')
+
+    with connection(setting('DATABASE_URL')) as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM webhooks WHERE id = %s", (webhook_id,))
+            conn.commit()
+
+    return json_response(200, {'success': True})
+
+
+router = Router({'GET': list_webhooks, 'POST': create_webhook, 'DELETE': delete_webhook}, database_required=True)
+
+
+@instrument('webhooks')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: Manage webhooks - create, list, test, delete
+    Business: Manage webhooks - create, list, test, delete; action=dispatch delivers queued events,
+              action=reset closes a webhook's circuit breaker
     Args: event with httpMethod, body, queryStringParameters
     Returns: HTTP response with webhooks data
     '''
-    method: str = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    database_url = os.environ.get('DATABASE_URL')
-    if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Database configuration missing'}),
-            'isBase64Encoded': False
-        }
-    
-    conn = psycopg2.connect(database_url)
-    
-    try:
-        if method == 'GET':
-            action = event.get('queryStringParameters', {}).get('action', 'list')
-            
-            if action == 'test':
-                webhook_id = event.get('queryStringParameters', {}).get('id', '')
-                
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute("SELECT url FROM webhooks WHERE id = %s", (webhook_id,))
-                    webhook = cur.fetchone()
-                    
-                    if not webhook:
-                        return {
-                            'statusCode': 404,
-                            'headers': {
-                                'Content-Type': 'application/json',
-                                'Access-Control-Allow-Origin': '*'
-                            },
-                            'body': json.dumps({'error': 'Webhook not found'}),
-                            'isBase64Encoded': False
-                        }
-                    
-                    test_payload = {
-                        'event': 'test.ping',
-                        'timestamp': datetime.now().isoformat(),
-                        'data': {'message': 'Test webhook from API Hub'}
-                    }
-                    
-                    try:
-                        response = requests.post(
-                            webhook['url'],
-                            json=test_payload,
-                            timeout=10,
-                            headers={'Content-Type': 'application/json'}
-                        )
-                        success = response.status_code < 400
-                        
-                        with conn.cursor() as cur_update:
-                            if success:
-                                cur_update.execute("""
-                                    UPDATE webhooks 
-                                    SET last_delivery_at = %s, success_count = success_count + 1
-                                    WHERE id = %s
-                                """, (datetime.now(), webhook_id))
-                            else:
-                                cur_update.execute("""
-                                    UPDATE webhooks 
-                                    SET failure_count = failure_count + 1
-                                    WHERE id = %s
-                                """, (webhook_id,))
-                            conn.commit()
-                        
-                        return {
-                            'statusCode': 200,
-                            'headers': {
-                                'Content-Type': 'application/json',
-                                'Access-Control-Allow-Origin': '*'
-                            },
-                            'body': json.dumps({
-                                'success': success,
-                                'status': response.status_code,
-                                'message': 'Test completed'
-                            }),
-                            'isBase64Encoded': False
-                        }
-                    except Exception as e:
-                        return {
-                            'statusCode': 200,
-                            'headers': {
-                                'Content-Type': 'application/json',
-                                'Access-Control-Allow-Origin': '*'
-                            },
-                            'body': json.dumps({
-                                'success': False,
-                                'message': str(e)
-                            }),
-                            'isBase64Encoded': False
-                        }
-            
-            else:
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute("""
-                        SELECT id, url, events, is_enabled, last_delivery_at, 
-                               success_count, failure_count
-                        FROM webhooks
-                        ORDER BY created_at DESC
-                    """)
-                    webhooks = cur.fetchall()
-                    
-                    result = []
-                    for wh in webhooks:
-                        total = wh['success_count'] + wh['failure_count']
-                        success_rate = (wh['success_count'] / total * 100) if total > 0 else 100
-                        
-                        result.append({
-                            'id': wh['id'],
-                            'url': wh['url'],
-                            'events': wh['events'],
-                            'enabled': wh['is_enabled'],
-                            'lastDelivery': wh['last_delivery_at'].strftime('%H:%M') if wh['last_delivery_at'] else 'Не использовался',
-                            'successRate': round(success_rate, 1)
-                        })
-                    
-                    return {
-                        'statusCode': 200,
-                        'headers': {
-                            'Content-Type': 'application/json',
-                            'Access-Control-Allow-Origin': '*'
-                        },
-                        'body': json.dumps({'webhooks': result}),
-                        'isBase64Encoded': False
-                    }
-        
-        elif method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
-            url = body_data.get('url', '').strip()
-            events = body_data.get('events', ['chat.message'])
-            
-            if not url:
-                return {
-                    'statusCode': 400,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({'error': 'URL is required'}),
-                    'isBase64Encoded': False
-                }
-            
-            webhook_id = f"wh_{secrets.token_hex(8)}"
-            
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO webhooks (id, url, events, is_enabled, created_at)
-                    VALUES (%s, %s, %s, %s, %s)
-                """, (webhook_id, url, events, True, datetime.now()))
-                conn.commit()
-            
-            return {
-                'statusCode': 201,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'id': webhook_id,
-                    'url': url,
-                    'events': events,
-                    'enabled': True,
-                    'lastDelivery': 'Не использовался',
-                    'successRate': 100.0
-                }),
-                'isBase64Encoded': False
-            }
-        
-        elif method == 'DELETE':
-            params = event.get('queryStringParameters', {})
-            webhook_id = params.get('id', '')
-            
-            if not webhook_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({'error': 'Webhook ID is required'}),
-                    'isBase64Encoded': False
-                }
-            
-            with conn.cursor() as cur:
-                cur.execute("DELETE FROM webhooks WHERE id = %s", (webhook_id,))
-                conn.commit()
-            
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({'success': True}),
-                'isBase64Encoded': False
-            }
-        
-        else:
-            return {
-                'statusCode': 405,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
-    
-    finally:
-        conn.close()
\ No newline at end of file
+    return router(event, context)
@@ -0,0 +1,21 @@
+-- Store a fixed-width SHA-256 digest of every API key so lookups never touch the plaintext column
+ALTER TABLE api_keys ADD COLUMN IF NOT EXISTS key_digest BYTEA;
+ALTER TABLE api_keys ADD COLUMN IF NOT EXISTS key_prefix VARCHAR(16);
+
+-- Backfill existing keys
+UPDATE api_keys
+SET key_digest = sha256(convert_to(key_value, 'UTF8')),
+    key_prefix = LEFT(key_value, 12)
+WHERE key_digest IS NULL;
+
+ALTER TABLE api_keys ALTER COLUMN key_digest SET NOT NULL;
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conname = 'api_keys_key_digest_length' AND conrelid = 'api_keys'::regclass) THEN
+        ALTER TABLE api_keys ADD CONSTRAINT api_keys_key_digest_length CHECK (octet_length(key_digest) = 32);
+    END IF;
+END $$;
+
+-- Create indexes for better performance
+CREATE UNIQUE INDEX IF NOT EXISTS idx_api_keys_key_digest ON api_keys(key_digest);
@@ -0,0 +1,16 @@
+-- Create completion cache table for opt-in caching of deterministic proxy requests
+CREATE TABLE IF NOT EXISTS completion_cache (
+    cache_key BYTEA PRIMARY KEY,
+    response TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+
+-- Track cache hits in history and daily statistics
+ALTER TABLE request_history ADD COLUMN IF NOT EXISTS cache_hit BOOLEAN DEFAULT false;
+ALTER TABLE token_stats ADD COLUMN IF NOT EXISTS cache_hits INTEGER DEFAULT 0;
+ALTER TABLE token_stats ADD COLUMN IF NOT EXISTS cache_misses INTEGER DEFAULT 0;
+
+-- Create indexes for better performance
+CREATE INDEX IF NOT EXISTS idx_completion_cache_expires_at ON completion_cache(expires_at);
+CREATE INDEX IF NOT EXISTS idx_completion_cache_created_at ON completion_cache(created_at DESC);
@@ -0,0 +1,15 @@
+-- Per-key limits enforced by the proxy; NULL means unlimited
+ALTER TABLE api_keys ADD COLUMN IF NOT EXISTS rate_limit_rpm INTEGER;
+ALTER TABLE api_keys ADD COLUMN IF NOT EXISTS daily_token_limit BIGINT;
+
+-- Create per-key daily usage table used to reconcile quotas across proxy instances
+CREATE TABLE IF NOT EXISTS key_daily_usage (
+    key_id VARCHAR(50) NOT NULL,
+    date DATE NOT NULL DEFAULT CURRENT_DATE,
+    requests INTEGER DEFAULT 0,
+    tokens BIGINT DEFAULT 0,
+    PRIMARY KEY (key_id, date)
+);
+
+-- Create indexes for better performance
+CREATE INDEX IF NOT EXISTS idx_key_daily_usage_date ON key_daily_usage(date DESC);
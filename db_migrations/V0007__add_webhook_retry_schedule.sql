@@ -0,0 +1,10 @@
+-- Schedule webhook delivery attempts and track per-webhook circuit breaker state
+ALTER TABLE webhook_deliveries ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+ALTER TABLE webhooks ADD COLUMN IF NOT EXISTS consecutive_failures INTEGER DEFAULT 0;
+ALTER TABLE webhooks ADD COLUMN IF NOT EXISTS circuit_trips INTEGER DEFAULT 0;
+ALTER TABLE webhooks ADD COLUMN IF NOT EXISTS circuit_open_until TIMESTAMP;
+
+-- Due deliveries are polled by next_attempt_at; the partial index only holds outstanding rows
+DROP INDEX IF EXISTS idx_webhook_deliveries_pending;
+CREATE INDEX IF NOT EXISTS idx_webhook_deliveries_next_attempt ON webhook_deliveries(next_attempt_at) WHERE status IN ('pending', 'sending');
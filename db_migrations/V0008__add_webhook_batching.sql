@@ -0,0 +1,7 @@
+-- Opt-in batch delivery per webhook and a signing secret for outgoing payloads
+ALTER TABLE webhooks ADD COLUMN IF NOT EXISTS batch_size INTEGER;
+ALTER TABLE webhooks ADD COLUMN IF NOT EXISTS batch_window_ms INTEGER;
+ALTER TABLE webhooks ADD COLUMN IF NOT EXISTS secret TEXT;
+
+-- Deliveries waiting for their batch window to close, looked up per webhook when new events are queued
+CREATE INDEX IF NOT EXISTS idx_webhook_deliveries_waiting ON webhook_deliveries(webhook_id, next_attempt_at) WHERE status = 'pending' AND attempts = 0;
@@ -0,0 +1,9 @@
+-- Keyset pagination on (timestamp, id), optionally narrowed by model, status code or endpoint
+CREATE INDEX IF NOT EXISTS idx_request_history_timestamp_id ON request_history(timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_request_history_model_timestamp ON request_history(model, timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_request_history_status_timestamp ON request_history(status_code, timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_request_history_endpoint_timestamp ON request_history(endpoint, timestamp DESC, id DESC);
+
+-- Superseded by the composite indexes above
+DROP INDEX IF EXISTS idx_request_history_timestamp;
+DROP INDEX IF EXISTS idx_request_history_model;
@@ -0,0 +1,34 @@
+-- Incremental usage rollups per API key and model, maintained by the proxy's accounting flush.
+-- duration_buckets[i] counts requests with duration_ms <= the i-th bound of
+-- ROLLUP_DURATION_BOUNDS_MS; the last element counts everything slower.
+CREATE TABLE IF NOT EXISTS usage_rollup_hourly (
+    bucket TIMESTAMP NOT NULL,
+    key_id VARCHAR(50) NOT NULL,
+    model VARCHAR(100) NOT NULL,
+    requests INTEGER DEFAULT 0,
+    errors INTEGER DEFAULT 0,
+    prompt_tokens BIGINT DEFAULT 0,
+    completion_tokens BIGINT DEFAULT 0,
+    total_tokens BIGINT DEFAULT 0,
+    duration_ms_sum BIGINT DEFAULT 0,
+    duration_buckets INTEGER[] NOT NULL,
+    PRIMARY KEY (bucket, key_id, model)
+);
+
+CREATE TABLE IF NOT EXISTS usage_rollup_daily (
+    date DATE NOT NULL,
+    key_id VARCHAR(50) NOT NULL,
+    model VARCHAR(100) NOT NULL,
+    requests INTEGER DEFAULT 0,
+    errors INTEGER DEFAULT 0,
+    prompt_tokens BIGINT DEFAULT 0,
+    completion_tokens BIGINT DEFAULT 0,
+    total_tokens BIGINT DEFAULT 0,
+    duration_ms_sum BIGINT DEFAULT 0,
+    duration_buckets INTEGER[] NOT NULL,
+    PRIMARY KEY (date, key_id, model)
+);
+
+-- Create indexes for per-key range queries
+CREATE INDEX IF NOT EXISTS idx_usage_rollup_hourly_key ON usage_rollup_hourly(key_id, bucket);
+CREATE INDEX IF NOT EXISTS idx_usage_rollup_daily_key ON usage_rollup_daily(key_id, date);
@@ -0,0 +1,119 @@
+-- Range-partition request_history and api_logs by day so retention drops whole partitions
+
+-- Create one partition per day in [from_date, to_date]; rows outside land in the default partition
+CREATE OR REPLACE FUNCTION ensure_daily_partitions(parent TEXT, from_date DATE, to_date DATE) RETURNS INTEGER AS $$
+DECLARE
+    day DATE := from_date;
+    created INTEGER := 0;
+    partition_name TEXT;
+BEGIN
+    WHILE day <= to_date LOOP
+        partition_name := parent || '_p' || to_char(day, 'YYYYMMDD');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                           partition_name, parent, day, day + 1);
+            created := created + 1;
+        END IF;
+        day := day + 1;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Drop daily partitions whose whole range is older than keep_days
+CREATE OR REPLACE FUNCTION drop_expired_partitions(parent TEXT, keep_days INTEGER) RETURNS INTEGER AS $$
+DECLARE
+    child TEXT;
+    dropped INTEGER := 0;
+BEGIN
+    FOR child IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = parent::regclass
+          AND c.relname ~ ('^' || parent || '_p[0-9]{8}$')
+          AND to_date(right(c.relname, 8), 'YYYYMMDD') < CURRENT_DATE - keep_days
+    LOOP
+        EXECUTE format('DROP TABLE %I', child);
+        dropped := dropped + 1;
+    END LOOP;
+    RETURN dropped;
+END;
+$$ LANGUAGE plpgsql;
+
+-- request_history
+ALTER TABLE request_history RENAME TO request_history_legacy;
+ALTER SEQUENCE request_history_id_seq OWNED BY NONE;
+ALTER SEQUENCE request_history_id_seq AS BIGINT;
+
+CREATE TABLE request_history (
+    id BIGINT NOT NULL DEFAULT nextval('request_history_id_seq'),
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    endpoint TEXT NOT NULL,
+    method VARCHAR(10) NOT NULL,
+    model VARCHAR(100),
+    prompt_tokens INTEGER DEFAULT 0,
+    completion_tokens INTEGER DEFAULT 0,
+    total_tokens INTEGER DEFAULT 0,
+    duration_ms INTEGER,
+    status_code INTEGER,
+    user_message TEXT,
+    ai_response TEXT,
+    error_message TEXT,
+    cache_hit BOOLEAN DEFAULT false,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE request_history_default PARTITION OF request_history DEFAULT;
+SELECT ensure_daily_partitions('request_history',
+                               COALESCE((SELECT min(timestamp)::date FROM request_history_legacy), CURRENT_DATE),
+                               CURRENT_DATE + 7);
+
+INSERT INTO request_history (id, timestamp, endpoint, method, model, prompt_tokens, completion_tokens,
+                             total_tokens, duration_ms, status_code, user_message, ai_response,
+                             error_message, cache_hit)
+SELECT id, COALESCE(timestamp, CURRENT_TIMESTAMP), endpoint, method, model, prompt_tokens, completion_tokens,
+       total_tokens, duration_ms, status_code, user_message, ai_response, error_message, cache_hit
+FROM request_history_legacy;
+
+DROP TABLE request_history_legacy;
+ALTER SEQUENCE request_history_id_seq OWNED BY request_history.id;
+
+CREATE INDEX IF NOT EXISTS idx_request_history_timestamp_id ON request_history(timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_request_history_model_timestamp ON request_history(model, timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_request_history_status_timestamp ON request_history(status_code, timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_request_history_endpoint_timestamp ON request_history(endpoint, timestamp DESC, id DESC);
+
+-- api_logs
+ALTER TABLE api_logs RENAME TO api_logs_legacy;
+ALTER SEQUENCE api_logs_id_seq OWNED BY NONE;
+ALTER SEQUENCE api_logs_id_seq AS BIGINT;
+
+CREATE TABLE api_logs (
+    id BIGINT NOT NULL DEFAULT nextval('api_logs_id_seq'),
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    level VARCHAR(20) NOT NULL,
+    method VARCHAR(10) NOT NULL,
+    endpoint TEXT NOT NULL,
+    status_code INTEGER NOT NULL,
+    message TEXT,
+    duration_ms INTEGER,
+    ip_address VARCHAR(50),
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE api_logs_default PARTITION OF api_logs DEFAULT;
+SELECT ensure_daily_partitions('api_logs',
+                               COALESCE((SELECT min(timestamp)::date FROM api_logs_legacy), CURRENT_DATE),
+                               CURRENT_DATE + 7);
+
+INSERT INTO api_logs (id, timestamp, level, method, endpoint, status_code, message, duration_ms, ip_address)
+SELECT id, COALESCE(timestamp, CURRENT_TIMESTAMP), level, method, endpoint, status_code, message,
+       duration_ms, ip_address
+FROM api_logs_legacy;
+
+DROP TABLE api_logs_legacy;
+ALTER SEQUENCE api_logs_id_seq OWNED BY api_logs.id;
+
+CREATE INDEX IF NOT EXISTS idx_api_logs_timestamp ON api_logs(timestamp DESC);
+CREATE INDEX IF NOT EXISTS idx_api_logs_level ON api_logs(level);
@@ -0,0 +1,9 @@
+-- Keyset pagination and exports on (timestamp, id), optionally narrowed by level, endpoint or status code
+CREATE INDEX IF NOT EXISTS idx_api_logs_timestamp_id ON api_logs(timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_api_logs_level_timestamp ON api_logs(level, timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_api_logs_endpoint_timestamp ON api_logs(endpoint, timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_api_logs_status_timestamp ON api_logs(status_code, timestamp DESC, id DESC);
+
+-- Superseded by the composite indexes above
+DROP INDEX IF EXISTS idx_api_logs_timestamp;
+DROP INDEX IF EXISTS idx_api_logs_level;
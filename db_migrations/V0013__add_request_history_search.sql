@@ -0,0 +1,16 @@
+-- Full-text and substring search over request history prompts and responses
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- 'simple' keeps mixed Russian/English text searchable without stemming surprises
+ALTER TABLE request_history ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+    setweight(to_tsvector('simple', coalesce(left(user_message, 10000), '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(left(ai_response, 10000), '')), 'B')
+) STORED;
+
+-- fastupdate buffers new entries in a pending list so the proxy's batched inserts stay cheap
+CREATE INDEX IF NOT EXISTS idx_request_history_search ON request_history
+    USING GIN (search_vector) WITH (fastupdate = on, gin_pending_list_limit = 4096);
+CREATE INDEX IF NOT EXISTS idx_request_history_user_message_trgm ON request_history
+    USING GIN (user_message gin_trgm_ops) WITH (fastupdate = on);
+CREATE INDEX IF NOT EXISTS idx_request_history_ai_response_trgm ON request_history
+    USING GIN (ai_response gin_trgm_ops) WITH (fastupdate = on);
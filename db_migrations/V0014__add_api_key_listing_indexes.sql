@@ -0,0 +1,16 @@
+-- Keyset pagination of active keys on (created_at, id) and name search served by a trigram index
+CREATE INDEX IF NOT EXISTS idx_api_keys_active_created_id ON api_keys(created_at DESC, id DESC) WHERE is_active;
+CREATE INDEX IF NOT EXISTS idx_api_keys_name_trgm ON api_keys USING GIN (name gin_trgm_ops);
+
+-- Superseded by the partial index above
+DROP INDEX IF EXISTS idx_api_keys_active;
+
+-- Key listings read per-key request counts from key_daily_usage instead of api_keys.request_count.
+-- Requests counted before key_daily_usage existed are carried over onto the key's creation date.
+INSERT INTO key_daily_usage (key_id, date, requests, tokens)
+SELECT k.id, COALESCE(k.created_at::date, CURRENT_DATE), k.request_count - COALESCE(u.requests, 0), 0
+FROM api_keys k
+LEFT JOIN (SELECT key_id, SUM(requests) AS requests FROM key_daily_usage GROUP BY key_id) u ON u.key_id = k.id
+WHERE k.request_count > COALESCE(u.requests, 0)
+ON CONFLICT (key_id, date)
+DO UPDATE SET requests = key_daily_usage.requests + EXCLUDED.requests;
@@ -0,0 +1,3 @@
+-- The circuit breaker no longer disables webhooks; circuit_open_until alone marks an open circuit.
+-- Re-enable webhooks the breaker switched off so they receive new events again.
+UPDATE webhooks SET is_enabled = true WHERE NOT is_enabled AND circuit_open_until IS NOT NULL;
@@ -0,0 +1,9 @@
+-- Key listings page on (created_at, id), so every key needs a creation time.
+-- Keys without one get the earliest sign of use, or the migration time when there is none.
+UPDATE api_keys k
+SET created_at = COALESCE(
+    LEAST((SELECT min(u.date)::timestamp FROM key_daily_usage u WHERE u.key_id = k.id), k.last_used_at),
+    CURRENT_TIMESTAMP)
+WHERE k.created_at IS NULL;
+
+ALTER TABLE api_keys ALTER COLUMN created_at SET NOT NULL;
@@ -0,0 +1,37 @@
+-- A day whose rows already sit in the default partition cannot get its own partition while they are there:
+-- detach the default, create the day's partition, move the rows over and reattach the default
+CREATE OR REPLACE FUNCTION ensure_daily_partitions(parent TEXT, from_date DATE, to_date DATE) RETURNS INTEGER AS $$
+DECLARE
+    day DATE := from_date;
+    created INTEGER := 0;
+    partition_name TEXT;
+    default_name TEXT := parent || '_default';
+    stranded BOOLEAN;
+BEGIN
+    WHILE day <= to_date LOOP
+        partition_name := parent || '_p' || to_char(day, 'YYYYMMDD');
+        IF to_regclass(partition_name) IS NULL THEN
+            stranded := false;
+            IF to_regclass(default_name) IS NOT NULL THEN
+                EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE timestamp >= %L AND timestamp < %L)',
+                               default_name, day, day + 1) INTO stranded;
+            END IF;
+            IF stranded THEN
+                EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', parent, default_name);
+                EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                               partition_name, parent, day, day + 1);
+                EXECUTE format('WITH moved AS (DELETE FROM %I WHERE timestamp >= %L AND timestamp < %L RETURNING *) '
+                               'INSERT INTO %I SELECT * FROM moved',
+                               default_name, day, day + 1, partition_name);
+                EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I DEFAULT', parent, default_name);
+            ELSE
+                EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                               partition_name, parent, day, day + 1);
+            END IF;
+            created := created + 1;
+        END IF;
+        day := day + 1;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,2 @@
+-- Keys are looked up by key_digest and listed by key_prefix; the plaintext is only ever shown once, on creation
+ALTER TABLE api_keys DROP COLUMN IF EXISTS key_value;
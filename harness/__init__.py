@@ -0,0 +1 @@
+'''Replay and load harness for the backend functions; see harness/__main__.py'''
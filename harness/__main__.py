@@ -0,0 +1,343 @@
+'''
+Replay and load harness for the backend functions.
+
+    python -m harness replay [--functions proxy,history]
+    python -m harness load [--scenarios proxy,history] [--concurrency 1,8] [--keys 100]
+                           [--history-rows 0,100000] [--requests 500] [--latency-ms 0]
+                           [--output results.json] [--baseline old.json] [--max-regression 0.15]
+    python -m harness coldstart [--functions proxy,history] [--runs 10]
+    python -m harness upstreams [--strategies least_outstanding,ewma] [--requests 400] [--concurrency 8]
+    python -m harness hedging [--requests 400] [--concurrency 8]
+    python -m harness keepalive [--requests 400] [--concurrency 8]
+    python -m harness concurrency [--in-flight 8,64,512] [--requests 1000] [--latency-ms 1000]
+    python -m harness herd [--callers 50] [--rounds 10] [--latency-ms 200]
+    python -m harness partitions [--rows 1000000] [--repeats 20]
+    python -m harness keylookup [--keys 1000000] [--lookups 10000]
+    python -m harness pooling [--scenarios history,api-keys,proxy] [--concurrency 1,8] [--requests 500]
+
+replay and load run against a disposable PostgreSQL database with every migration
+applied (HARNESS_DATABASE_URL or initdb/pg_ctl on PATH) and a local stub in
+place of GPTunnel and webhook receivers. load writes machine-readable results
+and exits 1 when a baseline is given and any profile regressed. coldstart needs
+no database: it imports each handler in fresh interpreters and times the import,
+the first CORS preflight and steady-state preflights. upstreams needs no database
+either: it routes completions across several local stubs, some failing, and
+reports where they went and how the callers fared. hedging compares caller
+latency and upstream load with and without hedged completions. keepalive
+compares caller latency and upstream connections opened with and without
+keep-alive connections to the upstream. concurrency
+needs the database too: it offers completions to the sync and the asyncio
+proxy handler in one process against a slow stub and reports how many the
+stub held at once. herd sends bursts of identical completions to the proxy
+at the same instant, cached (coalesced) and uncached, and reports how many
+reached the stub. partitions times the history and logs range queries on
+the daily partitions and on an unpartitioned copy of a large table. keylookup
+times uncached API key lookups by digest at a large key count, next to the same
+lookups by plaintext. pooling runs load scenarios with the database connection
+pool on and off and reports connections opened per request.
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from typing import List, Optional
+
+from harness.coldstart import measure
+from harness.concurrency import HANDLERS, run_concurrency
+from harness.database import DisposableDatabase
+from harness.functions import QueryCounter
+from harness.herd import run_herd
+from harness.keys import run_key_lookup
+from harness.load import SCENARIOS, Fixture, compare, dump_results, run_pooling, run_profile
+from harness.partitions import run_partitions
+from harness.replay import discover_functions, replay
+from harness.stub_server import StubServer
+from harness.upstreams import run_hedging, run_keepalive, run_upstreams
+
+
+def _csv(value: str) -> List[str]:
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def _ints(value: str) -> List[int]:
+    return [int(item) for item in _csv(value)]
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def _run_replay(args: argparse.Namespace) -> int:
+    results = replay(_csv(args.functions) if args.functions else discover_functions())
+    for result in results:
+        mark = 'ok  ' if result['passed'] else 'FAIL'
+        print(f"{mark} {result['function']}: {result['name']}" + (f" - {result['reason']}" if result['reason'] else ''))
+    failed = sum(1 for result in results if not result['passed'])
+    print(f'{len(results) - failed} passed, {failed} failed')
+    return 1 if failed else 0
+
+
+def _run_coldstart(args: argparse.Namespace) -> int:
+    results = [measure(function, args.runs) for function in (_csv(args.functions) or discover_functions())]
+    for result in results:
+        print(f"{result['function']:10} import={result['importMs']}ms first={result['firstPreflightMs']}ms "
+              f"preflight={result['preflightUs']}us loaded={','.join(result['modulesLoaded']) or '-'}",
+              file=sys.stderr)
+    print(json.dumps({'revision': _git_revision(), 'python': platform.python_version(), 'results': results},
+                     indent=2))
+    return 0
+
+
+def _run_upstreams(args: argparse.Namespace) -> int:
+    results = [run_upstreams(strategy, args.requests, args.concurrency) for strategy in _csv(args.strategies)]
+    for result in results:
+        for phase in result['phases']:
+            served = ' '.join(f'{name}={count}' for name, count in phase['served'].items())
+            print(f"{result['strategy']:17} {phase['phase']:12} p50={phase['latencyMs']['p50']}ms "
+                  f"p99={phase['latencyMs']['p99']}ms statuses={phase['statuses']} served: {served}",
+                  file=sys.stderr)
+    print(json.dumps({'revision': _git_revision(), 'python': platform.python_version(), 'results': results},
+                     indent=2))
+    return 0
+
+
+def _run_hedging(args: argparse.Namespace) -> int:
+    results = [run_hedging(hedge, args.requests, args.concurrency) for hedge in (False, True)]
+    for result in results:
+        print(f"hedge={'on ' if result['hedge'] else 'off'} p50={result['latencyMs']['p50']}ms "
+              f"p99={result['latencyMs']['p99']}ms statuses={result['statuses']} "
+              f"upstream={result['upstreamCompletions']} hedges={result['hedges']} wins={result['hedgeWins']}",
+              file=sys.stderr)
+    print(json.dumps({'revision': _git_revision(), 'python': platform.python_version(), 'results': results},
+                     indent=2))
+    return 0
+
+
+def _run_keepalive(args: argparse.Namespace) -> int:
+    results = [run_keepalive(keepalive, args.requests, args.concurrency) for keepalive in (True, False)]
+    for result in results:
+        print(f"keepalive={'on ' if result['keepalive'] else 'off'} p50={result['latencyMs']['p50']}ms "
+              f"p99={result['latencyMs']['p99']}ms statuses={result['statuses']} "
+              f"completions={result['upstreamCompletions']} connections={result['upstreamConnections']}",
+              file=sys.stderr)
+    print(json.dumps({'revision': _git_revision(), 'python': platform.python_version(), 'results': results},
+                     indent=2))
+    return 0
+
+
+def _run_concurrency(args: argparse.Namespace, database: DisposableDatabase, stub: StubServer) -> int:
+    fixture = Fixture(database.url, stub.webhook_url)
+    results = []
+    for in_flight in _ints(args.in_flight):
+        for mode in HANDLERS:
+            result = run_concurrency(fixture, stub, mode, in_flight, args.requests)
+            results.append(result)
+            print(f"{mode:5} in_flight={in_flight:<4} peak={result['peakInFlight']:<4} "
+                  f"{result['throughputRps']:>9} rps  p50={result['latencyMs']['p50']}ms "
+                  f"p99={result['latencyMs']['p99']}ms statuses={result['statuses']}", file=sys.stderr)
+    print(json.dumps({'revision': _git_revision(), 'python': platform.python_version(), 'results': results},
+                     indent=2))
+    return 0
+
+
+def _run_herd(args: argparse.Namespace, database: DisposableDatabase, stub: StubServer) -> int:
+    fixture = Fixture(database.url, stub.webhook_url)
+    results = [run_herd(fixture, stub, cache, args.callers, args.rounds) for cache in (True, False)]
+    for result in results:
+        print(f"cache={'on ' if result['cache'] else 'off'} requests={result['requests']} "
+              f"upstream={result['upstreamCompletions']} x-cache={result['xCache']} "
+              f"p50={result['latencyMs']['p50']}ms p99={result['latencyMs']['p99']}ms "
+              f"statuses={result['statuses']}", file=sys.stderr)
+    print(json.dumps({'revision': _git_revision(), 'python': platform.python_version(), 'results': results},
+                     indent=2))
+    return 0
+
+
+def _run_partitions(args: argparse.Namespace, database: DisposableDatabase, stub: StubServer) -> int:
+    results = run_partitions(Fixture(database.url, stub.webhook_url), args.rows, args.repeats)
+    for result in results:
+        print(f"{result['query']:17} {result['window']:>3} {result['layout']:11} "
+              f"scanned={result['relationsScanned']:<3}/{result['partitions']:<3} "
+              f"p50={result['latencyMs']['p50']}ms p99={result['latencyMs']['p99']}ms", file=sys.stderr)
+    print(json.dumps({'revision': _git_revision(), 'python': platform.python_version(), 'results': results},
+                     indent=2))
+    return 0
+
+
+def _run_keylookup(args: argparse.Namespace, database: DisposableDatabase, stub: StubServer) -> int:
+    results = run_key_lookup(Fixture(database.url, stub.webhook_url), args.keys, args.lookups)
+    for result in results:
+        print(f"{result['layout']:9} {result['outcome']:4} keys={result['keys']} index={result['index']} "
+              f"p50={result['latencyMs']['p50']}ms p99={result['latencyMs']['p99']}ms", file=sys.stderr)
+    print(json.dumps({'revision': _git_revision(), 'python': platform.python_version(), 'results': results},
+                     indent=2))
+    return 0
+
+
+def _run_pooling(args: argparse.Namespace, database: DisposableDatabase, stub: StubServer,
+                 counter: QueryCounter) -> int:
+    fixture = Fixture(database.url, stub.webhook_url)
+    results = []
+    for scenario in _csv(args.scenarios):
+        for concurrency in _ints(args.concurrency):
+            for pooled in (True, False):
+                result = run_pooling(fixture, counter, scenario, pooled, concurrency, args.keys, args.requests,
+                                     args.warmup)
+                results.append(result)
+                print(f"{scenario:18} c={concurrency:<3} pool={'on ' if pooled else 'off'} "
+                      f"{result['throughputRps']:>9} rps  p50={result['latencyMs']['p50']}ms "
+                      f"p99={result['latencyMs']['p99']}ms  conn/req={result['connectionsPerRequest']}  "
+                      f"errors={result['errors']}", file=sys.stderr)
+    print(json.dumps({'revision': _git_revision(), 'python': platform.python_version(), 'results': results},
+                     indent=2))
+    return 0
+
+
+def _run_load(args: argparse.Namespace, database: DisposableDatabase, stub: StubServer,
+              counter: QueryCounter) -> int:
+    scenarios = _csv(args.scenarios) if args.scenarios else list(SCENARIOS)
+    unknown = sorted(set(scenarios) - set(SCENARIOS))
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(unknown)}; available: {', '.join(SCENARIOS)}", file=sys.stderr)
+        return 2
+
+    fixture = Fixture(database.url, stub.webhook_url)
+    results = []
+    for history_rows in sorted(_ints(args.history_rows)):
+        for scenario in scenarios:
+            for concurrency in _ints(args.concurrency):
+                result = run_profile(fixture, counter, scenario, concurrency, args.keys, history_rows,
+                                     args.requests, args.warmup)
+                results.append(result)
+                print(f"{scenario:18} c={concurrency:<3} rows={history_rows:<8} "
+                      f"{result['throughputRps']:>9} rps  p50={result['latencyMs']['p50']}ms "
+                      f"p99={result['latencyMs']['p99']}ms  q/req={result['queriesPerRequest']}  "
+                      f"alloc={result['allocPeakKibPerRequest']}KiB  errors={result['errors']}")
+
+    output = dump_results(results, {
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'stubLatencyMs': args.latency_ms,
+        'requests': args.requests
+    })
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m harness', description='Replay and load harness')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    replay_parser = commands.add_parser('replay', help='run every tests.json case against its handler')
+    replay_parser.add_argument('--functions', default='')
+
+    load_parser = commands.add_parser('load', help='run load profiles and report throughput and latency')
+    load_parser.add_argument('--scenarios', default='')
+    load_parser.add_argument('--concurrency', default='1,8')
+    load_parser.add_argument('--keys', type=int, default=100)
+    load_parser.add_argument('--history-rows', default='0,100000')
+    load_parser.add_argument('--requests', type=int, default=500)
+    load_parser.add_argument('--warmup', type=int, default=20)
+    load_parser.add_argument('--latency-ms', type=float, default=0.0)
+    load_parser.add_argument('--output', default='')
+    load_parser.add_argument('--baseline', default='')
+    load_parser.add_argument('--max-regression', type=float, default=0.15)
+
+    coldstart_parser = commands.add_parser('coldstart', help='time handler imports and CORS preflights')
+    coldstart_parser.add_argument('--functions', default='')
+    coldstart_parser.add_argument('--runs', type=int, default=10)
+
+    upstreams_parser = commands.add_parser('upstreams', help='route completions across local stub upstreams')
+    upstreams_parser.add_argument('--strategies', default='least_outstanding,ewma')
+    upstreams_parser.add_argument('--requests', type=int, default=400)
+    upstreams_parser.add_argument('--concurrency', type=int, default=8)
+
+    hedging_parser = commands.add_parser('hedging', help='compare hedged and unhedged completions on slow stubs')
+    hedging_parser.add_argument('--requests', type=int, default=400)
+    hedging_parser.add_argument('--concurrency', type=int, default=8)
+
+    keepalive_parser = commands.add_parser('keepalive',
+                                           help='compare keep-alive and fresh upstream connections')
+    keepalive_parser.add_argument('--requests', type=int, default=400)
+    keepalive_parser.add_argument('--concurrency', type=int, default=8)
+
+    concurrency_parser = commands.add_parser('concurrency',
+                                             help='compare in-flight completions of the sync and asyncio proxy')
+    concurrency_parser.add_argument('--in-flight', default='8,64,512')
+    concurrency_parser.add_argument('--requests', type=int, default=1000)
+    concurrency_parser.add_argument('--latency-ms', type=float, default=1000.0)
+
+    herd_parser = commands.add_parser('herd', help='count upstream calls for bursts of identical completions')
+    herd_parser.add_argument('--callers', type=int, default=50)
+    herd_parser.add_argument('--rounds', type=int, default=10)
+    herd_parser.add_argument('--latency-ms', type=float, default=200.0)
+
+    partitions_parser = commands.add_parser('partitions',
+                                            help='compare range queries on partitioned and unpartitioned tables')
+    partitions_parser.add_argument('--rows', type=int, default=1000000)
+    partitions_parser.add_argument('--repeats', type=int, default=20)
+
+    keylookup_parser = commands.add_parser('keylookup', help='time uncached API key lookups by digest')
+    keylookup_parser.add_argument('--keys', type=int, default=1000000)
+    keylookup_parser.add_argument('--lookups', type=int, default=10000)
+
+    pooling_parser = commands.add_parser('pooling',
+                                         help='compare pooled and connect-per-request database access')
+    pooling_parser.add_argument('--scenarios', default='history,api-keys,proxy')
+    pooling_parser.add_argument('--concurrency', default='1,8')
+    pooling_parser.add_argument('--keys', type=int, default=100)
+    pooling_parser.add_argument('--requests', type=int, default=500)
+    pooling_parser.add_argument('--warmup', type=int, default=20)
+
+    args = parser.parse_args(argv)
+    if args.command == 'coldstart':
+        return _run_coldstart(args)
+    if args.command == 'upstreams':
+        return _run_upstreams(args)
+    if args.command == 'hedging':
+        return _run_hedging(args)
+    if args.command == 'keepalive':
+        return _run_keepalive(args)
+    counter = QueryCounter()
+    with DisposableDatabase() as database, StubServer(getattr(args, 'latency_ms', 0.0)) as stub:
+        os.environ['DATABASE_URL'] = database.url
+        os.environ['GPTUNNEL_URL'] = stub.completions_url
+        os.environ['GPTUNNEL_API_KEY'] = 'harness'
+        counter.install()
+        try:
+            if args.command == 'replay':
+                return _run_replay(args)
+            if args.command == 'concurrency':
+                return _run_concurrency(args, database, stub)
+            if args.command == 'herd':
+                return _run_herd(args, database, stub)
+            if args.command == 'partitions':
+                return _run_partitions(args, database, stub)
+            if args.command == 'keylookup':
+                return _run_keylookup(args, database, stub)
+            if args.command == 'pooling':
+                return _run_pooling(args, database, stub, counter)
+            return _run_load(args, database, stub, counter)
+        finally:
+            counter.uninstall()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List
+
+from harness.functions import BACKEND_DIR
+
+COLDSTART_SCRIPT = '''
+import importlib.util, json, sys, time
+folder, requests = sys.argv[1], int(sys.argv[2])
+started = time.perf_counter()
+sys.path.insert(0, folder)
+spec = importlib.util.spec_from_file_location('index', folder + '/index.py')
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+imported = time.perf_counter()
+event = {'httpMethod': 'OPTIONS', 'path': '/', 'headers': {}, 'queryStringParameters': {},
+         'body': None, 'isBase64Encoded': False, 'requestContext': {'requestId': 'coldstart'}}
+module.handler(event, None)
+first = time.perf_counter()
+samples = []
+for _ in range(requests):
+    t = time.perf_counter()
+    module.handler(event, None)
+    samples.append(time.perf_counter() - t)
+samples.sort()
+print(json.dumps({
+    'importMs': (imported - started) * 1000,
+    'firstPreflightMs': (first - imported) * 1000,
+    'preflightUs': samples[len(samples) // 2] * 1e6,
+    'modules': sorted(name for name in ('psycopg2', 'requests', 'orjson') if name in sys.modules)
+}))
+'''
+
+
+def measure(function: str, runs: int = 10, requests: int = 2000) -> Dict[str, Any]:
+    '''
+    Import a handler in fresh interpreters and answer CORS preflights with it.
+    Reports medians over runs of the import time, the first preflight and the
+    per-request preflight latency, plus which heavy modules ended up loaded.
+    '''
+    env = {**os.environ, 'REQUEST_LOG_ENABLED': '0'}
+    samples: List[Dict[str, Any]] = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', COLDSTART_SCRIPT, str(BACKEND_DIR / function), str(requests)],
+                                capture_output=True, text=True, check=True, env=env).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        'function': function,
+        'runs': runs,
+        'importMs': round(statistics.median(s['importMs'] for s in samples), 2),
+        'firstPreflightMs': round(statistics.median(s['firstPreflightMs'] for s in samples), 3),
+        'preflightUs': round(statistics.median(s['preflightUs'] for s in samples), 2),
+        'modulesLoaded': samples[-1]['modules']
+    }
@@ -0,0 +1,77 @@
+import asyncio
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+from harness.functions import build_event, call_async, event_loop, load_handler, read_body
+from harness.load import Fixture, _completion_body, _percentile
+from harness.stub_server import StubServer
+
+HANDLERS = {'sync': 'proxy', 'async': 'proxy/async_index'}
+
+
+def run_concurrency(fixture: Fixture, stub: StubServer, mode: str, in_flight: int, requests: int,
+                    keys: int = 100, seed: int = 1) -> Dict[str, Any]:
+    '''
+    Offer requests completions to one proxy handler in this process, at most
+    in_flight at a time, while the stub upstream holds every completion for its
+    latency. The sync handler gets in_flight worker threads, the async one
+    in_flight coroutines on a single event loop. Reports how many completions
+    the stub saw at once, throughput and caller latency.
+    '''
+    fixture.ensure_keys(keys)
+    handler = load_handler(HANDLERS[mode])
+    rng = random.Random(seed)
+    events = [build_event('POST', '/', _completion_body(rng), {'X-Api-Key': fixture.api_keys[rng.randrange(keys)]})
+              for _ in range(requests)]
+    handler(dict(events[0]), None)
+    stub.peak_in_flight = stub.in_flight
+
+    if mode == 'async':
+        coroutine = handler.coroutine
+
+        async def drive() -> List[Tuple[float, int]]:
+            semaphore = asyncio.Semaphore(in_flight)
+
+            async def call(event: Dict[str, Any]) -> Tuple[float, int]:
+                async with semaphore:
+                    started = time.perf_counter()
+                    response = await call_async(coroutine, event, None)
+                    return (time.perf_counter() - started) * 1000, response['statusCode']
+
+            return await asyncio.gather(*(call(event) for event in events))
+
+        started = time.perf_counter()
+        samples = asyncio.run_coroutine_threadsafe(drive(), event_loop()).result()
+    else:
+        def call(event: Dict[str, Any]) -> Tuple[float, int]:
+            started = time.perf_counter()
+            response = handler(event, None)
+            read_body(response)
+            return (time.perf_counter() - started) * 1000, response['statusCode']
+
+        with ThreadPoolExecutor(max_workers=in_flight) as executor:
+            started = time.perf_counter()
+            samples = list(executor.map(call, events))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, _ in samples]
+    statuses: Dict[str, int] = {}
+    for _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'mode': mode,
+        'inFlight': in_flight,
+        'requests': requests,
+        'stubLatencyMs': stub.latency_ms,
+        'peakInFlight': stub.peak_in_flight,
+        'throughputRps': round(requests / elapsed, 2) if elapsed else 0.0,
+        'latencyMs': {
+            'p50': round(_percentile(latencies, 0.5), 3),
+            'p99': round(_percentile(latencies, 0.99), 3),
+            'mean': round(statistics.fmean(latencies), 3) if latencies else 0.0
+        },
+        'statuses': statuses
+    }
@@ -0,0 +1,104 @@
+import os
+import re
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlsplit, urlunsplit
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+MIGRATIONS_DIR = Path(__file__).resolve().parent.parent / 'db_migrations'
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class DisposableDatabase:
+    '''
+    Throwaway PostgreSQL database with every migration applied.
+    With HARNESS_DATABASE_URL set, a fresh database is created on that server and
+    dropped afterwards; otherwise a private cluster is started with initdb/pg_ctl
+    from PATH in a temporary directory and removed on close.
+    '''
+
+    def __init__(self, server_url: Optional[str] = None):
+        self._server_url = server_url or os.environ.get('HARNESS_DATABASE_URL')
+        self._cluster_dir: Optional[str] = None
+        self._database_name = f'harness_{os.getpid()}_{int(time.time())}'
+        self.url = ''
+
+    def __enter__(self) -> 'DisposableDatabase':
+        if self._server_url is None:
+            self._server_url = self._start_cluster()
+        self._create_database()
+        self.url = self._database_url(self._database_name)
+        self.migrate()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def migrate(self) -> None:
+        '''Apply db_migrations/V*.sql in version order'''
+        migrations = sorted(MIGRATIONS_DIR.glob('V*__*.sql'), key=lambda p: int(re.match(r'V(\d+)', p.name).group(1)))
+        conn = psycopg2.connect(self.url)
+        try:
+            with conn.cursor() as cur:
+                for migration in migrations:
+                    cur.execute(migration.read_text())
+            conn.commit()
+        finally:
+            conn.close()
+
+    def close(self) -> None:
+        if self._server_url and self.url:
+            conn = psycopg2.connect(self._database_url('postgres'))
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT pg_terminate_backend(pid) FROM pg_stat_activity
+                        WHERE datname = %s AND pid <> pg_backend_pid()
+                    """, (self._database_name,))
+                    cur.execute(f'DROP DATABASE IF EXISTS "{self._database_name}"')
+            finally:
+                conn.close()
+            self.url = ''
+        if self._cluster_dir:
+            subprocess.run(['pg_ctl', '-D', os.path.join(self._cluster_dir, 'data'), '-m', 'immediate', 'stop'],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            shutil.rmtree(self._cluster_dir, ignore_errors=True)
+            self._cluster_dir = None
+
+    def _create_database(self) -> None:
+        conn = psycopg2.connect(self._database_url('postgres'))
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f'CREATE DATABASE "{self._database_name}"')
+        finally:
+            conn.close()
+
+    def _database_url(self, name: str) -> str:
+        parts = urlsplit(self._server_url)
+        return urlunsplit((parts.scheme, parts.netloc, f'/{name}', parts.query, parts.fragment))
+
+    def _start_cluster(self) -> str:
+        if shutil.which('initdb') is None or shutil.which('pg_ctl') is None:
+            raise RuntimeError('initdb/pg_ctl not found; install PostgreSQL or set HARNESS_DATABASE_URL')
+        self._cluster_dir = tempfile.mkdtemp(prefix='harness-pg-')
+        data_dir = os.path.join(self._cluster_dir, 'data')
+        port = _free_port()
+        subprocess.run(['initdb', '-D', data_dir, '-U', 'postgres', '-A', 'trust', '--no-sync'],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run(['pg_ctl', '-D', data_dir, '-w', '-l', os.path.join(self._cluster_dir, 'postgres.log'),
+                        '-o', f'-p {port} -k {self._cluster_dir} -c fsync=off -c max_connections=300', 'start'],
+                       check=True, stdout=subprocess.DEVNULL)
+        return f'postgresql://postgres@127.0.0.1:{port}/postgres'
@@ -0,0 +1,207 @@
+import asyncio
+import importlib.util
+import inspect
+import json
+import sys
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+import psycopg2
+import psycopg2.extensions
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+
+
+class QueryCounter:
+    '''Counts connections opened after install() and the statements they send'''
+
+    def __init__(self):
+        self.count = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._cursor_classes: Dict[type, type] = {}
+        self._connection_classes: Dict[type, type] = {}
+        self._connect: Optional[Callable[..., Any]] = None
+
+    def install(self) -> None:
+        if self._connect is not None:
+            return
+        self._connect = original_connect = psycopg2.connect
+
+        def connect(*args: Any, **kwargs: Any) -> Any:
+            with self._lock:
+                self.connections += 1
+            factory = kwargs.get('connection_factory') or psycopg2.extensions.connection
+            kwargs['connection_factory'] = self._counting_connection(factory)
+            return original_connect(*args, **kwargs)
+
+        psycopg2.connect = connect
+
+    def uninstall(self) -> None:
+        if self._connect is not None:
+            psycopg2.connect = self._connect
+            self._connect = None
+
+    def reset(self) -> int:
+        with self._lock:
+            count, self.count = self.count, 0
+        return count
+
+    def reset_connections(self) -> int:
+        with self._lock:
+            connections, self.connections = self.connections, 0
+        return connections
+
+    def _counting_connection(self, factory: type) -> type:
+        with self._lock:
+            connection_class = self._connection_classes.get(factory)
+            if connection_class is None:
+                counter = self
+
+                def cursor(connection: Any, *args: Any, **kwargs: Any) -> Any:
+                    cursor_factory = (kwargs.get('cursor_factory') or connection.cursor_factory
+                                      or psycopg2.extensions.cursor)
+                    kwargs['cursor_factory'] = counter._counting_cursor(cursor_factory)
+                    return factory.cursor(connection, *args, **kwargs)
+
+                connection_class = self._connection_classes[factory] = type(
+                    f'Counting{factory.__name__}', (factory,), {'cursor': cursor})
+        return connection_class
+
+    def _counting_cursor(self, factory: type) -> type:
+        cursor_class = self._cursor_classes.get(factory)
+        if cursor_class is None:
+            counter = self
+
+            def execute(cursor: Any, query: Any, vars: Any = None) -> Any:
+                with counter._lock:
+                    counter.count += 1
+                return factory.execute(cursor, query, vars)
+
+            cursor_class = self._cursor_classes[factory] = type(f'Counting{factory.__name__}', (factory,),
+                                                               {'execute': execute})
+        return cursor_class
+
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def event_loop() -> asyncio.AbstractEventLoop:
+    '''Background event loop shared by every coroutine handler the harness calls'''
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='harness-loop', daemon=True).start()
+        return _loop
+
+
+async def call_async(handler: Callable[..., Any], event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''Await a coroutine handler and drain an async iterator body on the loop it was made on'''
+    response = await handler(event, context)
+    body = response.get('body')
+    if hasattr(body, '__aiter__'):
+        response = {**response, 'body': ''.join([chunk async for chunk in body])}
+    return response
+
+
+def _blocking(handler: Callable[..., Any]) -> Callable[[Dict[str, Any], Any], Dict[str, Any]]:
+    def call(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        return asyncio.run_coroutine_threadsafe(call_async(handler, event, context), event_loop()).result()
+
+    call.__wrapped__ = handler.__wrapped__
+    call.coroutine = handler
+    return call
+
+
+def load_handler(function: str) -> Callable[[Dict[str, Any], Any], Dict[str, Any]]:
+    '''
+    Import backend/<function>/index.py as its own module; "proxy/async_index"
+    names another entry module of the folder. Sibling modules are imported
+    from the function folder and then unregistered, so folders that ship
+    modules with the same name do not see each other's copies. A coroutine
+    handler is returned as a blocking callable that runs it on event_loop(),
+    with the coroutine itself as its coroutine attribute.
+    '''
+    function, _, entry = function.partition('/')
+    entry = entry or 'index'
+    folder = BACKEND_DIR / function
+    before = set(sys.modules)
+    sys.path.insert(0, str(folder))
+    try:
+        spec = importlib.util.spec_from_file_location(f'harness_{function.replace("-", "_")}_{entry}',
+                                                      folder / f'{entry}.py')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(folder))
+        for name in set(sys.modules) - before:
+            path = getattr(sys.modules[name], '__file__', None) or ''
+            if Path(path).resolve().parent == folder.resolve():
+                del sys.modules[name]
+    if inspect.iscoroutinefunction(module.handler):
+        return _blocking(module.handler)
+    return module.handler
+
+
+def build_event(method: str, path: str = '/', body: Any = None,
+                headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    '''Cloud function event for an HTTP request, as the platform would deliver it'''
+    parts = urlsplit(path or '/')
+    return {
+        'httpMethod': method,
+        'path': parts.path or '/',
+        'headers': dict(headers or {}),
+        'queryStringParameters': dict(parse_qsl(parts.query)),
+        'body': body if isinstance(body, str) or body is None else json.dumps(body),
+        'isBase64Encoded': False,
+        'requestContext': {'requestId': 'harness'}
+    }
+
+
+def read_body(response: Dict[str, Any]) -> str:
+    '''Drain iterator bodies so streamed responses are fully consumed'''
+    body = response.get('body', '')
+    if isinstance(body, str):
+        return body
+    return ''.join(body)
+
+
+def matches(expected: Any, actual: Any, partial: bool = True) -> Tuple[bool, str]:
+    '''
+    Compare a response body with a tests.json expectation. The type names
+    "string", "number" and "boolean" match any value of that type; [] and {}
+    match any list or object; objects are compared key by key when partial.
+    '''
+    type_names = {'string': str, 'number': (int, float), 'boolean': bool}
+    if isinstance(expected, str) and expected in type_names:
+        ok = isinstance(actual, type_names[expected])
+        return ok, '' if ok else f'expected {expected}, got {actual!r}'
+    if isinstance(expected, dict):
+        if not isinstance(actual, dict):
+            return False, f'expected object, got {actual!r}'
+        if not partial and set(expected) != set(actual):
+            return False, f'expected keys {sorted(expected)}, got {sorted(actual)}'
+        for key, value in expected.items():
+            if key not in actual:
+                return False, f'missing key {key!r}'
+            ok, reason = matches(value, actual[key], partial)
+            if not ok:
+                return False, f'{key}: {reason}'
+        return True, ''
+    if isinstance(expected, list):
+        if not isinstance(actual, list):
+            return False, f'expected list, got {actual!r}'
+        if not expected:
+            return True, ''
+        if len(actual) < len(expected):
+            return False, f'expected at least {len(expected)} items, got {len(actual)}'
+        for i, value in enumerate(expected):
+            ok, reason = matches(value, actual[i], partial)
+            if not ok:
+                return False, f'[{i}]: {reason}'
+        return True, ''
+    ok = expected == actual
+    return ok, '' if ok else f'expected {expected!r}, got {actual!r}'
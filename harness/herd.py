@@ -0,0 +1,72 @@
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+from harness.functions import build_event, load_handler, read_body
+from harness.load import Fixture, _percentile
+from harness.stub_server import StubServer
+
+
+def run_herd(fixture: Fixture, stub: StubServer, cache: bool, callers: int, rounds: int,
+             keys: int = 100, seed: int = 1) -> Dict[str, Any]:
+    '''
+    Send callers identical completions to the proxy at the same instant,
+    rounds times with a new prompt each round, while the stub holds every
+    completion for its latency. With cache on the proxy coalesces each round
+    into one upstream call; with cache off every caller reaches the stub.
+    Reports the stub's completions against the requests sent and the X-Cache
+    answers the callers got.
+    '''
+    fixture.ensure_keys(keys)
+    handler = load_handler('proxy')
+    rng = random.Random(seed)
+    handler(build_event('POST', '/', {'model': 'gpt-4o-mini', 'messages': [{'role': 'user', 'content': 'Warm up'}]},
+                        {'X-Api-Key': fixture.api_keys[0]}), None)
+
+    samples: List[Tuple[float, int, str]] = []
+    per_round = []
+    with ThreadPoolExecutor(max_workers=callers) as executor:
+        for i in range(rounds):
+            body = {'model': 'gpt-4o-mini', 'cache': cache,
+                    'messages': [{'role': 'user', 'content': f'Herd question {seed}-{i}-{rng.randrange(1 << 30)}'}]}
+            events = [build_event('POST', '/', body, {'X-Api-Key': fixture.api_keys[rng.randrange(keys)]})
+                      for _ in range(callers)]
+            barrier = threading.Barrier(callers)
+
+            def call(event: Dict[str, Any]) -> Tuple[float, int, str]:
+                barrier.wait()
+                started = time.perf_counter()
+                response = handler(event, None)
+                read_body(response)
+                return ((time.perf_counter() - started) * 1000, response['statusCode'],
+                        response['headers'].get('X-Cache', '-'))
+
+            before = stub.completions
+            samples.extend(executor.map(call, events))
+            per_round.append(stub.completions - before)
+
+    latencies = [latency for latency, _, _ in samples]
+    statuses: Dict[str, int] = {}
+    cache_answers: Dict[str, int] = {}
+    for _, status, cache_answer in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        cache_answers[cache_answer] = cache_answers.get(cache_answer, 0) + 1
+    return {
+        'cache': cache,
+        'callers': callers,
+        'rounds': rounds,
+        'requests': len(samples),
+        'stubLatencyMs': stub.latency_ms,
+        'upstreamCompletions': sum(per_round),
+        'upstreamCompletionsPerRound': per_round,
+        'xCache': cache_answers,
+        'latencyMs': {
+            'p50': round(_percentile(latencies, 0.5), 3),
+            'p99': round(_percentile(latencies, 0.99), 3),
+            'mean': round(statistics.fmean(latencies), 3) if latencies else 0.0
+        },
+        'statuses': statuses
+    }
@@ -0,0 +1,118 @@
+import hashlib
+import random
+import statistics
+import time
+from typing import Any, Dict, List
+import psycopg2
+
+from harness.load import Fixture, _percentile
+
+KEY_LOOKUP = """
+    SELECT id, name, is_active, rate_limit_rpm, daily_token_limit
+    FROM api_keys
+    WHERE key_digest = %s
+"""
+PLAINTEXT_LOOKUP = """
+    SELECT id, name, is_active, rate_limit_rpm, daily_token_limit
+    FROM api_keys_plaintext
+    WHERE key_value = %s
+"""
+
+
+def _bench_key(n: int) -> str:
+    return f'sk_bench_{n:012d}'
+
+
+def _seed_keys(conn: Any, count: int) -> int:
+    '''Grow the harness key set to count keys and keep a plaintext-keyed copy to compare against'''
+    with conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM api_keys WHERE id LIKE 'key_bench_%%'")
+        have = cur.fetchone()[0]
+        if have < count:
+            cur.execute("""
+                INSERT INTO api_keys (id, name, key_digest, key_prefix, created_at)
+                SELECT 'key_bench_' || n, 'Bench key ' || n,
+                       sha256(convert_to('sk_bench_' || lpad(n::text, 12, '0'), 'UTF8')),
+                       left('sk_bench_' || lpad(n::text, 12, '0'), 12),
+                       LOCALTIMESTAMP - n * INTERVAL '1 second'
+                FROM generate_series(%s, %s) AS n
+            """, (have + 1, count))
+        cur.execute("DROP TABLE IF EXISTS api_keys_plaintext")
+        cur.execute("""
+            CREATE TABLE api_keys_plaintext AS
+            SELECT id, name, 'sk_bench_' || lpad(substr(id, 11), 12, '0') AS key_value, is_active,
+                   rate_limit_rpm, daily_token_limit
+            FROM api_keys
+            WHERE id LIKE 'key_bench_%%'
+        """)
+        cur.execute("ALTER TABLE api_keys_plaintext ADD PRIMARY KEY (id)")
+        cur.execute("CREATE UNIQUE INDEX api_keys_plaintext_key_value ON api_keys_plaintext (key_value)")
+        cur.execute("ANALYZE api_keys")
+        cur.execute("ANALYZE api_keys_plaintext")
+        cur.execute("SELECT count(*) FROM api_keys")
+        total = cur.fetchone()[0]
+    conn.commit()
+    return total
+
+
+def _index_of(conn: Any, query: str, param: Any) -> str:
+    with conn.cursor() as cur:
+        cur.execute('EXPLAIN (FORMAT JSON) ' + query, (param,))
+        plan = cur.fetchone()[0][0]['Plan']
+    conn.rollback()
+    while 'Index Name' not in plan and plan.get('Plans'):
+        plan = plan['Plans'][0]
+    return plan.get('Index Name') or plan['Node Type']
+
+
+def _time_lookups(conn: Any, query: str, params: List[Any]) -> List[float]:
+    timings = []
+    with conn.cursor() as cur:
+        for param in params:
+            started = time.perf_counter()
+            cur.execute(query, (param,))
+            cur.fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+    conn.rollback()
+    return timings
+
+
+def run_key_lookup(fixture: Fixture, keys: int, lookups: int, seed: int = 7) -> List[Dict[str, Any]]:
+    '''
+    Seed keys API keys, then time the proxy's uncached key lookup by
+    key_digest, for existing and unknown keys, straight against the database
+    so the proxy's key cache plays no part. The same lookups by plaintext on a
+    copy keyed by key_value show what the digest column costs or saves.
+    '''
+    conn = psycopg2.connect(fixture.database_url)
+    try:
+        total = _seed_keys(conn, keys)
+        rng = random.Random(seed)
+        known = [_bench_key(rng.randint(1, keys)) for _ in range(lookups)]
+        unknown = [_bench_key(keys + rng.randint(1, keys)) for _ in range(lookups)]
+
+        results = []
+        for layout, query, encode in (('digest', KEY_LOOKUP, lambda key: hashlib.sha256(key.encode()).digest()),
+                                      ('plaintext', PLAINTEXT_LOOKUP, lambda key: key)):
+            for outcome, sample in (('hit', known), ('miss', unknown)):
+                params = [encode(key) for key in sample]
+                _time_lookups(conn, query, params[:min(len(params), 100)])
+                timings = _time_lookups(conn, query, params)
+                results.append({
+                    'layout': layout,
+                    'outcome': outcome,
+                    'keys': total,
+                    'lookups': len(timings),
+                    'index': _index_of(conn, query, params[0]),
+                    'latencyMs': {
+                        'p50': round(_percentile(timings, 0.5), 4),
+                        'p99': round(_percentile(timings, 0.99), 4),
+                        'mean': round(statistics.fmean(timings), 4)
+                    }
+                })
+        with conn.cursor() as cur:
+            cur.execute("DROP TABLE api_keys_plaintext")
+        conn.commit()
+        return results
+    finally:
+        conn.close()
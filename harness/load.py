@@ -0,0 +1,277 @@
+import base64
+import hashlib
+import json
+import os
+import random
+import secrets
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Tuple
+import psycopg2
+from psycopg2.extras import execute_values
+
+from harness.functions import QueryCounter, build_event, load_handler, read_body
+
+ALLOCATION_SAMPLE = 200
+HISTORY_DAYS = 30
+
+
+class Fixture:
+    '''Seeded database state shared by the load scenarios'''
+
+    def __init__(self, database_url: str, webhook_url: str):
+        self.database_url = database_url
+        self.webhook_url = webhook_url
+        self.api_keys: List[str] = []
+        self.history_rows = 0
+
+    def ensure_keys(self, count: int) -> None:
+        '''Create API keys until at least count exist'''
+        missing = count - len(self.api_keys)
+        if missing <= 0:
+            return
+        keys = [f'sk_live_{secrets.token_urlsafe(20)}' for _ in range(missing)]
+        rows = [(f'key_{secrets.token_hex(8)}', f'Harness key {len(self.api_keys) + i}',
+                 hashlib.sha256(key.encode()).digest(), key[:12]) for i, key in enumerate(keys)]
+        self._execute_values("""
+            INSERT INTO api_keys (id, name, key_digest, key_prefix) VALUES %s
+        """, rows)
+        self.api_keys.extend(keys)
+
+    def ensure_history(self, rows: int) -> None:
+        '''Grow request_history and api_logs to rows rows each, spread over the last HISTORY_DAYS days'''
+        missing = rows - self.history_rows
+        if missing <= 0:
+            return
+        conn = psycopg2.connect(self.database_url)
+        try:
+            with conn.cursor() as cur:
+                for table in ('request_history', 'api_logs'):
+                    cur.execute("SELECT ensure_daily_partitions(%s, CURRENT_DATE - %s, CURRENT_DATE + 7)",
+                                (table, HISTORY_DAYS))
+                cur.execute("""
+                    INSERT INTO request_history (timestamp, endpoint, method, model, prompt_tokens,
+                                                 completion_tokens, total_tokens, duration_ms, status_code,
+                                                 user_message, ai_response)
+                    SELECT LOCALTIMESTAMP - random() * %s * INTERVAL '1 day', '/api/v1/completions', 'POST',
+                           (ARRAY['gpt-4', 'gpt-4o-mini', 'claude-3-haiku'])[1 + n %% 3],
+                           12, 7, 19, (random() * 2000)::int, CASE WHEN n %% 50 = 0 THEN 502 ELSE 200 END,
+                           'harness prompt ' || n || ' about databases and latency',
+                           'harness answer ' || n || ' with some generated text'
+                    FROM generate_series(1, %s) AS n
+                """, (HISTORY_DAYS, missing))
+                cur.execute("""
+                    INSERT INTO api_logs (timestamp, level, method, endpoint, status_code, message, duration_ms)
+                    SELECT LOCALTIMESTAMP - random() * %s * INTERVAL '1 day',
+                           CASE WHEN n %% 50 = 0 THEN 'error' ELSE 'info' END, 'POST', '/api/v1/completions',
+                           CASE WHEN n %% 50 = 0 THEN 502 ELSE 200 END, 'Success: 19 tokens', (random() * 2000)::int
+                    FROM generate_series(1, %s) AS n
+                """, (HISTORY_DAYS, missing))
+                cur.execute("ANALYZE request_history")
+                cur.execute("ANALYZE api_logs")
+            conn.commit()
+        finally:
+            conn.close()
+        self.history_rows = rows
+
+    def ensure_webhook(self) -> None:
+        self._execute_values("""
+            INSERT INTO webhooks (id, url, events) VALUES %s ON CONFLICT (id) DO NOTHING
+        """, [('wh_harness', self.webhook_url, ['chat.message'])])
+
+    def _execute_values(self, query: str, rows: List[Tuple[Any, ...]]) -> None:
+        conn = psycopg2.connect(self.database_url)
+        try:
+            with conn.cursor() as cur:
+                execute_values(cur, query, rows)
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def _completion_body(rng: random.Random, **extra: Any) -> Dict[str, Any]:
+    return {
+        'model': 'gpt-4o-mini',
+        'messages': [{'role': 'user', 'content': f'Harness question {rng.randrange(1000000)}'}],
+        **extra
+    }
+
+
+def _deep_cursor(rng: random.Random) -> str:
+    timestamp = datetime.now() - timedelta(days=rng.uniform(0, HISTORY_DAYS))
+    return base64.urlsafe_b64encode(f'{timestamp.isoformat()}|{2 ** 31}'.encode()).decode()
+
+
+def _scenarios(fixture: Fixture, keys: int) -> Dict[str, Tuple[str, Callable[[random.Random], Dict[str, Any]]]]:
+    def api_key(rng: random.Random) -> Dict[str, str]:
+        return {'X-Api-Key': fixture.api_keys[rng.randrange(keys)]}
+
+    def streaming(event: Dict[str, Any]) -> Dict[str, Any]:
+        event['supportsStreaming'] = True
+        return event
+
+    return {
+        'proxy': ('proxy', lambda rng: build_event('POST', '/', _completion_body(rng), api_key(rng))),
+        'proxy-cached': ('proxy', lambda rng: build_event(
+            'POST', '/', {'model': 'gpt-4o-mini', 'cache': True,
+                          'messages': [{'role': 'user', 'content': f'Cached question {rng.randrange(20)}'}]},
+            api_key(rng))),
+        'proxy-stream': ('proxy', lambda rng: streaming(build_event(
+            'POST', '/', _completion_body(rng, stream=True), api_key(rng)))),
+        'proxy-async': ('proxy/async_index', lambda rng: build_event('POST', '/', _completion_body(rng), api_key(rng))),
+        'proxy-async-stream': ('proxy/async_index', lambda rng: streaming(build_event(
+            'POST', '/', _completion_body(rng, stream=True), api_key(rng)))),
+        'gptunnel': ('gptunnel', lambda rng: build_event('POST', '/', _completion_body(rng))),
+        'history': ('history', lambda rng: build_event('GET', '/?action=history&limit=50')),
+        'history-deep': ('history', lambda rng: build_event(
+            'GET', f'/?action=history&limit=50&cursor={_deep_cursor(rng)}')),
+        'history-filtered': ('history', lambda rng: build_event('GET', '/?action=history&limit=50&status=502')),
+        'history-search': ('history', lambda rng: build_event(
+            'GET', f'/?action=search&q=prompt+{rng.randrange(1000)}&limit=20')),
+        'history-stats': ('history', lambda rng: build_event('GET', '/?action=stats')),
+        'logs': ('logs', lambda rng: build_event('GET', '/?limit=50&level=error')),
+        'api-keys': ('api-keys', lambda rng: build_event('GET', '/')),
+        'api-keys-search': ('api-keys', lambda rng: build_event('GET', f'/?q=key+{rng.randrange(keys)}&limit=50')),
+        'webhooks': ('webhooks', lambda rng: build_event('GET', '/')),
+        'webhooks-dispatch': ('webhooks', lambda rng: build_event('GET', '/?action=dispatch'))
+    }
+
+
+SCENARIOS = tuple(_scenarios(Fixture('', ''), 1))
+
+
+def _percentile(samples: List[float], quantile: float) -> float:
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(quantile * (len(ordered) - 1))))]
+
+
+def _flush_buffers(handler: Callable[..., Any]) -> None:
+    usage_buffer = getattr(handler, '__wrapped__', handler).__globals__.get('usage_buffer')
+    if usage_buffer is not None:
+        usage_buffer.flush()
+
+
+def run_profile(fixture: Fixture, counter: QueryCounter, scenario: str, concurrency: int, keys: int,
+                history_rows: int, requests: int, warmup: int, seed: int = 1) -> Dict[str, Any]:
+    '''
+    Drive one scenario with concurrency worker threads and measure throughput,
+    latency, statements and new database connections per request and, in a
+    separate serial pass under tracemalloc, allocation per request.
+    '''
+    fixture.ensure_keys(keys)
+    fixture.ensure_history(history_rows)
+    fixture.ensure_webhook()
+    function, make_event = _scenarios(fixture, keys)[scenario]
+    handler = load_handler(function)
+    local = threading.local()
+
+    def call(i: int) -> Tuple[float, int]:
+        rng = getattr(local, 'rng', None)
+        if rng is None:
+            rng = local.rng = random.Random(seed * 1000003 + threading.get_ident())
+        event = make_event(rng)
+        started = time.perf_counter()
+        response = handler(event, None)
+        read_body(response)
+        return (time.perf_counter() - started) * 1000, response['statusCode']
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(call, range(warmup)))
+        _flush_buffers(handler)
+        counter.reset()
+        counter.reset_connections()
+        started = time.perf_counter()
+        samples = list(executor.map(call, range(requests)))
+        elapsed = time.perf_counter() - started
+        _flush_buffers(handler)
+        queries = counter.reset()
+        connections = counter.reset_connections()
+
+    allocation_runs = min(requests, ALLOCATION_SAMPLE)
+    peaks = []
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    try:
+        for i in range(allocation_runs):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            call(i)
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+    retained_blocks = (sys.getallocatedblocks() - blocks_before) / max(allocation_runs, 1)
+
+    latencies = [latency for latency, _ in samples]
+    statuses: Dict[str, int] = {}
+    for _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'scenario': scenario,
+        'function': function,
+        'concurrency': concurrency,
+        'keys': keys,
+        'historyRows': history_rows,
+        'requests': requests,
+        'throughputRps': round(requests / elapsed, 2) if elapsed else 0.0,
+        'latencyMs': {
+            'p50': round(_percentile(latencies, 0.5), 3),
+            'p99': round(_percentile(latencies, 0.99), 3),
+            'mean': round(statistics.fmean(latencies), 3) if latencies else 0.0
+        },
+        'statuses': statuses,
+        'errors': sum(count for status, count in statuses.items() if int(status) >= 500),
+        'queriesPerRequest': round(queries / requests, 3) if requests else 0.0,
+        'connectionsPerRequest': round(connections / requests, 3) if requests else 0.0,
+        'allocPeakKibPerRequest': round(statistics.fmean(peaks) / 1024, 2) if peaks else 0.0,
+        'retainedBlocksPerRequest': round(retained_blocks, 2)
+    }
+
+
+def run_pooling(fixture: Fixture, counter: QueryCounter, scenario: str, pooled: bool, concurrency: int,
+                keys: int, requests: int, warmup: int) -> Dict[str, Any]:
+    '''
+    run_profile() with the handler's connection pool on or off. With
+    DB_POOL_ENABLED=0 every borrowed connection is closed on return, so the
+    difference is what connecting per request costs.
+    '''
+    os.environ['DB_POOL_ENABLED'] = '1' if pooled else '0'
+    try:
+        result = run_profile(fixture, counter, scenario, concurrency, keys, 0, requests, warmup)
+    finally:
+        os.environ.pop('DB_POOL_ENABLED', None)
+    result['pooled'] = pooled
+    return result
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    '''List regressions against a previous results file beyond the max_regression ratio'''
+    def profile_key(result: Dict[str, Any]) -> Tuple[Any, ...]:
+        return result['scenario'], result['concurrency'], result['keys'], result['historyRows']
+
+    previous = {profile_key(r): r for r in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        old = previous.get(profile_key(result))
+        if old is None:
+            continue
+        name = '{}[c={} keys={} rows={}]'.format(*profile_key(result))
+        if result['throughputRps'] < old['throughputRps'] * (1 - max_regression):
+            regressions.append(f"{name}: throughput {old['throughputRps']} -> {result['throughputRps']} rps")
+        if result['latencyMs']['p99'] > old['latencyMs']['p99'] * (1 + max_regression):
+            regressions.append(f"{name}: p99 {old['latencyMs']['p99']} -> {result['latencyMs']['p99']} ms")
+        if result['queriesPerRequest'] > old['queriesPerRequest'] * (1 + max_regression) + 0.01:
+            regressions.append(f"{name}: queries/request {old['queriesPerRequest']} -> {result['queriesPerRequest']}")
+        if result['errors'] > old['errors']:
+            regressions.append(f"{name}: errors {old['errors']} -> {result['errors']}")
+    return regressions
+
+
+def dump_results(results: List[Dict[str, Any]], metadata: Dict[str, Any]) -> str:
+    return json.dumps({**metadata, 'results': results}, indent=2)
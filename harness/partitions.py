@@ -0,0 +1,118 @@
+import statistics
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Set, Tuple
+import psycopg2
+
+from harness.load import Fixture, _percentile
+
+WINDOWS = (('1h', timedelta(hours=1)), ('1d', timedelta(days=1)), ('7d', timedelta(days=7)),
+           ('30d', timedelta(days=30)))
+QUERIES = {
+    'history-page': """
+        SELECT id, timestamp, model, total_tokens, duration_ms, status_code
+        FROM {table}
+        WHERE timestamp >= %(start)s AND timestamp < %(end)s
+        ORDER BY timestamp DESC, id DESC
+        LIMIT 50
+    """,
+    'history-aggregate': """
+        SELECT count(*), COALESCE(sum(total_tokens), 0), avg(duration_ms)
+        FROM {table}
+        WHERE timestamp >= %(start)s AND timestamp < %(end)s
+    """,
+    'logs-errors': """
+        SELECT id, timestamp, endpoint, status_code, message
+        FROM {table}
+        WHERE level = 'error' AND timestamp >= %(start)s AND timestamp < %(end)s
+        ORDER BY timestamp DESC
+        LIMIT 50
+    """
+}
+PARENTS = {'history-page': 'request_history', 'history-aggregate': 'request_history', 'logs-errors': 'api_logs'}
+
+
+def _create_flat_copies(conn: Any) -> None:
+    '''Unpartitioned copies of request_history and api_logs with the same indexes, as they were before V0011'''
+    with conn.cursor() as cur:
+        for table, indexes in (('request_history', ('timestamp DESC, id DESC',)),
+                               ('api_logs', ('timestamp DESC', 'level'))):
+            cur.execute(f"DROP TABLE IF EXISTS {table}_flat")
+            cur.execute(f"CREATE TABLE {table}_flat AS SELECT * FROM {table}")
+            cur.execute(f"ALTER TABLE {table}_flat ADD PRIMARY KEY (id)")
+            for i, columns in enumerate(indexes):
+                cur.execute(f"CREATE INDEX {table}_flat_{i} ON {table}_flat ({columns})")
+            cur.execute(f"ANALYZE {table}_flat")
+    conn.commit()
+
+
+def _scanned_relations(plan: Dict[str, Any], found: Set[str]) -> Set[str]:
+    if 'Relation Name' in plan:
+        found.add(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        _scanned_relations(child, found)
+    return found
+
+
+def _measure(conn: Any, query: str, params: Dict[str, Any], repeats: int) -> Tuple[List[float], int]:
+    with conn.cursor() as cur:
+        cur.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+        plan = cur.fetchone()[0][0]['Plan']
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            cur.execute(query, params)
+            cur.fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+    conn.rollback()
+    return timings, len(_scanned_relations(plan, set()))
+
+
+def run_partitions(fixture: Fixture, rows: int, repeats: int = 20) -> List[Dict[str, Any]]:
+    '''
+    Grow request_history and api_logs to rows rows each over the last 30 days,
+    then time the range queries the history and logs views send, over windows
+    of one hour to 30 days ending now. Each query runs against the daily
+    partitions and against an unpartitioned copy with the same indexes.
+    Reports p50/p99 latency and how many tables the plan touches after
+    partition pruning.
+    '''
+    fixture.ensure_history(rows)
+    conn = psycopg2.connect(fixture.database_url)
+    try:
+        _create_flat_copies(conn)
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT count(*) FROM pg_inherits
+                WHERE inhparent = 'request_history'::regclass
+            """)
+            partition_count = cur.fetchone()[0]
+        conn.rollback()
+
+        end = datetime.now()
+        results = []
+        for name, query in QUERIES.items():
+            parent = PARENTS[name]
+            for window, span in WINDOWS:
+                params = {'start': end - span, 'end': end}
+                for layout, table in (('partitioned', parent), ('flat', f'{parent}_flat')):
+                    timings, relations = _measure(conn, query.format(table=table), params, repeats)
+                    results.append({
+                        'query': name,
+                        'window': window,
+                        'layout': layout,
+                        'rows': rows,
+                        'partitions': partition_count if layout == 'partitioned' else 1,
+                        'relationsScanned': relations,
+                        'latencyMs': {
+                            'p50': round(_percentile(timings, 0.5), 3),
+                            'p99': round(_percentile(timings, 0.99), 3),
+                            'mean': round(statistics.fmean(timings), 3)
+                        }
+                    })
+        with conn.cursor() as cur:
+            cur.execute("DROP TABLE request_history_flat, api_logs_flat")
+        conn.commit()
+        return results
+    finally:
+        conn.close()
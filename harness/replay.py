@@ -0,0 +1,52 @@
+import json
+from typing import Any, Dict, List, Optional
+
+from harness.functions import BACKEND_DIR, build_event, load_handler, matches, read_body
+
+ENTRIES = ('index', 'async_index')
+
+
+def discover_functions() -> List[str]:
+    '''Backend folders that ship a handler and a tests.json'''
+    return sorted(p.name for p in BACKEND_DIR.iterdir()
+                  if (p / 'index.py').is_file() and (p / 'tests.json').is_file())
+
+
+def handlers_of(function: str) -> List[str]:
+    '''Handler entry points of a function in load_handler() notation: index.py and variants such as async_index.py'''
+    return [function if entry == 'index' else f'{function}/{entry}'
+            for entry in ENTRIES if (BACKEND_DIR / function / f'{entry}.py').is_file()]
+
+
+def replay(functions: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    '''Run every tests.json case against each handler of the function and return one result per case'''
+    results = []
+    for function in functions or discover_functions():
+        for target in handlers_of(function):
+            handler = load_handler(target)
+            cases = json.loads((BACKEND_DIR / function / 'tests.json').read_text())['tests']
+            for case in cases:
+                event = build_event(case.get('method', 'GET'), case.get('path', '/'),
+                                    case.get('body'), case.get('headers'))
+                try:
+                    response = handler(event, None)
+                    body = read_body(response)
+                except Exception as e:
+                    results.append({'function': target, 'name': case['name'], 'passed': False,
+                                    'reason': f'{type(e).__name__}: {e}'})
+                    continue
+
+                reason = ''
+                if response['statusCode'] != case['expectedStatus']:
+                    reason = (f"expected status {case['expectedStatus']}, "
+                              f"got {response['statusCode']}: {body[:200]}")
+                elif 'expectedBody' in case:
+                    try:
+                        actual = json.loads(body)
+                    except ValueError:
+                        actual = body
+                    ok, reason = matches(case['expectedBody'], actual,
+                                         case.get('bodyMatcher', 'partial') == 'partial')
+                results.append({'function': target, 'name': case['name'], 'passed': not reason,
+                                'reason': reason})
+    return results
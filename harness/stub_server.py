@@ -0,0 +1,134 @@
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+
+STUB_CONTENT = 'Hello from the harness stub.'
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StubServer:
+    '''
+    Local stand-in for GPTunnel and webhook receivers.
+    POST /v1/chat/completions answers like the chat completions API, as JSON or
+    as an SSE stream when the payload asks for one, after latency_ms, or after
+    slow_ms for a slow_ratio share of calls. A status other than 200 makes it
+    answer completions with that error instead.
+    POST /webhook accepts deliveries and counts them.
+    in_flight and peak_in_flight count completions being answered at once,
+    connections the TCP connections accepted.
+    '''
+
+    def __init__(self, latency_ms: float = 0.0, status: int = 200, slow_ratio: float = 0.0, slow_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.slow_ratio = slow_ratio
+        self.slow_ms = slow_ms
+        self.status = status
+        self.completions = 0
+        self.webhook_deliveries = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def completions_url(self) -> str:
+        return f'{self.base_url}/v1/chat/completions'
+
+    @property
+    def webhook_url(self) -> str:
+        return f'{self.base_url}/webhook'
+
+    def __enter__(self) -> 'StubServer':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self) -> type:
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+            def setup(self) -> None:
+                super().setup()
+                with stub._lock:
+                    stub.connections += 1
+
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if self.path.startswith('/webhook'):
+                    with stub._lock:
+                        stub.webhook_deliveries += 1
+                    self._send(200, 'application/json', b'{}')
+                    return
+
+                payload: Dict[str, Any] = json.loads(body or b'{}')
+                with stub._lock:
+                    stub.in_flight += 1
+                    stub.peak_in_flight = max(stub.peak_in_flight, stub.in_flight)
+                try:
+                    if stub.slow_ratio and random.random() < stub.slow_ratio:
+                        time.sleep(stub.slow_ms / 1000)
+                    elif stub.latency_ms:
+                        time.sleep(stub.latency_ms / 1000)
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+                        stub.completions += 1
+                if stub.status != 200:
+                    self._send(stub.status, 'application/json', b'{"error": "stub failure"}')
+                    return
+                usage = {'prompt_tokens': 12, 'completion_tokens': 7, 'total_tokens': 19}
+                model = payload.get('model', 'gpt-4')
+                if payload.get('stream'):
+                    chunks = [{'model': model, 'choices': [{'delta': {'content': word + ' '}}]}
+                              for word in STUB_CONTENT.split()]
+                    chunks.append({'model': model, 'choices': [], 'usage': usage})
+                    data = ''.join(f'data: {json.dumps(chunk)}\n\n' for chunk in chunks) + 'data: [DONE]\n\n'
+                    self._send(200, 'text/event-stream', data.encode())
+                    return
+                self._send(200, 'application/json', json.dumps({
+                    'id': 'chatcmpl-harness',
+                    'object': 'chat.completion',
+                    'model': model,
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': STUB_CONTENT},
+                                 'finish_reason': 'stop'}],
+                    'usage': usage
+                }).encode())
+
+            def _send(self, status: int, content_type: str, data: bytes) -> None:
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                if self.close_connection:
+                    self.send_header('Connection', 'close')
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
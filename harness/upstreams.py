@@ -0,0 +1,124 @@
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Any, Dict, List, Tuple
+
+from harness.functions import build_event, load_handler, read_body
+from harness.load import _percentile
+from harness.stub_server import StubServer
+
+UNREACHABLE_URL = 'http://127.0.0.1:9/v1/chat/completions'
+
+
+def _drive(handler: Any, requests: int, concurrency: int) -> Dict[str, Any]:
+    event = build_event('POST', '/', {'model': 'gpt-4o-mini', 'messages': [{'role': 'user', 'content': 'Hi'}]})
+
+    def call(i: int) -> Tuple[float, int]:
+        started = time.perf_counter()
+        response = handler(dict(event), None)
+        read_body(response)
+        return (time.perf_counter() - started) * 1000, response['statusCode']
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(call, range(requests)))
+    latencies = [latency for latency, _ in samples]
+    statuses: Dict[str, int] = {}
+    for _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'statuses': statuses,
+        'latencyMs': {
+            'p50': round(_percentile(latencies, 0.5), 3),
+            'p99': round(_percentile(latencies, 0.99), 3),
+            'mean': round(statistics.fmean(latencies), 3) if latencies else 0.0
+        }
+    }
+
+
+def run_upstreams(strategy: str, requests: int = 400, concurrency: int = 8) -> Dict[str, Any]:
+    '''
+    Drive the gptunnel handler against several local upstreams: a fast and a
+    slow stub, one answering 503 and an unreachable address. Halfway through
+    the fast stub starts failing too. Reports statuses, latency and how many
+    completions each stub served in both halves, plus the balancer's view.
+    The proxy function routes through the same balancer module.
+    '''
+    with ExitStack() as stack:
+        stubs = {
+            'fast': stack.enter_context(StubServer(latency_ms=5)),
+            'slow': stack.enter_context(StubServer(latency_ms=60)),
+            'failing': stack.enter_context(StubServer(status=503))
+        }
+        upstreams = [{'name': name, 'url': stub.completions_url} for name, stub in stubs.items()]
+        upstreams.append({'name': 'unreachable', 'url': UNREACHABLE_URL})
+        os.environ['UPSTREAMS'] = json.dumps(upstreams)
+        os.environ['UPSTREAM_STRATEGY'] = strategy
+        os.environ.setdefault('GPTUNNEL_API_KEY', 'harness')
+        try:
+            handler = load_handler('gptunnel')
+            phases: List[Dict[str, Any]] = []
+            for name, change in (('healthy', None), ('fast-failing', 'fast')):
+                if change:
+                    stubs[change].status = 503
+                before = {stub_name: stub.completions for stub_name, stub in stubs.items()}
+                result = _drive(handler, requests // 2, concurrency)
+                result['phase'] = name
+                result['served'] = {stub_name: stub.completions - before[stub_name]
+                                    for stub_name, stub in stubs.items()}
+                phases.append(result)
+            balancer = handler.__wrapped__.__globals__['post'].__globals__['get_balancer']()
+            return {'strategy': strategy, 'concurrency': concurrency, 'phases': phases,
+                    'upstreams': balancer.state()}
+        finally:
+            os.environ.pop('UPSTREAMS', None)
+            os.environ.pop('UPSTREAM_STRATEGY', None)
+
+
+def run_hedging(hedge: bool, requests: int = 400, concurrency: int = 8) -> Dict[str, Any]:
+    '''
+    Drive the gptunnel handler against two stubs that answer in 20ms but take
+    500ms for 3% of calls, with hedging on or off. Reports caller latency, how
+    many completions the stubs ran in total (the load hedging added) and the
+    hedge counters.
+    '''
+    with ExitStack() as stack:
+        stubs = [stack.enter_context(StubServer(latency_ms=20, slow_ratio=0.03, slow_ms=500)) for _ in range(2)]
+        os.environ['UPSTREAMS'] = json.dumps([{'name': f'stub-{i}', 'url': stub.completions_url}
+                                              for i, stub in enumerate(stubs)])
+        os.environ['UPSTREAM_HEDGE_ENABLED'] = '1' if hedge else '0'
+        os.environ.setdefault('GPTUNNEL_API_KEY', 'harness')
+        try:
+            handler = load_handler('gptunnel')
+            result = _drive(handler, requests, concurrency)
+            policy = handler.__wrapped__.__globals__['post'].__globals__['hedge_policy']
+            result.update({'hedge': hedge, 'concurrency': concurrency, 'requests': requests,
+                           'upstreamCompletions': sum(stub.completions for stub in stubs), **policy.state()})
+            return result
+        finally:
+            os.environ.pop('UPSTREAMS', None)
+            os.environ.pop('UPSTREAM_HEDGE_ENABLED', None)
+
+
+def run_keepalive(keepalive: bool, requests: int = 400, concurrency: int = 8,
+                  latency_ms: float = 5.0) -> Dict[str, Any]:
+    '''
+    Drive the gptunnel handler against one stub with upstream keep-alive on or
+    off. Reports caller latency and how many TCP connections the stub accepted;
+    with UPSTREAM_KEEPALIVE=0 every completion opens its own.
+    '''
+    with StubServer(latency_ms=latency_ms) as stub:
+        os.environ['UPSTREAMS'] = json.dumps([{'name': 'stub', 'url': stub.completions_url}])
+        os.environ['UPSTREAM_KEEPALIVE'] = '1' if keepalive else '0'
+        os.environ.setdefault('GPTUNNEL_API_KEY', 'harness')
+        try:
+            handler = load_handler('gptunnel')
+            result = _drive(handler, requests, concurrency)
+            result.update({'keepalive': keepalive, 'concurrency': concurrency, 'requests': requests,
+                           'upstreamCompletions': stub.completions, 'upstreamConnections': stub.connections})
+            return result
+        finally:
+            os.environ.pop('UPSTREAMS', None)
+            os.environ.pop('UPSTREAM_KEEPALIVE', None)
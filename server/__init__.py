@@ -0,0 +1 @@
+'''Self-hosted server that runs every backend function in one process per worker; see server/__main__.py'''
@@ -0,0 +1,45 @@
+'''
+Self-hosted server for the backend functions.
+
+    python -m server [--interface asgi] [--host 0.0.0.0] [--port 8000] [--workers 4] [--threads 32]
+
+Every worker process imports all mounted functions once and answers each under
+/<function>: POST /proxy, GET /history?action=stats, DELETE /api-keys?id=...
+Requests are turned into the same event dict the cloud platform delivers, so
+handlers run unchanged. runtime, timing and balancer are imported once per
+worker, so the functions share one database pool (DB_POOL_SIZE connections),
+one upstream session and one balancer instead of one each.
+
+asgi runs uvicorn and mounts the proxy's asyncio handler; the other functions
+run on --threads threads per worker. wsgi runs gunicorn with gthread workers
+and the synchronous handlers only. SERVER_FUNCTIONS picks the functions to
+mount, by default every backend folder with an index.py.
+'''
+import argparse
+import os
+import sys
+from typing import List, Optional
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m server', description='Serve every backend function')
+    parser.add_argument('--interface', choices=('asgi', 'wsgi'), default='asgi')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threads', type=int, default=32)
+    args = parser.parse_args(argv)
+
+    if args.interface == 'wsgi':
+        os.execvp(sys.executable, [sys.executable, '-m', 'gunicorn', '--bind', f'{args.host}:{args.port}',
+                                   '--workers', str(args.workers), '--threads', str(args.threads),
+                                   '--worker-class', 'gthread', 'server.wsgi:app'])
+
+    import uvicorn
+    os.environ['SERVER_THREADS'] = str(args.threads)
+    uvicorn.run('server.asgi:app', host=args.host, port=args.port, workers=args.workers, access_log=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+import asyncio
+import inspect
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from server.functions import (Handler, body_bytes, build_event, encode_chunk, load_functions, mounted_functions,
+                              not_found, response_headers, route)
+
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', '32'))
+
+_END = object()
+
+
+class ASGIApp:
+    '''
+    ASGI application serving every mounted function under /<function>.
+    Coroutine handlers run on the worker's event loop. Synchronous handlers,
+    and the iterator bodies they stream, run on SERVER_THREADS threads so a
+    blocked handler never stalls the loop.
+    '''
+
+    def __init__(self, handlers: Dict[str, Handler]):
+        self.handlers = handlers
+        self._coroutines = {name for name, handler in handlers.items() if inspect.iscoroutinefunction(handler)}
+        self._executor = ThreadPoolExecutor(max_workers=SERVER_THREADS, thread_name_prefix='handler')
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable[..., Any], send: Callable[..., Any]) -> None:
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        body = await self._read_body(receive)
+        function, path = route(scope['path'])
+        handler = self.handlers.get(function)
+        if handler is None:
+            response = not_found()
+        else:
+            event = build_event(scope['method'], path, scope.get('query_string', b'').decode('latin-1'),
+                                [(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']],
+                                body)
+            if function in self._coroutines:
+                response = await handler(event, None)
+            else:
+                response = await asyncio.get_running_loop().run_in_executor(self._executor, handler, event, None)
+        await self._send(response, send)
+
+    async def _send(self, response: Dict[str, Any], send: Callable[..., Any]) -> None:
+        await send({
+            'type': 'http.response.start',
+            'status': response.get('statusCode', 200),
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in response_headers(response)]
+        })
+        data = body_bytes(response)
+        if data is not None:
+            await send({'type': 'http.response.body', 'body': data})
+            return
+
+        body = response['body']
+        if hasattr(body, '__aiter__'):
+            chunks = body.__aiter__()
+            try:
+                async for chunk in chunks:
+                    await send({'type': 'http.response.body', 'body': encode_chunk(chunk), 'more_body': True})
+            finally:
+                aclose = getattr(chunks, 'aclose', None)
+                if aclose is not None:
+                    await aclose()
+        else:
+            loop = asyncio.get_running_loop()
+            chunks = iter(body)
+            try:
+                while True:
+                    chunk = await loop.run_in_executor(self._executor, next, chunks, _END)
+                    if chunk is _END:
+                        break
+                    await send({'type': 'http.response.body', 'body': encode_chunk(chunk), 'more_body': True})
+            finally:
+                close = getattr(chunks, 'close', None)
+                if close is not None:
+                    await loop.run_in_executor(self._executor, close)
+        await send({'type': 'http.response.body', 'body': b''})
+
+    @staticmethod
+    async def _read_body(receive: Callable[..., Any]) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def _lifespan(self, receive: Callable[..., Any], send: Callable[..., Any]) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+app = ASGIApp(load_functions(mounted_functions(), prefer_async=True))
@@ -0,0 +1,128 @@
+import base64
+import importlib.util
+import os
+import sys
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+ENTRIES = ('index', 'async_index')
+
+Handler = Callable[[Dict[str, Any], Any], Any]
+
+
+def mounted_functions() -> List[str]:
+    '''SERVER_FUNCTIONS as a comma-separated list, by default every backend folder that ships an index.py'''
+    names = os.environ.get('SERVER_FUNCTIONS', '')
+    if names:
+        return [name.strip() for name in names.split(',') if name.strip()]
+    return sorted(p.name for p in BACKEND_DIR.iterdir() if (p / 'index.py').is_file())
+
+
+def shared_modules(functions: Iterable[str]) -> Set[str]:
+    '''Sibling modules shipped by several of the functions, byte-identical in every folder that ships them'''
+    sources: Dict[str, List[bytes]] = {}
+    for function in functions:
+        for path in (BACKEND_DIR / function).glob('*.py'):
+            if path.stem not in ENTRIES:
+                sources.setdefault(path.stem, []).append(path.read_bytes())
+    return {name for name, variants in sources.items() if len(variants) > 1 and len(set(variants)) == 1}
+
+
+def load_functions(functions: List[str], prefer_async: bool = False) -> Dict[str, Handler]:
+    '''
+    Import every function's handler into this process. Modules returned by
+    shared_modules(), such as runtime, timing and balancer, are imported once
+    and stay registered, so the functions share their connection pools,
+    upstream sessions and caches. Every other sibling module is unregistered
+    after its function is loaded, so folders that ship different modules with
+    the same name do not see each other's copies. With prefer_async, a folder's
+    async_index.py is mounted instead of its index.py.
+    '''
+    shared = shared_modules(functions)
+    handlers = {}
+    for function in functions:
+        folder = BACKEND_DIR / function
+        entry = 'async_index' if prefer_async and (folder / 'async_index.py').is_file() else 'index'
+        before = set(sys.modules)
+        sys.path.insert(0, str(folder))
+        try:
+            spec = importlib.util.spec_from_file_location(f'backend_{function.replace("-", "_")}_{entry}',
+                                                          folder / f'{entry}.py')
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        finally:
+            sys.path.remove(str(folder))
+            for name in set(sys.modules) - before:
+                path = getattr(sys.modules[name], '__file__', None) or ''
+                if name not in shared and Path(path).resolve().parent == folder.resolve():
+                    del sys.modules[name]
+        handlers[function] = module.handler
+    return handlers
+
+
+def route(path: str) -> Tuple[str, str]:
+    '''Split /<function>/rest into the function name and the path the function sees'''
+    function, _, rest = path.lstrip('/').partition('/')
+    return function, '/' + rest
+
+
+def header_name(name: str) -> str:
+    '''x-api-key -> X-Api-Key, the spelling the platform delivers headers in'''
+    return '-'.join(part.capitalize() for part in name.split('-'))
+
+
+def build_event(method: str, path: str, query_string: str, headers: Iterable[Tuple[str, str]],
+                body: bytes) -> Dict[str, Any]:
+    '''Cloud function event for an HTTP request, in the shape the platform delivers to handlers'''
+    event_headers: Dict[str, str] = {}
+    for name, value in headers:
+        name = header_name(name)
+        event_headers[name] = f'{event_headers[name]}, {value}' if name in event_headers else value
+    try:
+        text: Optional[str] = body.decode('utf-8') if body else None
+        encoded = False
+    except UnicodeDecodeError:
+        text = base64.b64encode(body).decode()
+        encoded = True
+    return {
+        'httpMethod': method,
+        'path': path,
+        'headers': event_headers,
+        'queryStringParameters': dict(parse_qsl(query_string, keep_blank_values=True)),
+        'body': text,
+        'isBase64Encoded': encoded,
+        'supportsStreaming': True,
+        'requestContext': {'requestId': event_headers.get('X-Request-Id') or uuid.uuid4().hex}
+    }
+
+
+def not_found() -> Dict[str, Any]:
+    return {
+        'statusCode': 404,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': '{"error":"Not found"}',
+        'isBase64Encoded': False
+    }
+
+
+def response_headers(response: Dict[str, Any]) -> List[Tuple[str, str]]:
+    return [(name, str(value)) for name, value in (response.get('headers') or {}).items()]
+
+
+def encode_chunk(chunk: Any) -> bytes:
+    return chunk if isinstance(chunk, bytes) else str(chunk).encode('utf-8')
+
+
+def body_bytes(response: Dict[str, Any]) -> Optional[bytes]:
+    '''The whole body of a response whose body is a string, None when it is an iterator'''
+    body = response.get('body')
+    if body is None:
+        return b''
+    if not isinstance(body, str):
+        return None
+    if response.get('isBase64Encoded'):
+        return base64.b64decode(body)
+    return body.encode('utf-8')
@@ -0,0 +1,66 @@
+from http import HTTPStatus
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+from server.functions import (Handler, body_bytes, build_event, encode_chunk, load_functions, mounted_functions,
+                              not_found, response_headers, route)
+
+
+def _reason(status: int) -> str:
+    try:
+        return HTTPStatus(status).phrase
+    except ValueError:
+        return ''
+
+
+def _headers(environ: Dict[str, Any]) -> List[Tuple[str, str]]:
+    headers = [(key[5:].replace('_', '-'), value) for key, value in environ.items() if key.startswith('HTTP_')]
+    for key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+        if environ.get(key):
+            headers.append((key.replace('_', '-'), environ[key]))
+    return headers
+
+
+class _Body:
+    '''WSGI iterable over a streamed body that closes it when the server is done, even unstarted'''
+
+    def __init__(self, body: Iterable[Any]):
+        self._chunks = iter(body)
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self
+
+    def __next__(self) -> bytes:
+        return encode_chunk(next(self._chunks))
+
+    def close(self) -> None:
+        close = getattr(self._chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class WSGIApp:
+    '''WSGI application serving every mounted function's synchronous handler under /<function>'''
+
+    def __init__(self, handlers: Dict[str, Handler]):
+        self.handlers = handlers
+
+    def __call__(self, environ: Dict[str, Any], start_response: Callable[..., Any]) -> Iterable[bytes]:
+        function, path = route(environ.get('PATH_INFO') or '/')
+        handler = self.handlers.get(function)
+        if handler is None:
+            response = not_found()
+        else:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            body = environ['wsgi.input'].read(length) if length else b''
+            response = handler(build_event(environ['REQUEST_METHOD'], path, environ.get('QUERY_STRING', ''),
+                                           _headers(environ), body), None)
+
+        status = response.get('statusCode', 200)
+        start_response(f'{status} {_reason(status)}', response_headers(response))
+        data = body_bytes(response)
+        if data is not None:
+            return [data]
+        return _Body(response['body'])
+
+
+app = WSGIApp(load_functions(mounted_functions()))